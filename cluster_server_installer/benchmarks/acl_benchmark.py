@@ -0,0 +1,110 @@
+import argparse
+import ipaddress
+import json
+import statistics
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, List, Sequence
+
+from cluster_server_installer.vpn.acl_policy import AclPolicy
+
+# The policy the installer wrote before the generator: one autoApprover entry per node subnet
+LEGACY_TEMPLATE = """
+{{
+  "acls": [
+  {{"action": "accept", "src": ["*"], "dst": ["*:*"]}}
+  ],
+  "autoApprovers": {{
+        "routes": {{
+            "10.42.0.0/16":        ["cluster-user"],
+{cluster_subnets}            "2001:cafe:42::/56": ["cluster-user"],
+        }},
+    }},
+}}
+"""
+
+
+@dataclass(frozen=True)
+class AclRun:
+    generator: str
+    node_subnets: int
+    route_entries: int
+    policy_bytes: int
+    generate_ms: float
+    incremental_add_ms: float
+
+
+def node_subnets(count: int) -> List[str]:
+    # /24 per node, spilling out of the pod /16 into neighbouring space once it is full so larger fleets also
+    # exercise aggregation across several parents
+    base = int(ipaddress.ip_address('10.42.0.0'))
+    return [str(ipaddress.ip_network((base + index * 256, 24))) for index in range(count)]
+
+
+def legacy_policy(subnets: Sequence[str]) -> str:
+    string = ''
+    for subnet in subnets:
+        string += f'            "{subnet}":        ["cluster-user"],\n'
+    return LEGACY_TEMPLATE.format(cluster_subnets=string)
+
+
+def generated_policy(subnets: Sequence[str]) -> AclPolicy:
+    policy = AclPolicy()
+    policy.add_route_prefixes(['10.42.0.0/16', '10.43.0.0/16', '2001:cafe:42::/56', *subnets])
+    return policy
+
+
+def _timed_ms(action: Callable[[], object], repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        action()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def run_benchmark(sizes: Sequence[int], repeat: int) -> List[AclRun]:
+    results = []
+    for size in sizes:
+        subnets = node_subnets(size)
+        extra_subnet = node_subnets(size + 1)[-1]
+
+        legacy = legacy_policy(subnets)
+        # The legacy file was rewritten from scratch for every change
+        results.append(AclRun('legacy', size, legacy.count('["cluster-user"]'), len(legacy.encode()),
+                              _timed_ms(lambda: legacy_policy(subnets), repeat),
+                              _timed_ms(lambda: legacy_policy([*subnets, extra_subnet]), repeat)))
+
+        policy = generated_policy(subnets)
+        document = policy.to_json()
+
+        def add_one():
+            AclPolicy(policy.document()).add_route_prefixes([extra_subnet])
+
+        results.append(AclRun('generator', size, len(json.loads(document)['autoApprovers']['routes']),
+                              len(document.encode()), _timed_ms(lambda: generated_policy(subnets).to_json(), repeat),
+                              _timed_ms(add_one, repeat)))
+    return results
+
+
+def format_report(results: List[AclRun]) -> str:
+    lines = [f'{"generator":<11}{"subnets":>9}{"entries":>9}{"bytes":>10}{"generate ms":>13}{"add one ms":>12}']
+    for result in results:
+        lines.append(f'{result.generator:<11}{result.node_subnets:>9}{result.route_entries:>9}'
+                     f'{result.policy_bytes:>10}{result.generate_ms:>13.3f}{result.incremental_add_ms:>12.3f}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares headscale policy size and generation time as the number '
+                                                 'of node subnets grows')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 255, 1024, 4096, 16384])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='Print the raw results as JSON')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmark(args.sizes, args.repeat)
+    if args.json:
+        print(json.dumps([asdict(result) for result in benchmark_results], indent=2))
+    else:
+        print(format_report(benchmark_results))
@@ -0,0 +1,427 @@
+import dataclasses
+import itertools
+import json
+import pathlib
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Final, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import yaml
+
+
+@dataclass(frozen=True)
+class ResourceType:
+    group: str
+    version: str
+    kind: str
+    plural: str
+    namespaced: bool
+
+    @property
+    def api_version(self) -> str:
+        return f'{self.group}/{self.version}' if self.group else self.version
+
+
+@dataclass(frozen=True)
+class ReadinessDelays:
+    crd_established: float = 0.2
+    deployment_rollout: float = 1.0
+    daemon_set_rollout: float = 1.0
+    service_endpoints: float = 0.5
+    helm_chart_job: float = 2.0
+    metrics_server: float = 2.0
+    dashboard: float = 1.0
+
+    def scaled(self, factor: float) -> 'ReadinessDelays':
+        return dataclasses.replace(self, **{delay.name: getattr(self, delay.name) * factor
+                                            for delay in dataclasses.fields(self)})
+
+
+BUILTIN_RESOURCES: Final[List[ResourceType]] = [
+    ResourceType('', 'v1', 'Namespace', 'namespaces', False),
+    ResourceType('', 'v1', 'Secret', 'secrets', True),
+    ResourceType('', 'v1', 'ConfigMap', 'configmaps', True),
+    ResourceType('', 'v1', 'Service', 'services', True),
+    ResourceType('', 'v1', 'ServiceAccount', 'serviceaccounts', True),
+    ResourceType('', 'v1', 'Endpoints', 'endpoints', True),
+    ResourceType('', 'v1', 'PersistentVolumeClaim', 'persistentvolumeclaims', True),
+    ResourceType('', 'v1', 'PersistentVolume', 'persistentvolumes', False),
+    ResourceType('', 'v1', 'Pod', 'pods', True),
+    ResourceType('apps', 'v1', 'Deployment', 'deployments', True),
+    ResourceType('apps', 'v1', 'DaemonSet', 'daemonsets', True),
+    ResourceType('apps', 'v1', 'StatefulSet', 'statefulsets', True),
+    ResourceType('batch', 'v1', 'Job', 'jobs', True),
+    ResourceType('rbac.authorization.k8s.io', 'v1', 'ClusterRole', 'clusterroles', False),
+    ResourceType('rbac.authorization.k8s.io', 'v1', 'ClusterRoleBinding', 'clusterrolebindings', False),
+    ResourceType('rbac.authorization.k8s.io', 'v1', 'Role', 'roles', True),
+    ResourceType('rbac.authorization.k8s.io', 'v1', 'RoleBinding', 'rolebindings', True),
+    ResourceType('networking.k8s.io', 'v1', 'Ingress', 'ingresses', True),
+    ResourceType('storage.k8s.io', 'v1', 'StorageClass', 'storageclasses', False),
+    ResourceType('admissionregistration.k8s.io', 'v1', 'MutatingWebhookConfiguration',
+                 'mutatingwebhookconfigurations', False),
+    ResourceType('admissionregistration.k8s.io', 'v1', 'ValidatingWebhookConfiguration',
+                 'validatingwebhookconfigurations', False),
+    ResourceType('apiextensions.k8s.io', 'v1', 'CustomResourceDefinition', 'customresourcedefinitions', False),
+    # Bundled with k3s itself
+    ResourceType('helm.cattle.io', 'v1', 'HelmChart', 'helmcharts', True),
+]
+# CRDs that a chart installs through the k3s helm-controller rather than through our manifests
+HELM_CHART_CRDS: Final[Dict[str, List[ResourceType]]] = {
+    'traefik': [ResourceType('traefik.containo.us', 'v1alpha1', 'Middleware', 'middlewares', True)],
+}
+DASHBOARD_CHART: Final[str] = 'rancher'
+
+ObjectKey = Tuple[str, str, str, str]
+
+
+class FakeKubernetesApi:
+    # Watches are cut short like a real apiserver does, clients relist and continue
+    WATCH_MAX_SECONDS: Final[float] = 5
+    WATCH_POLL_INTERVAL_IN_SECONDS: Final[float] = 0.02
+
+    def __init__(self, delays: ReadinessDelays = ReadinessDelays(), host: str = '127.0.0.1', port: int = 0):
+        self._delays = delays
+        self._lock = threading.RLock()
+        self._resource_versions = itertools.count(1)
+        self._types: Dict[Tuple[str, str], ResourceType] = {(t.group, t.plural): t for t in BUILTIN_RESOURCES}
+        self._objects: Dict[ObjectKey, Dict[str, Any]] = {}
+        self._created_at_version: Dict[ObjectKey, int] = {}
+        self._compacted_version = 0
+        self._pending: List[Tuple[float, Callable[[], None]]] = []
+        self._api_calls: Counter = Counter()
+        self._booted_at = time.monotonic()
+        self._dashboard_ready_at: Optional[float] = None
+        self._server = ThreadingHTTPServer((host, port), _FakeKubernetesHandler)
+        self._server.daemon_threads = True
+        self._server.api = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_calls(self) -> Counter:
+        with self._lock:
+            return Counter(self._api_calls)
+
+    def start(self) -> 'FakeKubernetesApi':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-kubernetes', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def boot(self):
+        # Readiness of node-level components (metrics-server) counts from when k3s was "installed"
+        with self._lock:
+            self._booted_at = time.monotonic()
+
+    def write_kubeconfig(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(yaml.safe_dump({
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'simulation', 'cluster': {'server': self.url}}],
+            'users': [{'name': 'simulation', 'user': {'token': 'simulation'}}],
+            'contexts': [{'name': 'simulation', 'context': {'cluster': 'simulation', 'user': 'simulation'}}],
+            'current-context': 'simulation',
+        }))
+
+    def dashboard_ready(self) -> bool:
+        with self._lock:
+            return self._dashboard_ready_at is not None and time.monotonic() >= self._dashboard_ready_at
+
+    def compact(self):
+        # Like etcd compaction: watches from any resource version handed out so far answer 410 Gone
+        with self._lock:
+            self._compacted_version = next(self._resource_versions)
+
+    def _schedule(self, delay: float, action: Callable[[], None]):
+        self._pending.append((time.monotonic() + delay, action))
+
+    def _advance(self):
+        now = time.monotonic()
+        due = [action for at, action in self._pending if at <= now]
+        if due:
+            self._pending = [(at, action) for at, action in self._pending if at > now]
+            for action in due:
+                action()
+
+    def _store(self, key: ObjectKey, obj: Dict[str, Any]) -> Dict[str, Any]:
+        version = next(self._resource_versions)
+        obj['metadata']['resourceVersion'] = str(version)
+        self._created_at_version.setdefault(key, version)
+        self._objects[key] = obj
+        return obj
+
+    def _update_status(self, key: ObjectKey, status: Dict[str, Any]):
+        obj = self._objects.get(key)
+        if obj is not None:
+            obj['status'] = status
+            self._store(key, obj)
+
+    def _upsert(self, resource: ResourceType, namespace: str, name: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        key = (resource.group, resource.plural, namespace, name)
+        existing = self._objects.get(key)
+        metadata = dict(body.get('metadata') or {})
+        metadata['name'] = name
+        if resource.namespaced:
+            metadata['namespace'] = namespace
+        generation = 1
+        if existing is not None:
+            metadata['uid'] = existing['metadata']['uid']
+            generation = existing['metadata']['generation'] + (existing.get('spec') != body.get('spec'))
+        else:
+            metadata['uid'] = str(uuid.uuid4())
+        metadata['generation'] = generation
+        obj = {**body, 'apiVersion': resource.api_version, 'kind': resource.kind, 'metadata': metadata}
+        if existing is not None and 'status' in existing:
+            obj['status'] = existing['status']
+        self._store(key, obj)
+        self._react(resource, key, obj)
+        return obj
+
+    def _react(self, resource: ResourceType, key: ObjectKey, obj: Dict[str, Any]):
+        # Stand-ins for the controllers that would act on a real cluster
+        generation = obj['metadata']['generation']
+        spec = obj.get('spec') or {}
+        if resource.kind == 'CustomResourceDefinition':
+            self._schedule(self._delays.crd_established, lambda: self._establish(key))
+        elif resource.kind == 'Deployment':
+            replicas = spec.get('replicas', 1)
+            self._schedule(self._delays.deployment_rollout, lambda: self._update_status(key, {
+                'observedGeneration': generation, 'replicas': replicas, 'updatedReplicas': replicas,
+                'readyReplicas': replicas, 'availableReplicas': replicas}))
+        elif resource.kind == 'DaemonSet':
+            self._schedule(self._delays.daemon_set_rollout, lambda: self._update_status(key, {
+                'observedGeneration': generation, 'currentNumberScheduled': 1, 'desiredNumberScheduled': 1,
+                'numberMisscheduled': 0, 'numberReady': 1, 'updatedNumberScheduled': 1, 'numberAvailable': 1}))
+        elif resource.kind == 'Service' and spec.get('selector'):
+            self._schedule(self._delays.service_endpoints, lambda: self._create_endpoints(key[2], key[3]))
+        elif resource.kind == 'HelmChart':
+            self._start_helm_job(key[2], key[3])
+
+    def _establish(self, key: ObjectKey):
+        crd = self._objects.get(key)
+        if crd is None:
+            return
+        spec = crd['spec']
+        for version in spec.get('versions', []):
+            self._register(ResourceType(spec['group'], version['name'], spec['names']['kind'],
+                                        spec['names']['plural'], spec.get('scope') == 'Namespaced'))
+        self._update_status(key, {
+            'conditions': [{'type': 'Established', 'status': 'True'}, {'type': 'NamesAccepted', 'status': 'True'}],
+            'acceptedNames': {'kind': spec['names']['kind'], 'plural': spec['names']['plural']},
+            'storedVersions': [version['name'] for version in spec.get('versions', []) if version.get('storage')]})
+
+    def _register(self, resource: ResourceType):
+        self._types.setdefault((resource.group, resource.plural), resource)
+
+    def _create_endpoints(self, namespace: str, name: str):
+        self._store(('', 'endpoints', namespace, name), {
+            'apiVersion': 'v1', 'kind': 'Endpoints',
+            'metadata': {'name': name, 'namespace': namespace, 'uid': str(uuid.uuid4()), 'generation': 1},
+            'subsets': [{'addresses': [{'ip': '10.42.0.10'}]}]})
+
+    def _start_helm_job(self, namespace: str, chart: str):
+        key = ('batch', 'jobs', namespace, f'helm-install-{chart}')
+        self._store(key, {
+            'apiVersion': 'batch/v1', 'kind': 'Job',
+            'metadata': {'name': key[3], 'namespace': namespace, 'uid': str(uuid.uuid4()), 'generation': 1},
+            'spec': {'template': {'spec': {'containers': [{'name': 'helm'}], 'restartPolicy': 'OnFailure'}}},
+            'status': {'active': 1}})
+
+        def complete():
+            for resource in HELM_CHART_CRDS.get(chart, []):
+                self._register(resource)
+                self._store(('apiextensions.k8s.io', 'customresourcedefinitions', '',
+                             f'{resource.plural}.{resource.group}'), {
+                    'apiVersion': 'apiextensions.k8s.io/v1', 'kind': 'CustomResourceDefinition',
+                    'metadata': {'name': f'{resource.plural}.{resource.group}', 'uid': str(uuid.uuid4()),
+                                 'generation': 1},
+                    'spec': {'group': resource.group, 'scope': 'Namespaced' if resource.namespaced else 'Cluster',
+                             'names': {'kind': resource.kind, 'plural': resource.plural},
+                             'versions': [{'name': resource.version, 'served': True, 'storage': True}]},
+                    'status': {'conditions': [{'type': 'Established', 'status': 'True'}],
+                               'acceptedNames': {'kind': resource.kind, 'plural': resource.plural},
+                               'storedVersions': [resource.version]}})
+            if chart == DASHBOARD_CHART:
+                self._dashboard_ready_at = time.monotonic() + self._delays.dashboard
+            self._update_status(key, {'succeeded': 1, 'conditions': [{'type': 'Complete', 'status': 'True'}]})
+        self._schedule(self._delays.helm_chart_job, complete)
+
+    @staticmethod
+    def _status(code: int, reason: str, message: str) -> Tuple[int, Dict[str, Any]]:
+        return code, {'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Failure',
+                      'reason': reason, 'message': message, 'code': code}
+
+    def _discovery(self, path: str) -> Optional[Dict[str, Any]]:
+        types = list(self._types.values())
+        if path == '/version':
+            return {'major': '1', 'minor': '27', 'gitVersion': 'v1.27.9+k3s1', 'platform': 'linux/amd64'}
+        if path == '/api':
+            return {'kind': 'APIVersions', 'versions': ['v1']}
+        if path == '/apis':
+            groups: Dict[str, List[str]] = {}
+            for resource in types:
+                if resource.group and resource.version not in groups.setdefault(resource.group, []):
+                    groups[resource.group].append(resource.version)
+            return {'kind': 'APIGroupList', 'apiVersion': 'v1', 'groups': [{
+                'name': group,
+                'versions': [{'groupVersion': f'{group}/{version}', 'version': version} for version in versions],
+                'preferredVersion': {'groupVersion': f'{group}/{versions[0]}', 'version': versions[0]},
+            } for group, versions in groups.items()]}
+
+        parts = path.strip('/').split('/')
+        if parts == ['api', 'v1']:
+            group, version = '', 'v1'
+        elif len(parts) == 3 and parts[0] == 'apis':
+            group, version = parts[1], parts[2]
+        else:
+            return None
+        return {'kind': 'APIResourceList', 'apiVersion': 'v1',
+                'groupVersion': f'{group}/{version}' if group else version,
+                'resources': [{'name': resource.plural, 'singularName': resource.kind.lower(),
+                               'namespaced': resource.namespaced, 'kind': resource.kind,
+                               'verbs': ['create', 'delete', 'get', 'list', 'patch', 'update', 'watch']}
+                              for resource in types if resource.group == group and resource.version == version]}
+
+    def _route(self, path: str) -> Optional[Tuple[ResourceType, str, Optional[str]]]:
+        parts = path.strip('/').split('/')
+        if parts[0] == 'api' and len(parts) >= 3:
+            group, rest = '', parts[2:]
+        elif parts[0] == 'apis' and len(parts) >= 4:
+            group, rest = parts[1], parts[3:]
+        else:
+            return None
+        namespace = ''
+        if rest[0] == 'namespaces' and len(rest) >= 3:
+            namespace, rest = rest[1], rest[2:]
+        resource = self._types.get((group, rest[0]))
+        if resource is None:
+            return None
+        return resource, namespace, rest[1] if len(rest) > 1 else None
+
+    def _matching(self, resource: ResourceType, namespace: str,
+                  field_selector: Optional[str]) -> List[Tuple[ObjectKey, Dict[str, Any]]]:
+        name = None
+        if field_selector and field_selector.startswith('metadata.name='):
+            name = field_selector.split('=', 1)[1]
+        return [(key, obj) for key, obj in self._objects.items()
+                if key[:2] == (resource.group, resource.plural) and (not namespace or key[2] == namespace) and
+                (name is None or key[3] == name)]
+
+    def handle(self, method: str, raw_path: str, body: bytes) -> Tuple[int, Any]:
+        parsed = urllib.parse.urlparse(raw_path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(parsed.query).items()}
+        path = parsed.path.rstrip('/') or '/'
+        with self._lock:
+            self._advance()
+            discovery = self._discovery(path) if method == 'GET' else None
+            if discovery is not None:
+                self._api_calls['discovery'] += 1
+                return 200, discovery
+
+            if path == '/apis/metrics.k8s.io/v1beta1/pods':
+                self._api_calls['GET metrics'] += 1
+                if time.monotonic() < self._booted_at + self._delays.metrics_server:
+                    return FakeKubernetesApi._status(503, 'ServiceUnavailable', 'metrics not available yet')
+                return 200, {'kind': 'PodMetricsList', 'apiVersion': 'metrics.k8s.io/v1beta1', 'metadata': {},
+                             'items': []}
+
+            route = self._route(path)
+            if route is None:
+                self._api_calls[f'{method} unknown'] += 1
+                return FakeKubernetesApi._status(404, 'NotFound', f'the server could not find {path}')
+            resource, namespace, name = route
+            watching = method == 'GET' and name is None and query.get('watch') in ('true', '1')
+            self._api_calls[f'{"WATCH" if watching else method} {resource.plural}'] += 1
+
+            if method == 'GET' and name is None:
+                if watching:
+                    if int(query.get('resourceVersion') or 0) < self._compacted_version:
+                        return FakeKubernetesApi._status(410, 'Expired', 'too old resource version')
+                    return 200, self._watch(resource, namespace, query)
+                items = [obj for _, obj in self._matching(resource, namespace, query.get('fieldSelector'))]
+                return 200, {'kind': f'{resource.kind}List', 'apiVersion': resource.api_version,
+                             'metadata': {'resourceVersion': str(next(self._resource_versions))}, 'items': items}
+
+            payload = json.loads(body) if body else {}
+            if method == 'POST':
+                name = (payload.get('metadata') or {}).get('name')
+                if (resource.group, resource.plural, namespace, name) in self._objects:
+                    return FakeKubernetesApi._status(409, 'AlreadyExists', f'{resource.plural} "{name}" already exists')
+                return 201, self._upsert(resource, namespace, name, payload)
+
+            key = (resource.group, resource.plural, namespace, name)
+            if method == 'GET':
+                if key not in self._objects:
+                    return FakeKubernetesApi._status(404, 'NotFound', f'{resource.plural} "{name}" not found')
+                return 200, self._objects[key]
+            if method in ('PUT', 'PATCH'):
+                return 200, self._upsert(resource, namespace, name, payload)
+            if method == 'DELETE':
+                self._objects.pop(key, None)
+                return 200, FakeKubernetesApi._status(200, 'Deleted', name)[1]
+            return FakeKubernetesApi._status(405, 'MethodNotAllowed', method)
+
+    def _watch(self, resource: ResourceType, namespace: str, query: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+        since = int(query.get('resourceVersion') or 0)
+        deadline = time.monotonic() + min(float(query.get('timeoutSeconds') or FakeKubernetesApi.WATCH_MAX_SECONDS),
+                                          FakeKubernetesApi.WATCH_MAX_SECONDS)
+        while time.monotonic() < deadline:
+            with self._lock:
+                self._advance()
+                changed = sorted(((int(obj['metadata']['resourceVersion']), key, obj)
+                                  for key, obj in self._matching(resource, namespace, query.get('fieldSelector'))
+                                  if int(obj['metadata']['resourceVersion']) > since), key=lambda item: item[0])
+                events = [{'type': 'ADDED' if self._created_at_version[key] > since else 'MODIFIED',
+                           'object': json.loads(json.dumps(obj))} for _, key, obj in changed]
+            for event in events:
+                yield event
+            if changed:
+                since = changed[-1][0]
+            time.sleep(FakeKubernetesApi.WATCH_POLL_INTERVAL_IN_SECONDS)
+
+
+class _FakeKubernetesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        status, payload = self.server.api.handle(self.command, self.path, self.rfile.read(length) if length else b'')
+        if isinstance(payload, dict):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for event in payload:
+                data = json.dumps(event).encode('utf-8') + b'\n'
+                self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
@@ -0,0 +1,129 @@
+import argparse
+import json
+import logging
+import statistics
+import time
+from collections import Counter
+from dataclasses import dataclass, asdict, field
+from typing import Final, Any, Callable, Dict, List
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.benchmarks.simulation import Simulation, SimulationProfile
+from cluster_server_installer.orchestration.install_graph import InstallGraph
+from cluster_server_installer.utilities.tracing import tracer
+
+# Spans that mean the installer is waiting on something outside itself rather than doing work
+WAIT_CATEGORIES: Final[frozenset] = frozenset({'probe', 'readiness'})
+
+
+@dataclass(frozen=True)
+class BenchmarkRun:
+    scenario: str
+    wall_seconds: float
+    cpu_seconds: float
+    idle_seconds: float
+    simulated_command_seconds: float
+    waiting_seconds: float
+    subprocess_spawns: int
+    api_calls: int
+    spawns_by_command: Dict[str, int] = field(default_factory=dict)
+    api_calls_by_kind: Dict[str, int] = field(default_factory=dict)
+    slowest_steps: Dict[str, float] = field(default_factory=dict)
+
+
+def _measure(simulation: Simulation, scenario: str, action: Callable[[], Any]) -> BenchmarkRun:
+    spawns_before = simulation.runner.spawns
+    api_before = simulation.api.api_calls + simulation.http_calls
+    spans_before = len(tracer().spans)
+    simulated_before = simulation.runner.simulated_seconds
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    action()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    spans = tracer().spans[spans_before:]
+    spawns = simulation.runner.spawns - spawns_before
+    api_calls = (simulation.api.api_calls + simulation.http_calls) - api_before
+    steps = sorted(((span.name, span.duration) for span in spans if span.category == 'install-step'),
+                   key=lambda step: -step[1])
+    return BenchmarkRun(
+        scenario=scenario, wall_seconds=wall, cpu_seconds=cpu, idle_seconds=max(0.0, wall - cpu),
+        simulated_command_seconds=simulation.runner.simulated_seconds - simulated_before,
+        waiting_seconds=sum(span.duration for span in spans if span.category in WAIT_CATEGORIES),
+        subprocess_spawns=sum(spawns.values()), api_calls=sum(api_calls.values()),
+        spawns_by_command=dict(spawns.most_common()), api_calls_by_kind=dict(api_calls.most_common()),
+        slowest_steps={name: round(duration, 3) for name, duration in steps[:8]})
+
+
+def _reconcile(simulation: Simulation):
+    if not simulation.reconcile():
+        raise RuntimeError('Reconcile failed')
+
+
+def run_benchmark(runs: int, time_scale: float, max_workers: int, resume: bool,
+                  reconcile: bool = False, score_transport: str = 'tcp') -> List[BenchmarkRun]:
+    profile = SimulationProfile().scaled(time_scale)
+    results = []
+    for _ in range(runs):
+        with Simulation(profile) as simulation:
+            results.append(_measure(simulation, 'fresh', simulation.build_graph(max_workers, score_transport).run))
+            if resume:
+                results.append(_measure(simulation, 'resume', simulation.build_graph(max_workers, score_transport).run))
+            if reconcile:
+                results.append(_measure(simulation, 'reconcile', lambda: _reconcile(simulation)))
+    return results
+
+
+def format_report(results: List[BenchmarkRun]) -> str:
+    lines = []
+    for scenario in dict.fromkeys(result.scenario for result in results):
+        runs = [result for result in results if result.scenario == scenario]
+
+        def column(name: str) -> str:
+            values = [getattr(run, name) for run in runs]
+            return f'{statistics.median(values):9.2f} (min {min(values):.2f}, max {max(values):.2f})'
+
+        lines.append(f'{scenario}, {len(runs)} run(s), median:')
+        lines.append(f'  wall time            {column("wall_seconds")} s')
+        lines.append(f'  cpu (work)           {column("cpu_seconds")} s')
+        lines.append(f'  idle (sleep/wait)    {column("idle_seconds")} s')
+        lines.append(f'  probe/readiness wait {column("waiting_seconds")} s')
+        lines.append(f'  simulated commands   {column("simulated_command_seconds")} s')
+        lines.append(f'  subprocess spawns    {column("subprocess_spawns")}')
+        lines.append(f'  api calls            {column("api_calls")}')
+        spawns = sum((Counter(run.spawns_by_command) for run in runs), Counter())
+        api_calls = sum((Counter(run.api_calls_by_kind) for run in runs), Counter())
+        lines.append(f'  spawns by command:   {", ".join(f"{k}={v / len(runs):g}" for k, v in spawns.most_common())}')
+        lines.append(f'  top api calls:       '
+                     f'{", ".join(f"{k}={v / len(runs):g}" for k, v in api_calls.most_common(8))}')
+        lines.append(f'  slowest steps:       '
+                     f'{", ".join(f"{k}={v:.2f}s" for k, v in runs[-1].slowest_steps.items())}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the full install pipeline against simulated host, '
+                                                 'cluster and network backends')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--time-scale', type=float, default=0.1,
+                        help='Multiplier applied to simulated command latencies and readiness delays')
+    parser.add_argument('--max-workers', type=int, default=InstallGraph.DEFAULT_MAX_WORKERS)
+    parser.add_argument('--resume', action='store_true', help='Also measure a journal-resumed re-run')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Also measure a reconcile of the installed cluster against the bundled manifests')
+    parser.add_argument('--score-transport', choices=['tcp', 'uds'], default='tcp',
+                        help='Transport of the simulated ciy-scheduler score server')
+    parser.add_argument('--json', action='store_true', help='Print the raw per-run results as JSON')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    logging.getLogger(LOGGER_NAME).setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    benchmark_results = run_benchmark(args.runs, args.time_scale, args.max_workers, args.resume,
+                                      args.reconcile, args.score_transport)
+    if args.json:
+        print(json.dumps([asdict(result) for result in benchmark_results], indent=2))
+    else:
+        print(format_report(benchmark_results))
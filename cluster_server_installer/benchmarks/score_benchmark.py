@@ -0,0 +1,99 @@
+import argparse
+import http.client
+import json
+import statistics
+import time
+from dataclasses import dataclass, asdict
+from typing import Final, List, Mapping
+
+from cluster_server_installer.utilities.probes import http_connection
+
+WARMUP_REQUESTS: Final[int] = 20
+REQUEST_TIMEOUT_IN_SECONDS: Final[float] = 2
+
+
+@dataclass(frozen=True)
+class TransportRun:
+    transport: str
+    endpoint: str
+    requests: int
+    errors: int
+    connect_ms: float
+    p50_ms: float
+    p99_ms: float
+    mean_ms: float
+
+
+def benchmark_endpoint(transport: str, endpoint: str, requests: int, path: str = '/') -> TransportRun:
+    # One kept-alive connection, the way the scheduler's client reuses it. Opening it is measured on its own
+    connection = http_connection(endpoint, REQUEST_TIMEOUT_IN_SECONDS)
+    start = time.perf_counter()
+    try:
+        connection.connect()
+    except OSError:
+        connection.close()
+        return TransportRun(transport, endpoint, requests, requests, 0.0, 0.0, 0.0, 0.0)
+    connect_ms = (time.perf_counter() - start) * 1000
+
+    latencies = []
+    errors = 0
+    try:
+        for index in range(WARMUP_REQUESTS + requests):
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                connection.getresponse().read()
+            except (OSError, http.client.HTTPException):
+                # http.client reconnects on the next request
+                errors += index >= WARMUP_REQUESTS
+                connection.close()
+                continue
+            if index >= WARMUP_REQUESTS:
+                latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        connection.close()
+    if not latencies:
+        return TransportRun(transport, endpoint, requests, errors, connect_ms, 0.0, 0.0, 0.0)
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return TransportRun(transport, endpoint, requests, errors, connect_ms, percentiles[49], percentiles[98],
+                        statistics.fmean(latencies))
+
+
+def run_benchmark(endpoints: Mapping[str, str], requests: int, path: str = '/') -> List[TransportRun]:
+    # endpoints: transport name -> 'host:port' or 'unix:///path/to.sock', measured one after the other
+    return [benchmark_endpoint(transport, endpoint, requests, path) for transport, endpoint in endpoints.items()]
+
+
+def format_report(results: List[TransportRun]) -> str:
+    lines = [f'{"transport":<11}{"requests":>10}{"errors":>8}{"connect ms":>12}{"p50 ms":>10}{"p99 ms":>10}'
+             f'{"mean ms":>10}']
+    for result in results:
+        lines.append(f'{result.transport:<11}{result.requests:>10}{result.errors:>8}{result.connect_ms:>12.3f}'
+                     f'{result.p50_ms:>10.3f}{result.p99_ms:>10.3f}{result.mean_ms:>10.3f}')
+    answered = {result.transport: result for result in results if result.errors < result.requests}
+    if 'tcp' in answered and 'uds' in answered and answered['uds'].p50_ms > 0:
+        lines.append(f'tcp p50 is {answered["tcp"].p50_ms / answered["uds"].p50_ms:.2f}x the uds p50')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from cluster_server_installer.k8s.ciy_scheduler_installer import CiySchedulerInstaller
+
+    parser = argparse.ArgumentParser(description='Measures ciy-scheduler score request latency over TCP and the '
+                                                 'unix domain socket')
+    parser.add_argument('--tcp', default=CiySchedulerInstaller.score_endpoints('tcp')['tcp'], metavar='HOST:PORT')
+    parser.add_argument('--uds', default=str(CiySchedulerInstaller.SCORE_SOCKET_PATH), metavar='PATH',
+                        help='Socket path, an empty value measures TCP only')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--path', default=CiySchedulerInstaller.SCORE_PROBE_PATH)
+    parser.add_argument('--json', action='store_true', help='Print the raw results as JSON')
+    args = parser.parse_args()
+
+    benchmark_endpoints = {'tcp': args.tcp}
+    if args.uds:
+        benchmark_endpoints['uds'] = f'unix://{args.uds}'
+    benchmark_results = run_benchmark(benchmark_endpoints, args.requests, args.path)
+    if args.json:
+        print(json.dumps([asdict(result) for result in benchmark_results], indent=2))
+    else:
+        print(format_report(benchmark_results))
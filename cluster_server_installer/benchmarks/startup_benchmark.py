@@ -0,0 +1,94 @@
+import argparse
+import json
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict, field
+from typing import Final, Dict, List, Optional, Sequence
+
+# Placeholder arguments each subcommand parses. With --startup-probe the command exits once its imports are done,
+# before any of them is used
+COMMAND_ARGUMENTS: Final[Dict[str, List[str]]] = {
+    'install': ['example.com', 'ops@example.com', 'registry.example.com', 'key', 'godaddy-key', 'godaddy-secret'],
+    'create-bundle': ['bundle', 'key'],
+    'fleet': ['inventory.json'],
+    'k3s-profile': [],
+    'renew-certs': [],
+    'reconcile': ['example.com', 'ops@example.com'],
+    'selftest': [],
+}
+HEAVY_MODULES: Final[Sequence[str]] = ('kubernetes', 'requests', 'urllib3', 'yaml', 'crontab')
+
+
+@dataclass(frozen=True)
+class StartupRun:
+    command: str
+    wall_seconds: float
+    import_seconds: float
+    modules: int
+    heavy_modules: List[str] = field(default_factory=list)
+
+
+def _parse_import_times(stderr: str) -> Dict[str, int]:
+    # -X importtime lines: "import time:  self [us] |  cumulative | imported package"
+    self_times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        self_times[name.strip()] = int(self_us)
+    return self_times
+
+
+def _measure(command: str, argv: List[str]) -> StartupRun:
+    start = time.perf_counter()
+    completed = subprocess.run(argv, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    self_times = _parse_import_times(completed.stderr)
+    return StartupRun(command=command, wall_seconds=wall, import_seconds=sum(self_times.values()) / 1e6,
+                      modules=len(self_times),
+                      heavy_modules=[name for name in HEAVY_MODULES if name in self_times])
+
+
+def run_benchmark(runs: int, commands: Sequence[str], binary: Optional[pathlib.Path]) -> List[StartupRun]:
+    results = []
+    for _ in range(runs):
+        for command in commands:
+            # Argument parsing, dispatch and everything the chosen command pulls in, in a fresh process each time
+            probe_arguments = ['--startup-probe', command, *COMMAND_ARGUMENTS[command]]
+            if binary is not None:
+                results.append(_measure(command, [str(binary), *probe_arguments]))
+                continue
+            results.append(_measure(command, [sys.executable, '-X', 'importtime', '-m', 'cluster_server_installer.main',
+                                              *probe_arguments]))
+    return results
+
+
+def format_report(results: List[StartupRun]) -> str:
+    lines = [f'{"command":<15}{"wall (s)":>10}{"imports (s)":>13}{"modules":>9}  heavy modules loaded']
+    for command in dict.fromkeys(result.command for result in results):
+        runs = [result for result in results if result.command == command]
+        lines.append(f'{command:<15}{statistics.median(run.wall_seconds for run in runs):>10.3f}'
+                     f'{statistics.median(run.import_seconds for run in runs):>13.3f}'
+                     f'{statistics.median(run.modules for run in runs):>9.0f}  '
+                     f'{", ".join(runs[-1].heavy_modules) or "-"}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures how long each subcommand takes to start')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--command', action='append', choices=sorted(COMMAND_ARGUMENTS),
+                        help='Command to measure, may be repeated (default: all)')
+    parser.add_argument('--binary', type=pathlib.Path, default=None,
+                        help='Time the commands of a built installer instead of the source tree')
+    parser.add_argument('--json', action='store_true', help='Print the raw per-run results as JSON')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmark(args.runs, args.command or list(COMMAND_ARGUMENTS), args.binary)
+    if args.json:
+        print(json.dumps([asdict(result) for result in benchmark_results], indent=2))
+    else:
+        print(format_report(benchmark_results))
@@ -0,0 +1,136 @@
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from typing import Final, Iterator, List, Mapping, Optional, Sequence
+
+from cluster_server_installer.utilities.command_runner import command_runner
+
+MIB: Final[int] = 1024 * 1024
+FSYNC_BLOCK_SIZE: Final[int] = 4096
+
+
+@dataclass(frozen=True)
+class StorageRun:
+    target: str
+    path: str
+    mounted: bool
+    write_mib_per_second: float
+    read_mib_per_second: float
+    fsync_p50_ms: float
+    fsync_p99_ms: float
+
+
+@contextlib.contextmanager
+def nfs_mount(export: pathlib.Path, mount_options: Sequence[str]) -> Iterator[Optional[pathlib.Path]]:
+    # Loops the export back through the NFS client with the provisioner's mount options, so sync/async and the
+    # transfer sizes are part of the measurement. None when the mount is not possible (e.g. no NFS client)
+    with tempfile.TemporaryDirectory(prefix='ciy-storage-benchmark-') as mount_point:
+        mounted = command_runner().run(['mount', '-t', 'nfs', '-o', ','.join(mount_options),
+                                        f'127.0.0.1:{export}', mount_point], timeout_in_seconds=30).succeeded
+        try:
+            yield pathlib.Path(mount_point) if mounted else None
+        finally:
+            if mounted:
+                command_runner().run(['umount', mount_point], timeout_in_seconds=30)
+
+
+def _sequential_write(path: pathlib.Path, size_mib: int) -> float:
+    block = os.urandom(MIB)
+    start = time.perf_counter()
+    with path.open('wb', buffering=0) as output:
+        for _ in range(size_mib):
+            output.write(block)
+        os.fsync(output.fileno())
+    return size_mib / (time.perf_counter() - start)
+
+
+def _sequential_read(path: pathlib.Path, size_mib: int) -> float:
+    with path.open('rb', buffering=0) as source:
+        # Reads from the page cache would only measure memory bandwidth
+        os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        start = time.perf_counter()
+        while source.read(MIB):
+            pass
+    return size_mib / (time.perf_counter() - start)
+
+
+def _fsync_latencies_ms(path: pathlib.Path, count: int) -> List[float]:
+    # The commit pattern of a database: a small append, then wait for it to be durable
+    block = os.urandom(FSYNC_BLOCK_SIZE)
+    samples = []
+    with path.open('ab', buffering=0) as output:
+        for _ in range(count):
+            output.write(block)
+            start = time.perf_counter()
+            os.fsync(output.fileno())
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def benchmark_directory(target: str, directory: pathlib.Path, size_mib: int, fsyncs: int,
+                        mounted: bool = False) -> StorageRun:
+    data_path = directory / f'.storage-benchmark-{os.getpid()}'
+    fsync_path = directory / f'.storage-benchmark-{os.getpid()}-fsync'
+    try:
+        write_speed = _sequential_write(data_path, size_mib)
+        read_speed = _sequential_read(data_path, size_mib)
+        latencies = _fsync_latencies_ms(fsync_path, fsyncs)
+    finally:
+        data_path.unlink(missing_ok=True)
+        fsync_path.unlink(missing_ok=True)
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return StorageRun(target, str(directory), mounted, write_speed, read_speed, percentiles[49], percentiles[98])
+
+
+def run_benchmark(targets: Mapping[str, pathlib.Path], size_mib: int, fsyncs: int,
+                  mount_options: Optional[Sequence[str]] = None) -> List[StorageRun]:
+    results = []
+    for target, directory in targets.items():
+        if mount_options is None:
+            results.append(benchmark_directory(target, directory, size_mib, fsyncs))
+            continue
+        with nfs_mount(directory, mount_options) as mount_point:
+            results.append(benchmark_directory(target, mount_point or directory, size_mib, fsyncs,
+                                               mounted=mount_point is not None))
+    return results
+
+
+def format_report(results: List[StorageRun]) -> str:
+    lines = [f'{"target":<14}{"via":>6}{"write MiB/s":>13}{"read MiB/s":>12}{"fsync p50 ms":>14}{"fsync p99 ms":>14}']
+    for result in results:
+        lines.append(f'{result.target:<14}{"nfs" if result.mounted else "local":>6}'
+                     f'{result.write_mib_per_second:>13.1f}{result.read_mib_per_second:>12.1f}'
+                     f'{result.fsync_p50_ms:>14.3f}{result.fsync_p99_ms:>14.3f}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures sequential throughput and fsync latency of the storage '
+                                                 'classes the installer exports')
+    parser.add_argument('--target', dest='targets', action='append', default=[], metavar='NAME=PATH',
+                        help='Directory to measure (default: the NFS exports of this host)')
+    parser.add_argument('--size-mib', type=int, default=256)
+    parser.add_argument('--fsyncs', type=int, default=500)
+    parser.add_argument('--no-mount', action='store_true', help='Measure the export directories without NFS')
+    parser.add_argument('--json', action='store_true', help='Print the raw results as JSON')
+    args = parser.parse_args()
+
+    from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+    storage_profile = K3sInstaller.default_storage_profile()
+    if args.targets:
+        benchmark_targets = {name: pathlib.Path(path) for name, _, path in
+                             (target.partition('=') for target in args.targets)}
+    else:
+        benchmark_targets = {export.storage_class: export.path for export in storage_profile.exports}
+    benchmark_results = run_benchmark(benchmark_targets, args.size_mib, args.fsyncs,
+                                      None if args.no_mount else storage_profile.mount_options)
+    if args.json:
+        print(json.dumps([asdict(result) for result in benchmark_results], indent=2))
+    else:
+        print(format_report(benchmark_results))
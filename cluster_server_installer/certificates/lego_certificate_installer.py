@@ -1,41 +1,146 @@
-import os
+import grp
+import logging
 import pathlib
 import json
 import random
-import crontab
-from typing import Final, Tuple
+import re
+import shutil
+import ssl
+import time
+from dataclasses import dataclass
+from typing import Final, FrozenSet, List, Optional, Sequence, Tuple
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.dns_query import DnsResolver, DnsError
+from cluster_server_installer.utilities.resources import resources
+from cluster_server_installer.utilities.tracing import tracer
+
+
+@dataclass(frozen=True)
+class CertificateInfo:
+    not_after: float
+    names: FrozenSet[str]
+
+    def days_left(self) -> float:
+        return (self.not_after - time.time()) / (24 * 60 * 60)
+
+    def covers(self, domains: Sequence[str]) -> bool:
+        return set(domains) <= self.names
 
 
 class LegoCertificateInstaller:
-    LEGO_FILE_PATH: Final[pathlib.Path] = pathlib.Path(__file__).parent.parent / 'resources' / 'cert_provider' / 'lego'
+    LEGO_RESOURCE: Final[str] = 'cert_provider/lego'
+    # lego runs from a root-owned copy rather than from the (possibly read-only) bundled resources
+    LEGO_INSTALL_PATH: Final[pathlib.Path] = pathlib.Path('/usr/local/lib/ciy-installer/lego')
     DNS_TIMEOUT: Final[int] = 10 * 60
     INSTALLER_DIRECTORY: Final[str] = '/usr/local/bin/ciy-installer'
     CERT_DIR: Final[pathlib.Path] = pathlib.Path('/usr/local/src/certs')
     CERT_ORIGINAL_DIR: Final[pathlib.Path] = pathlib.Path('/usr/local/src/orig_certs')
     CERT_DETAILS_FILE: Final[pathlib.Path] = pathlib.Path('/usr/local/src/orig_certs') / 'renewal_details.json'
     CERT_RETRY_COUNT: Final[int] = 5
+    RETRY_BACKOFF_IN_SECONDS: Final[float] = 60
+    MAX_RETRY_BACKOFF_IN_SECONDS: Final[float] = 15 * 60
+    # Let's Encrypt certificates live 90 days, renewing in the last 30 leaves several daily attempts to spare
+    RENEWAL_WINDOW_IN_DAYS: Final[int] = 30
+    OPENSSL_TIMEOUT_IN_SECONDS: Final[int] = 10
+    # Headscale runs unprivileged, it reads the key through its group
+    CERT_GROUP: Final[str] = 'headscale'
+    # headscale loads its TLS certificate only at start up (SIGHUP rereads the ACL policy alone), so a renewed
+    # certificate means a restart
+    RESTART_SERVICE: Final[str] = 'headscale'
+    # A single order covers every hostname the server exposes, headscale on the bare domain and the cluster ingresses
+    # on these subdomains, so there is one DNS-01 propagation wait instead of one per service
+    SERVICE_SUBDOMAINS: Final[Tuple[str, ...]] = ('dashboard', 'cluster-access')
+    GODADDY_NAMESERVER_SUFFIX: Final[str] = '.domaincontrol.com'
+    # Renewal job goes to root's crontab unless a crontab file is given
+    CRON_TAB_FILE: Final[Optional[pathlib.Path]] = None
+    # lego itself waits up to DNS_TIMEOUT for propagation, leave it room to finish the order afterwards
+    LEGO_TIMEOUT_IN_SECONDS: Final[int] = DNS_TIMEOUT + 5 * 60
 
     def __init__(self, go_daddy_access_key: str, go_daddy_secret_key: str, email: str, domain: str):
-        LegoCertificateInstaller.LEGO_FILE_PATH.chmod(0o777)
+        LegoCertificateInstaller.deploy_lego()
         self._access_key = go_daddy_access_key
         self._secret_key = go_daddy_secret_key
         self._email = email
         self._domain = domain
+        self._logger = logging.getLogger(LOGGER_NAME)
         LegoCertificateInstaller.CERT_DIR.mkdir(parents=True, exist_ok=True)
         LegoCertificateInstaller.CERT_ORIGINAL_DIR.mkdir(parents=True, exist_ok=True)
 
-    def install_certificates(self) -> bool:
-        cert_installed = False
+    @staticmethod
+    def deploy_lego():
+        ArtifactDeployer().deploy_file(resources().path(LegoCertificateInstaller.LEGO_RESOURCE),
+                                       LegoCertificateInstaller.LEGO_INSTALL_PATH)
+
+    @staticmethod
+    def _retry_backoff(attempt: int) -> float:
+        delay = min(LegoCertificateInstaller.MAX_RETRY_BACKOFF_IN_SECONDS,
+                    LegoCertificateInstaller.RETRY_BACKOFF_IN_SECONDS * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
 
-        command = f'GODADDY_API_KEY={self._access_key} \
-        GODADDY_API_SECRET={self._secret_key} \
-        GODADDY_PROPAGATION_TIMEOUT={LegoCertificateInstaller.DNS_TIMEOUT} {LegoCertificateInstaller.LEGO_FILE_PATH} --path {str(LegoCertificateInstaller.CERT_ORIGINAL_DIR.absolute())} --email {self._email} --dns godaddy --domains {self._domain} --accept-tos'
-        for i in range(LegoCertificateInstaller.CERT_RETRY_COUNT):
-            cert_installed = os.system(command + " run") == 0
-            if cert_installed:
-                break
+    @staticmethod
+    def certificate_domains(domain: str) -> List[str]:
+        # lego names the certificate files after the first domain, which stays the bare one headscale is served on
+        return [domain, *(f'{subdomain}.{domain}' for subdomain in LegoCertificateInstaller.SERVICE_SUBDOMAINS)]
 
-        if not cert_installed:
+    @staticmethod
+    def _run_lego(action: str, access_key: str, secret_key: str, email: str, domains: Sequence[str],
+                  action_args: Sequence[str] = ()) -> bool:
+        # The ACME account registered under --path on the first run is reused by every later run and renewal
+        resolvers = LegoCertificateInstaller.challenge_resolvers(domains[0])
+        argv = [LegoCertificateInstaller.LEGO_INSTALL_PATH, '--path', LegoCertificateInstaller.CERT_ORIGINAL_DIR.absolute(),
+                '--email', email, '--dns', 'godaddy', *(arg for domain in domains for arg in ('--domains', domain)),
+                *(arg for resolver in resolvers for arg in ('--dns.resolvers', resolver)),
+                '--accept-tos', action, *action_args]
+        runner = command_runner()
+        with tracer().span(f'lego-{action}', 'certificates', domain=domains[0], names=len(domains)) as span:
+            for i in range(LegoCertificateInstaller.CERT_RETRY_COUNT):
+                span.set(retries=i)
+                result = runner.run(
+                    argv, timeout_in_seconds=LegoCertificateInstaller.LEGO_TIMEOUT_IN_SECONDS,
+                    env={'GODADDY_PROPAGATION_TIMEOUT': str(LegoCertificateInstaller.DNS_TIMEOUT)},
+                    secret_env={'GODADDY_API_KEY': access_key, 'GODADDY_API_SECRET': secret_key})
+                if result.succeeded:
+                    return True
+                if result.cancelled or i == LegoCertificateInstaller.CERT_RETRY_COUNT - 1:
+                    break
+                # Back off instead of hammering the ACME and DNS APIs, most failures here are rate limits or
+                # propagation that needs more time
+                delay = LegoCertificateInstaller._retry_backoff(i)
+                logging.getLogger(LOGGER_NAME).warning(f"lego {action} failed, retrying in {delay:.0f}s")
+                if runner.cancel_event.wait(delay):
+                    break
+            return False
+
+    @staticmethod
+    def challenge_resolvers(domain: str) -> List[str]:
+        # lego checks the challenge record's propagation against the zone's own nameservers, so a record that is
+        # served already is seen without waiting out recursive resolver caches
+        logger = logging.getLogger(LOGGER_NAME)
+        try:
+            zone, nameservers = DnsResolver().zone_nameservers(domain)
+        except DnsError as e:
+            logger.warning(f"Could not look up the nameservers of {domain}, lego uses the system resolvers: {e}")
+            return []
+        # lego publishes the challenge through the GoDaddy API, a zone (partly) served elsewhere may never see it.
+        # Secondary setups can still work, so this only warns
+        if not all(nameserver.endswith(LegoCertificateInstaller.GODADDY_NAMESERVER_SUFFIX)
+                   for nameserver in nameservers):
+            logger.warning(f"{zone} is served by {', '.join(nameservers)}, not only GoDaddy, DNS-01 challenges for "
+                           f"{domain} may not propagate")
+        return [f'{nameserver}:{DnsResolver.DNS_PORT}' for nameserver in nameservers]
+
+    def install_certificates(self) -> bool:
+        domains = LegoCertificateInstaller.certificate_domains(self._domain)
+        # A re-install keeps a still valid certificate rather than spending a new order against the ACME rate limits
+        existing = LegoCertificateInstaller.certificate_info(self._domain)
+        if existing is not None and existing.covers(domains) and \
+                existing.days_left() > LegoCertificateInstaller.RENEWAL_WINDOW_IN_DAYS:
+            self._logger.info(f"Reusing the certificate for {', '.join(domains)}, "
+                              f"valid for {existing.days_left():.0f} more days")
+        elif not LegoCertificateInstaller._run_lego('run', self._access_key, self._secret_key, self._email, domains):
             return False
 
         renewal_details = {
@@ -48,45 +153,103 @@ class LegoCertificateInstaller:
         LegoCertificateInstaller.CERT_DETAILS_FILE.write_text(json.dumps(renewal_details))
         LegoCertificateInstaller.alter_certificate_permissions(self._domain)
 
-        cron = crontab.CronTab(user='root')
-        job = cron.new(command=f'{LegoCertificateInstaller.INSTALLER_DIRECTORY} renew-certs')
-        job.from_line(f'{random.randrange(0, 59)} {random.randrange(0, 23)} 20 * *')
+        # Only the install path touches cron, the monthly renew-certs run does not pay for importing it
+        import crontab
+        cron = crontab.CronTab(user='root') if LegoCertificateInstaller.CRON_TAB_FILE is None else \
+            crontab.CronTab(tabfile=str(LegoCertificateInstaller.CRON_TAB_FILE))
+        command = f'{LegoCertificateInstaller.INSTALLER_DIRECTORY} renew-certs'
+        cron.remove_all(command=command)
+        # Daily, renew-certs returns right away unless the certificate is inside its renewal window
+        job = cron.new(command=command)
+        job.from_line(f'{random.randrange(0, 59)} {random.randrange(0, 23)} * * *')
         cron.write()
 
         return True
 
     def get_certificate_root_path(self) -> Tuple[pathlib.Path, pathlib.Path]:
-        return (LegoCertificateInstaller.CERT_DIR / 'certificates' / f'{self._domain}.crt',
-                LegoCertificateInstaller.CERT_DIR / 'certificates' / f'{self._domain}.key')
+        return LegoCertificateInstaller.certificate_paths(self._domain)
 
     @staticmethod
-    def alter_certificate_permissions(domain_name: str):
-        headscale_cert_path = LegoCertificateInstaller.CERT_DIR / 'certificates' / f'{domain_name}.crt'
-        headscale_key_path = LegoCertificateInstaller.CERT_DIR / 'certificates' / f'{domain_name}.key'
-        headscale_cert_path.parent.mkdir(parents=True, exist_ok=True)
+    def certificate_paths(domain_name: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        return (LegoCertificateInstaller.CERT_DIR / 'certificates' / f'{domain_name}.crt',
+                LegoCertificateInstaller.CERT_DIR / 'certificates' / f'{domain_name}.key')
 
-        headscale_cert_path.write_bytes(
-            (LegoCertificateInstaller.CERT_ORIGINAL_DIR / 'certificates' / f'{domain_name}.crt').read_bytes())
-        headscale_key_path.write_bytes(
-            (LegoCertificateInstaller.CERT_ORIGINAL_DIR / 'certificates' / f'{domain_name}.key').read_bytes())
+    @staticmethod
+    def alter_certificate_permissions(domain_name: str) -> bool:
+        # Each file is swapped in with a rename, so headscale never reads a half written certificate or key
+        deployer = ArtifactDeployer()
+        cert_path, key_path = LegoCertificateInstaller.certificate_paths(domain_name)
+        headscale_cert = deployer.deploy_file(
+            LegoCertificateInstaller.CERT_ORIGINAL_DIR / 'certificates' / f'{domain_name}.crt', cert_path, mode=0o644)
+        headscale_key = deployer.deploy_file(
+            LegoCertificateInstaller.CERT_ORIGINAL_DIR / 'certificates' / f'{domain_name}.key', key_path, mode=0o640)
+        try:
+            grp.getgrnam(LegoCertificateInstaller.CERT_GROUP)
+            shutil.chown(headscale_key.destination, group=LegoCertificateInstaller.CERT_GROUP)
+        except KeyError:
+            headscale_key.destination.chmod(0o644)
+        return headscale_cert.replaced or headscale_key.replaced
 
-        headscale_cert_path.chmod(0o777)
-        headscale_key_path.chmod(0o777)
+    @staticmethod
+    def certificate_info(domain_name: str) -> Optional[CertificateInfo]:
+        certificate = LegoCertificateInstaller.CERT_ORIGINAL_DIR / 'certificates' / f'{domain_name}.crt'
+        if not certificate.exists():
+            return None
+        result = command_runner().run(
+            ['openssl', 'x509', '-noout', '-enddate', '-ext', 'subjectAltName', '-in', certificate],
+            timeout_in_seconds=LegoCertificateInstaller.OPENSSL_TIMEOUT_IN_SECONDS)
+        lines = result.stdout.splitlines()
+        if not result.succeeded or not lines or not lines[0].startswith('notAfter='):
+            return None
+        try:
+            not_after = float(ssl.cert_time_to_seconds(lines[0][len('notAfter='):].strip()))
+        except ValueError:
+            return None
+        return CertificateInfo(not_after, frozenset(re.findall(r'DNS:([^,\s]+)', result.stdout)))
 
     @staticmethod
-    def renew_certificates():
-        cert_renewed = False
+    def restart_certificate_consumers(domain_name: str) -> bool:
+        # Only called when the deployed certificate or key changed
+        logging.getLogger(LOGGER_NAME).warning(
+            f"Planned VPN control plane interruption: restarting {LegoCertificateInstaller.RESTART_SERVICE} to serve "
+            f"the renewed {domain_name} certificate, tailscale clients reconnect once it is back")
+        if not command_runner().run(['systemctl', 'restart', LegoCertificateInstaller.RESTART_SERVICE]).succeeded:
+            return False
+
+        from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+        if not pathlib.Path(K3sInstaller.RELEVANT_CONFIG_FILE).exists():
+            return True
+        return K3sInstaller().apply_tls_secrets(domain_name)
+
+    @staticmethod
+    def renew_certificates(window_in_days: int = RENEWAL_WINDOW_IN_DAYS, force: bool = False) -> bool:
+        logger = logging.getLogger(LOGGER_NAME)
         cert_details = json.loads(LegoCertificateInstaller.CERT_DETAILS_FILE.read_text())
-        command = f'GODADDY_API_KEY={cert_details["GODADDY_API_KEY"]} \
-        GODADDY_API_SECRET={cert_details["GODADDY_API_SECRET"]} \
-        GODADDY_PROPAGATION_TIMEOUT={LegoCertificateInstaller.DNS_TIMEOUT} {LegoCertificateInstaller.LEGO_FILE_PATH} --path {str(LegoCertificateInstaller.CERT_ORIGINAL_DIR.absolute())} --email {cert_details["EMAIL"]} --dns godaddy --domains {cert_details["DOMAIN"]} --accept-tos'
-        for i in range(LegoCertificateInstaller.CERT_RETRY_COUNT):
-            cert_renewed = os.system(command + " renew") == 0
-            if cert_renewed:
-                break
-
-        if not cert_renewed:
+        domain = cert_details['DOMAIN']
+
+        domains = LegoCertificateInstaller.certificate_domains(domain)
+
+        info = LegoCertificateInstaller.certificate_info(domain)
+        if info is not None and info.covers(domains):
+            if not force and info.days_left() > window_in_days:
+                logger.info(f"Certificate for {domain} is valid for {info.days_left():.1f} more days, "
+                            f"renewal window opens {window_in_days} days before expiry")
+                return True
+            logger.info(f"Certificate for {domain} expires in {info.days_left():.1f} days, renewing")
+            # lego skips renewal itself when the certificate is outside --days, forcing means asking for more days
+            # than any certificate can have left
+            action, action_args = 'renew', ['--days', str(365 * 10 if force else window_in_days)]
+        else:
+            # Unreadable, or issued before all service hostnames were included: a new order replaces it
+            logger.warning(f"The {domain} certificate does not cover {', '.join(domains)}, issuing a new one")
+            action, action_args = 'run', []
+
+        LegoCertificateInstaller.deploy_lego()
+        if not LegoCertificateInstaller._run_lego(action, cert_details['GODADDY_API_KEY'],
+                                                  cert_details['GODADDY_API_SECRET'], cert_details['EMAIL'],
+                                                  domains, action_args=action_args):
             return False
 
-        LegoCertificateInstaller.alter_certificate_permissions(cert_details["DOMAIN"])
-        return True
+        if not LegoCertificateInstaller.alter_certificate_permissions(domain):
+            return True
+        return LegoCertificateInstaller.restart_certificate_consumers(domain)
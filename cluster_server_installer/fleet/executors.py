@@ -0,0 +1,167 @@
+import logging
+import math
+import pathlib
+import shlex
+import subprocess
+import threading
+import time
+from typing import Final, Callable, Dict, List, Optional
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.fleet.inventory import FleetHost, override_strings
+
+
+class HostExecutionError(RuntimeError):
+    pass
+
+
+class HostExecutor:
+    def execute(self, host: FleetHost, log_path: pathlib.Path, timeout_in_seconds: float,
+                progress: Callable[[str], None]):
+        raise NotImplementedError()
+
+
+class LocalExecutor(HostExecutor):
+    # Runs the install pipeline in this process, so it can only target the machine the fleet command runs on
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def execute(self, host: FleetHost, log_path: pathlib.Path, timeout_in_seconds: float,
+                progress: Callable[[str], None]):
+        from cluster_server_installer.k8s.k3s_profile import parse_overrides
+        from cluster_server_installer.orchestration.install_graph import InstallGraph
+        from cluster_server_installer.orchestration.install_journal import InstallJournal
+        from cluster_server_installer.orchestration.install_pipeline import build_install_graph
+        from cluster_server_installer.utilities.artifact_cache import ArtifactCache
+
+        if not self._lock.acquire(blocking=False):
+            raise HostExecutionError("The local executor can only install one host at a time")
+        handler = logging.FileHandler(log_path)
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.addHandler(handler)
+        try:
+            progress('installing locally')
+            # The remaining options are build_install_graph keyword arguments as they are
+            options = dict(host.options)
+            journal = InstallJournal()
+            if options.pop('fresh', False):
+                journal.clear()
+            offline_bundle = options.pop('offline_bundle', None)
+            image_archive = options.pop('image_archive', None)
+            build_install_graph(host_url=host.server_url, email=host.email, registry=host.registry,
+                                access_key=host.access_key, go_daddy_access_key=host.godaddy_access_key,
+                                go_daddy_secret=host.godaddy_secret,
+                                max_workers=host.max_workers or InstallGraph.DEFAULT_MAX_WORKERS, journal=journal,
+                                artifact_cache=ArtifactCache(
+                                    offline_bundle=pathlib.Path(offline_bundle) if offline_bundle else None),
+                                image_archive=pathlib.Path(image_archive) if image_archive else None,
+                                k3s_overrides=parse_overrides(override_strings(options.pop('k3s_overrides', []))),
+                                database_overrides=parse_overrides(
+                                    override_strings(options.pop('database_overrides', []))),
+                                **options).run()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+            self._lock.release()
+
+
+class SshExecutor(HostExecutor):
+    REMOTE_BINARY_PATH: Final[str] = '/usr/local/bin/ciy-installer'
+    SSH_OPTIONS: Final[List[str]] = ['-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=accept-new',
+                                     '-o', 'ServerAliveInterval=30']
+    REMOTE_KILL_GRACE_IN_SECONDS: Final[int] = 30
+    REMOTE_KILL_TIMEOUT_IN_SECONDS: Final[float] = 30
+
+    def __init__(self, installer_binary: pathlib.Path):
+        self._installer_binary = installer_binary
+
+    def _ssh_target(self, host: FleetHost) -> str:
+        return f'{host.ssh_user}@{host.address}'
+
+    def _ssh_command(self, host: FleetHost, remote_command: str) -> List[str]:
+        return ['ssh', '-p', str(host.ssh_port), *SshExecutor.SSH_OPTIONS, self._ssh_target(host), remote_command]
+
+    def _run(self, command: List[str], log_file, deadline: float, description: str, stdin_text: Optional[str] = None,
+             on_timeout: Optional[Callable[[], None]] = None):
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL if stdin_text is None else subprocess.PIPE,
+                                   start_new_session=True)
+        if stdin_text is not None:
+            try:
+                process.stdin.write(stdin_text.encode())
+                process.stdin.close()
+            except BrokenPipeError:
+                # ssh exited before reading, its return code tells why
+                pass
+        try:
+            return_code = process.wait(timeout=max(1.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            if on_timeout:
+                on_timeout()
+            raise HostExecutionError(f"{description} timed out")
+        if return_code != 0:
+            raise HostExecutionError(f"{description} exited with {return_code}")
+
+    def _remote_install_command(self, host: FleetHost, timeout_in_seconds: float) -> str:
+        # The secrets arrive on stdin and reach the installer through its environment, never a command line. The
+        # remote timeout ends the install even when the connection to this host is gone
+        variables = list(host.secret_environment())
+        arguments = ' '.join(shlex.quote(argument)
+                             for argument in host.install_arguments(secrets_from_environment=True))
+        return ' && '.join([f'chmod 0755 {SshExecutor.REMOTE_BINARY_PATH}',
+                            *(f'IFS= read -r {variable}' for variable in variables),
+                            f'export {" ".join(variables)}',
+                            f'exec timeout --kill-after={SshExecutor.REMOTE_KILL_GRACE_IN_SECONDS} '
+                            f'{max(1, math.ceil(timeout_in_seconds))} {SshExecutor.REMOTE_BINARY_PATH} {arguments}'])
+
+    def _kill_remote_install(self, host: FleetHost, log_file):
+        # Killing ssh leaves the remote install running, stop it before the host is reported as timed out. The
+        # bracket keeps the pattern from matching the shell pkill runs in
+        pattern = f'[{SshExecutor.REMOTE_BINARY_PATH[0]}]{SshExecutor.REMOTE_BINARY_PATH[1:]} install'
+        try:
+            subprocess.run(self._ssh_command(host, f'pkill -TERM -f {shlex.quote(pattern)}'), stdout=log_file,
+                           stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                           timeout=SshExecutor.REMOTE_KILL_TIMEOUT_IN_SECONDS)
+        except subprocess.TimeoutExpired:
+            logging.getLogger(LOGGER_NAME).warning(f"[{host.name}] could not reach the host to stop the install, it "
+                                                   f"ends by itself once its remote timeout expires")
+
+    def execute(self, host: FleetHost, log_path: pathlib.Path, timeout_in_seconds: float,
+                progress: Callable[[str], None]):
+        deadline = time.monotonic() + timeout_in_seconds
+        with log_path.open('ab') as log_file:
+            progress('uploading installer')
+            self._run(['scp', '-q', '-P', str(host.ssh_port), *SshExecutor.SSH_OPTIONS, str(self._installer_binary),
+                       f'{self._ssh_target(host)}:{SshExecutor.REMOTE_BINARY_PATH}'], log_file, deadline, 'upload')
+            progress('installing')
+            self._run(self._ssh_command(host, self._remote_install_command(host, deadline - time.monotonic())),
+                      log_file, deadline, 'remote install',
+                      stdin_text=''.join(f'{value}\n' for value in host.secret_environment().values()),
+                      on_timeout=lambda: self._kill_remote_install(host, log_file))
+
+
+class FakeExecutor(HostExecutor):
+    # In-process stand-in: each host "installs" by sleeping, and the listed hosts fail
+    def __init__(self, durations: Optional[Dict[str, float]] = None, failures: Optional[Dict[str, str]] = None,
+                 default_duration: float = 0.1):
+        self._durations = durations or {}
+        self._failures = failures or {}
+        self._default_duration = default_duration
+        self.executed: List[str] = []
+        self._lock = threading.Lock()
+
+    def execute(self, host: FleetHost, log_path: pathlib.Path, timeout_in_seconds: float,
+                progress: Callable[[str], None]):
+        with self._lock:
+            self.executed.append(host.name)
+        progress('installing (fake)')
+        duration = self._durations.get(host.name, self._default_duration)
+        if duration > timeout_in_seconds:
+            time.sleep(timeout_in_seconds)
+            raise HostExecutionError("fake install timed out")
+        time.sleep(duration)
+        log_path.write_text(f'fake install of {host.name}\n')
+        if host.name in self._failures:
+            raise HostExecutionError(self._failures[host.name])
@@ -0,0 +1,62 @@
+import logging
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Final, List, Optional
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.fleet.executors import HostExecutor
+from cluster_server_installer.fleet.inventory import FleetHost
+
+
+@dataclass(frozen=True)
+class HostResult:
+    name: str
+    succeeded: bool
+    duration: float
+    log_path: pathlib.Path
+    error: Optional[str] = None
+
+
+class FleetRunner:
+    DEFAULT_CONCURRENCY: Final[int] = 8
+    DEFAULT_HOST_TIMEOUT_IN_SECONDS: Final[int] = 60 * 60
+
+    def __init__(self, executor: HostExecutor, log_dir: pathlib.Path, concurrency: int = DEFAULT_CONCURRENCY,
+                 host_timeout_in_seconds: float = DEFAULT_HOST_TIMEOUT_IN_SECONDS):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._executor = executor
+        self._log_dir = log_dir
+        self._concurrency = concurrency
+        self._host_timeout = host_timeout_in_seconds
+
+    def _install_host(self, host: FleetHost) -> HostResult:
+        log_path = self._log_dir / f'{host.name}.log'
+        start = time.monotonic()
+        try:
+            self._executor.execute(host, log_path, self._host_timeout,
+                                   lambda status: self._logger.info(f"[{host.name}] {status}"))
+        except Exception as e:
+            self._logger.error(f"[{host.name}] failed: {e}")
+            return HostResult(host.name, False, time.monotonic() - start, log_path, str(e))
+        self._logger.info(f"[{host.name}] installed in {time.monotonic() - start:.1f}s")
+        return HostResult(host.name, True, time.monotonic() - start, log_path)
+
+    def run(self, hosts: List[FleetHost]) -> List[HostResult]:
+        self._log_dir.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, min(self._concurrency, len(hosts))),
+                                thread_name_prefix='fleet-host') as executor:
+            return list(executor.map(self._install_host, hosts))
+
+    @staticmethod
+    def summary(results: List[HostResult]) -> str:
+        width = max([len('HOST')] + [len(result.name) for result in results])
+        lines = [f"{'HOST':<{width}}  STATUS  DURATION  DETAILS"]
+        for result in sorted(results, key=lambda result: (result.succeeded, -result.duration)):
+            status = 'ok' if result.succeeded else 'FAILED'
+            details = result.error or str(result.log_path)
+            lines.append(f"{result.name:<{width}}  {status:<6}  {result.duration:>7.1f}s  {details}")
+        succeeded = sum(result.succeeded for result in results)
+        lines.append(f"{succeeded}/{len(results)} hosts installed")
+        return '\n'.join(lines)
@@ -0,0 +1,108 @@
+import json
+import pathlib
+from dataclasses import dataclass, field
+from typing import Final, Any, Dict, List, Optional, Tuple
+
+# A secret install argument given as '-' is read from these variables instead, keeping it out of the process list
+SECRET_FROM_ENVIRONMENT: Final[str] = '-'
+ACCESS_KEY_VARIABLE: Final[str] = 'CIY_ACCESS_KEY'
+GODADDY_SECRET_VARIABLE: Final[str] = 'CIY_GODADDY_SECRET'
+
+# Per host install options, named after the install command's keyword arguments, and the flag each one maps to
+INSTALL_OPTION_FLAGS: Final[Dict[str, str]] = {
+    'headscale_profile': '--headscale-profile',
+    'nic_policy': '--nic-policy',
+    'storage_latency_backend': '--storage-latency-backend',
+    'database_profile': '--database-profile',
+    'score_transport': '--scheduler-score-transport',
+    'score_workers': '--scheduler-score-workers',
+    'offline_bundle': '--offline-bundle',
+    'image_archive': '--image-archive',
+}
+INSTALL_OVERRIDE_FLAGS: Final[Dict[str, str]] = {
+    'k3s_overrides': '--k3s-set',
+    'database_overrides': '--database-set',
+}
+# Switches: (flag, the option value that adds it)
+INSTALL_SWITCH_FLAGS: Final[Dict[str, Tuple[str, bool]]] = {
+    'fresh': ('--fresh', True),
+    'storage_benchmark': ('--skip-storage-benchmark', False),
+    'score_benchmark': ('--score-benchmark', True),
+}
+INSTALL_OPTIONS: Final[frozenset] = frozenset(INSTALL_OPTION_FLAGS) | frozenset(INSTALL_OVERRIDE_FLAGS) | \
+    frozenset(INSTALL_SWITCH_FLAGS)
+
+
+def override_strings(overrides: Any) -> List[str]:
+    # Either a list of KEY=VALUE strings, as on the command line, or a mapping
+    if isinstance(overrides, dict):
+        return [f'{key}={value}' for key, value in overrides.items()]
+    return list(overrides)
+
+
+@dataclass(frozen=True)
+class FleetHost:
+    name: str
+    address: str
+    server_url: str
+    email: str
+    registry: str
+    access_key: str
+    godaddy_access_key: str
+    godaddy_secret: str
+    ssh_user: str = 'root'
+    ssh_port: int = 22
+    max_workers: Optional[int] = None
+    options: Dict[str, Any] = field(default_factory=dict, compare=False, hash=False)
+
+    def install_arguments(self, secrets_from_environment: bool = False) -> List[str]:
+        access_key, godaddy_secret = (SECRET_FROM_ENVIRONMENT, SECRET_FROM_ENVIRONMENT) \
+            if secrets_from_environment else (self.access_key, self.godaddy_secret)
+        arguments = ['install', self.server_url, self.email, self.registry, access_key, self.godaddy_access_key,
+                     godaddy_secret]
+        if self.max_workers is not None:
+            arguments += ['--max-workers', str(self.max_workers)]
+        for name, value in self.options.items():
+            if name in INSTALL_OPTION_FLAGS:
+                arguments += [INSTALL_OPTION_FLAGS[name], str(value)]
+            elif name in INSTALL_OVERRIDE_FLAGS:
+                for override in override_strings(value):
+                    arguments += [INSTALL_OVERRIDE_FLAGS[name], override]
+            elif value == INSTALL_SWITCH_FLAGS[name][1]:
+                arguments.append(INSTALL_SWITCH_FLAGS[name][0])
+        return arguments
+
+    def secret_environment(self) -> Dict[str, str]:
+        return {ACCESS_KEY_VARIABLE: self.access_key, GODADDY_SECRET_VARIABLE: self.godaddy_secret}
+
+
+class Inventory:
+    HOST_FIELDS: Final[frozenset] = frozenset(FleetHost.__dataclass_fields__) - {'options'}
+
+    def __init__(self, hosts: List[FleetHost]):
+        names = [host.name for host in hosts]
+        duplicates = {name for name in names if names.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"Duplicate hosts in inventory: {sorted(duplicates)}")
+        self.hosts = hosts
+
+    @staticmethod
+    def load(path: pathlib.Path) -> 'Inventory':
+        # {"defaults": {...shared parameters...}, "hosts": [{"name": ..., "address": ..., ...overrides...}]}, where
+        # any parameter may also be an install option such as "nic_policy" or "k3s_overrides"
+        contents = json.loads(path.read_text())
+        defaults = contents.get('defaults', {})
+        hosts = []
+        for entry in contents['hosts']:
+            merged = {**defaults, **entry}
+            merged.setdefault('name', merged.get('address'))
+            known = {key: value for key, value in merged.items() if key in Inventory.HOST_FIELDS}
+            options = {key: value for key, value in merged.items() if key in INSTALL_OPTIONS}
+            unknown = merged.keys() - known.keys() - options.keys()
+            if unknown:
+                raise ValueError(f"Inventory host {merged.get('name')} has unknown parameters: {sorted(unknown)}")
+            missing = Inventory.HOST_FIELDS - known.keys() - {'ssh_user', 'ssh_port', 'max_workers'}
+            if missing:
+                raise ValueError(f"Inventory host {merged.get('name')} is missing: {sorted(missing)}")
+            hosts.append(FleetHost(**known, options=options))
+        return Inventory(hosts)
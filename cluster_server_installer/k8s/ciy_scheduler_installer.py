@@ -1,55 +1,212 @@
+import dataclasses
+import io
 import logging
-import os
 import pathlib
-from typing import Final
+from typing import Final, Any, Dict, List, Optional, Tuple
 
 from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.artifact_cache import ArtifactCache, ArtifactSpec
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.host_facts import HostCapacity, host_facts, invalidate_host_facts
+from cluster_server_installer.utilities.probes import default_probe_engine, HttpEndpointProbe, SystemdUnitProbe
+from cluster_server_installer.utilities.tracing import tracer
+
+SCORE_TRANSPORTS: Final[Tuple[str, ...]] = ('tcp', 'uds')
 
 
 class CiySchedulerInstaller:
     ENVIRONMENT_FILE_PATH: Final[pathlib.Path] = pathlib.Path('/etc/ciy-scheduling/env.cfg')
     ENVIRONMENT_FILE_CONTENTS: Final[str] = """KUBECONFIG=/etc/rancher/k3s/k3s.yaml
 CLUSTER_ACCESS_URL=https://cluster-access.{host}
-SCHEDULER_SCORE_SERVER_URL=0.0.0.0:25555
+SCHEDULER_SCORE_SERVER_URL={score_server_url}
     """
+    SCORE_SERVER_PORT: Final[int] = 25555
+    SCORE_SOCKET_PATH: Final[pathlib.Path] = pathlib.Path('/run/ciy-scheduler/score.sock')
+    SCORE_PROBE_PATH: Final[str] = '/'
+    SOCKET_UNIT_PATH: Final[pathlib.Path] = pathlib.Path('/etc/systemd/system/ciy-scheduler.socket')
+    SERVICE_DROP_IN_PATH: Final[pathlib.Path] = \
+        pathlib.Path('/etc/systemd/system/ciy-scheduler.service.d/ciy-installer.conf')
+    # systemd owns both listeners and hands them to the service (LISTEN_FDS). The descheduler runs in the pod
+    # network and keeps reaching the score server over TCP
+    SOCKET_UNIT_CONTENTS: Final[str] = """[Unit]
+Description=ciy-scheduler score endpoint
+
+[Socket]
+ListenStream={socket_path}
+SocketMode=0660
+ListenStream={port}
+FileDescriptorName=score
+Backlog=1024
+Service=ciy-scheduler.service
+
+[Install]
+WantedBy=sockets.target
+"""
+    SERVICE_DROP_IN_CONTENTS: Final[str] = """[Unit]
+Requires=ciy-scheduler.socket
+After=ciy-scheduler.socket
+"""
+    # Half the cores, the other half stays with k3s and the databases on the same host
+    MIN_SCORE_WORKERS: Final[int] = 2
+    MAX_SCORE_WORKERS: Final[int] = 16
+    SCORE_BENCHMARK_REQUESTS: Final[int] = 500
 
     CIY_SCHEDULER_SCALE_VERSION: Final[str] = '1.0.0'
+    SERVICE_STARTUP_TIME_IN_SECONDS: Final[int] = 60
 
-    def __init__(self):
+    def __init__(self, score_transport: str = 'tcp', score_workers: Optional[int] = None):
+        if score_transport not in SCORE_TRANSPORTS:
+            raise ValueError(f"Unknown score transport {score_transport}, expected one of {SCORE_TRANSPORTS}")
         self._logger = logging.getLogger(LOGGER_NAME)
+        self._score_transport = score_transport
+        self._score_workers = score_workers
+
+    @staticmethod
+    def workers_for_host(capacity: HostCapacity) -> int:
+        return max(CiySchedulerInstaller.MIN_SCORE_WORKERS,
+                   min(CiySchedulerInstaller.MAX_SCORE_WORKERS, capacity.cpu_count // 2))
+
+    @property
+    def score_workers(self) -> Optional[int]:
+        # Only set when asked for, or with the unix socket transport. The default install leaves the scheduler's
+        # own concurrency alone
+        if self._score_workers is None and self._score_transport == 'uds':
+            return CiySchedulerInstaller.workers_for_host(host_facts().capacity)
+        return self._score_workers
+
+    @staticmethod
+    def score_endpoints(score_transport: str) -> Dict[str, str]:
+        # Where clients on this host reach the score server, by transport
+        endpoints = {'tcp': f'127.0.0.1:{CiySchedulerInstaller.SCORE_SERVER_PORT}'}
+        if score_transport == 'uds':
+            endpoints['uds'] = f'unix://{CiySchedulerInstaller.SCORE_SOCKET_PATH}'
+        return endpoints
+
+    def environment_file(self, host_url: str) -> str:
+        if self._score_transport == 'uds':
+            score_server_url = f'unix://{CiySchedulerInstaller.SCORE_SOCKET_PATH}'
+        else:
+            score_server_url = f'0.0.0.0:{CiySchedulerInstaller.SCORE_SERVER_PORT}'
+        contents = CiySchedulerInstaller.ENVIRONMENT_FILE_CONTENTS.format(host=host_url,
+                                                                          score_server_url=score_server_url)
+        workers = self.score_workers
+        if workers is None:
+            return contents
+        contents = contents.rstrip(' ') + f'SCHEDULER_SCORE_WORKERS={workers}\n'
+        if self._score_workers is not None:
+            # Caps the Go runtime of the cluster's only scheduler, so only on an explicit worker count
+            contents += f'GOMAXPROCS={workers}\n'
+        return contents
 
     @staticmethod
     def check_if_ciy_scheduler_is_installed() -> bool:
-        return os.system('systemctl is-active quiet ciy-scheduler') == 0
+        return host_facts().unit_active('ciy-scheduler')
 
     def install_kube_scheduler(self, host_url: str, gitlab_token: str):
-        installation_status = True
+        package_path = self.download_ciy_scheduler(gitlab_token=gitlab_token, artifact_cache=ArtifactCache())
+        self.setup_ciy_scheduler(host_url=host_url, package_path=package_path)
+
+    @staticmethod
+    def ciy_scheduler_artifact(gitlab_token: str) -> ArtifactSpec:
+        return ArtifactSpec(
+            name='ciy-kube-scheduler', version=CiySchedulerInstaller.CIY_SCHEDULER_SCALE_VERSION, suffix='-amd64.deb',
+            url=f'https://gitlab.com/api/v4/projects/54080196/packages/generic/ciy-scheduler/{CiySchedulerInstaller.CIY_SCHEDULER_SCALE_VERSION}/ciy-kube-scheduler-{CiySchedulerInstaller.CIY_SCHEDULER_SCALE_VERSION}-amd64.deb',
+            headers={'PRIVATE-TOKEN': gitlab_token})
+
+    def download_ciy_scheduler(self, gitlab_token: str, artifact_cache: ArtifactCache) -> Optional[pathlib.Path]:
+        if CiySchedulerInstaller.check_if_ciy_scheduler_is_installed():
+            return None
+        self._logger.info("Fetching ciy-scheduler package")
+        return artifact_cache.fetch(CiySchedulerInstaller.ciy_scheduler_artifact(gitlab_token))
+
+    def setup_ciy_scheduler(self, host_url: str, package_path: Optional[pathlib.Path]):
         self._logger.info("Checking if ciy-scheduler is installed")
         if not CiySchedulerInstaller.check_if_ciy_scheduler_is_installed():
-            installation_status = self.install_ciy_scheduler(host_url=host_url, gitlab_token=gitlab_token)
+            installation_status = self.install_ciy_scheduler(host_url=host_url, package_path=package_path)
             self._logger.info(f"ciy-scheduler installation status: {installation_status}")
+        else:
+            # A changed transport or worker count is applied to an installed service too
+            installation_status = self.configure_ciy_scheduler(host_url=host_url)
 
         if not installation_status:
             self._logger.fatal("Error!! failed to install ciy-scheduler... aborting")
             raise RuntimeError("Failed to install ciy-scheduler... aborting")
 
-    def install_ciy_scheduler(self, host_url: str, gitlab_token: str) -> bool:
+    def install_ciy_scheduler(self, host_url: str, package_path: pathlib.Path) -> bool:
         status = True
-        status &= os.system(f'wget --header="PRIVATE-TOKEN: {gitlab_token}" --output-document=ciy-scheduler.deb \
-  https://gitlab.com/api/v4/projects/54080196/packages/generic/ciy-scheduler/{CiySchedulerInstaller.CIY_SCHEDULER_SCALE_VERSION}/ciy-kube-scheduler-{CiySchedulerInstaller.CIY_SCHEDULER_SCALE_VERSION}-amd64.deb') == 0
         self._logger.info("Ciy-scheduler dpkg in progress")
-        status &= os.system(f'dpkg --install ciy-scheduler.deb') == 0
+        status &= command_runner().run(['dpkg', '--install', package_path]).succeeded
 
         self._logger.info("Enabling ciy-scheduler service")
-        status &= os.system(f'systemctl enable ciy-scheduler') == 0
+        status &= command_runner().run(['systemctl', 'enable', 'ciy-scheduler']).succeeded
         if not status:
             return False
+        return self.configure_ciy_scheduler(host_url=host_url, start=True)
+
+    def _deploy_socket_units(self, deployer: ArtifactDeployer) -> bool:
+        # True when the unit files changed, systemd has to reread them then
+        if self._score_transport == 'uds':
+            socket_unit = CiySchedulerInstaller.SOCKET_UNIT_CONTENTS.format(
+                socket_path=CiySchedulerInstaller.SCORE_SOCKET_PATH, port=CiySchedulerInstaller.SCORE_SERVER_PORT)
+            results = [deployer.deploy_stream(io.BytesIO(contents.encode('utf-8')), path, mode=0o644)
+                       for contents, path in ((socket_unit, CiySchedulerInstaller.SOCKET_UNIT_PATH),
+                                              (CiySchedulerInstaller.SERVICE_DROP_IN_CONTENTS,
+                                               CiySchedulerInstaller.SERVICE_DROP_IN_PATH))]
+            return any(result.replaced for result in results)
+        if not CiySchedulerInstaller.SOCKET_UNIT_PATH.exists():
+            return False
+        # Back to TCP: the service binds the port itself again once systemd lets go of it
+        command_runner().run(['systemctl', 'disable', '--now', 'ciy-scheduler.socket'])
+        CiySchedulerInstaller.SOCKET_UNIT_PATH.unlink()
+        CiySchedulerInstaller.SERVICE_DROP_IN_PATH.unlink(missing_ok=True)
+        return True
 
-        self._logger.info("Configuring ciy-scheduler service")
-        CiySchedulerInstaller.ENVIRONMENT_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
-        CiySchedulerInstaller.ENVIRONMENT_FILE_PATH.write_text(
-            CiySchedulerInstaller.ENVIRONMENT_FILE_CONTENTS.format(host=host_url))
+    def configure_ciy_scheduler(self, host_url: str, start: bool = False) -> bool:
+        self._logger.info(f"Configuring ciy-scheduler service ({self._score_transport} score endpoint, "
+                          f"{self.score_workers or 'default'} workers)")
+        runner = command_runner()
+        deployer = ArtifactDeployer()
+        environment_changed = deployer.deploy_stream(io.BytesIO(self.environment_file(host_url).encode('utf-8')),
+                                                     CiySchedulerInstaller.ENVIRONMENT_FILE_PATH, mode=0o644).replaced
+        units_changed = self._deploy_socket_units(deployer)
+        if not (start or environment_changed or units_changed):
+            return self.wait_for_score_server()
+
+        status = True
+        if not start:
+            # The running service may hold the TCP port the socket unit is about to bind
+            status &= runner.run(['systemctl', 'stop', 'ciy-scheduler']).succeeded
+        if units_changed:
+            status &= runner.run(['systemctl', 'daemon-reload']).succeeded
+        if self._score_transport == 'uds':
+            status &= runner.run(['systemctl', 'enable', 'ciy-scheduler.socket']).succeeded and \
+                runner.run(['systemctl', 'start', 'ciy-scheduler.socket']).succeeded
 
         self._logger.info("Starting ciy-scheduler")
-        status &= os.system(f'systemctl start ciy-scheduler') == 0
-        return status
+        status &= runner.run(['systemctl', 'start', 'ciy-scheduler']).succeeded
+        invalidate_host_facts()
+        return status and self.wait_for_score_server()
+
+    def wait_for_score_server(self) -> bool:
+        # Over TCP the scheduler starts before k3s exists, so an active unit is all that can be asked of it. A
+        # socket activated socket accepts connections before the process even runs, only an answered request
+        # means the server behind it is serving
+        probes = [SystemdUnitProbe('ciy-scheduler')]
+        if self._score_transport == 'uds':
+            probes.append(HttpEndpointProbe('ciy-scheduler-score:uds',
+                                            CiySchedulerInstaller.score_endpoints('uds')['uds'],
+                                            CiySchedulerInstaller.SCORE_PROBE_PATH))
+        results = default_probe_engine().wait_all(probes, CiySchedulerInstaller.SERVICE_STARTUP_TIME_IN_SECONDS)
+        return all(result.ready for result in results)
+
+    def benchmark_score_transport(self) -> List[Dict[str, Any]]:
+        from cluster_server_installer.benchmarks.score_benchmark import format_report, run_benchmark
+
+        with tracer().span('score-benchmark', 'install') as span:
+            results = run_benchmark(CiySchedulerInstaller.score_endpoints(self._score_transport),
+                                    CiySchedulerInstaller.SCORE_BENCHMARK_REQUESTS,
+                                    CiySchedulerInstaller.SCORE_PROBE_PATH)
+            span.set(**{f'{result.transport}_p50_ms': round(result.p50_ms, 3) for result in results})
+        self._logger.info(f"Score latency benchmark:\n{format_report(results)}")
+        return [dataclasses.asdict(result) for result in results]
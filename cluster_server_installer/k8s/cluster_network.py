@@ -0,0 +1,13 @@
+from dataclasses import dataclass
+from typing import List, Tuple
+
+
+@dataclass(frozen=True)
+class ClusterNetwork:
+    cluster_cidr: str = '10.42.0.0/16'
+    service_cidr: str = '10.43.0.0/16'
+    # Not part of the k3s configuration, routed over the VPN for the clients' IPv6 side
+    extra_routes: Tuple[str, ...] = ('2001:cafe:42::/56',)
+
+    def routes(self) -> List[str]:
+        return [self.cluster_cidr, self.service_cidr, *self.extra_routes]
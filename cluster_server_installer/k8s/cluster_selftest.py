@@ -0,0 +1,330 @@
+import io
+import json
+import logging
+import pathlib
+import re
+import shutil
+import statistics
+import time
+from dataclasses import dataclass, asdict, field
+from typing import Final, Dict, List, Optional, Sequence, Tuple
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+import kubernetes
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.k8s.readiness_gates import PodPhaseGate, PodScheduledGate, PvcBoundGate, \
+    ReadinessTimeoutError
+from cluster_server_installer.k8s.storage_profile import NFS_BULK_STORAGE_CLASS, NFS_STORAGE_CLASS
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.host_facts import host_facts
+from cluster_server_installer.utilities.tracing import tracer
+
+DEFAULT_BASELINE_PATH: Final[pathlib.Path] = pathlib.Path('/var/lib/ciy-installer/selftest-baseline.json')
+DEFAULT_TOLERANCE: Final[float] = 0.25
+# dd's summary line, e.g. "67108864 bytes (67 MB, 64 MiB) copied, 0.51 s, 132 MB/s"
+DD_SUMMARY_PATTERN: Final[re.Pattern] = re.compile(r'^(\d+) bytes .* copied, ([\d.]+) s', re.MULTILINE)
+PGBENCH_LATENCY_PATTERN: Final[re.Pattern] = re.compile(r'latency average = ([\d.]+) ms')
+TAILSCALE_PONG_PATTERN: Final[re.Pattern] = re.compile(r'^pong from .* in ([\d.]+)ms', re.MULTILINE)
+
+
+def _percentile(samples: Sequence[float], percent: int) -> float:
+    if len(samples) < 2:
+        return samples[0]
+    return statistics.quantiles(samples, n=100)[percent - 1]
+
+
+@dataclass(frozen=True)
+class SelfTestMetric:
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = False
+
+
+@dataclass(frozen=True)
+class MetricComparison:
+    name: str
+    baseline: float
+    value: float
+    unit: str
+    regressed: bool
+
+    @property
+    def change(self) -> float:
+        return (self.value - self.baseline) / self.baseline if self.baseline else 0.0
+
+
+@dataclass(frozen=True)
+class SelfTestReport:
+    hostname: str
+    created_at: float
+    metrics: List[SelfTestMetric] = field(default_factory=list)
+    # probe -> reason, for the probes that could not produce numbers
+    failures: Dict[str, str] = field(default_factory=dict)
+
+    @staticmethod
+    def load(path: pathlib.Path) -> 'SelfTestReport':
+        document = json.loads(path.read_text())
+        return SelfTestReport(hostname=document['hostname'], created_at=document['created_at'],
+                              metrics=[SelfTestMetric(**metric) for metric in document['metrics']],
+                              failures=document.get('failures', {}))
+
+    def save(self, path: pathlib.Path):
+        ArtifactDeployer().deploy_stream(io.BytesIO(self.to_json().encode('utf-8')), path, mode=0o644)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), indent=2)
+
+    def compare(self, baseline: 'SelfTestReport', tolerance: float = DEFAULT_TOLERANCE) -> List[MetricComparison]:
+        # A metric regresses once it is worse than the baseline by more than the tolerance, in its own direction
+        baseline_values = {metric.name: metric.value for metric in baseline.metrics}
+        comparisons = []
+        for metric in self.metrics:
+            if metric.name not in baseline_values:
+                continue
+            reference = baseline_values[metric.name]
+            if metric.higher_is_better:
+                regressed = metric.value < reference * (1 - tolerance)
+            else:
+                regressed = metric.value > reference * (1 + tolerance)
+            comparisons.append(MetricComparison(metric.name, reference, metric.value, metric.unit, regressed))
+        return comparisons
+
+    def format_report(self, comparisons: Optional[List[MetricComparison]] = None) -> str:
+        compared = {comparison.name: comparison for comparison in comparisons or []}
+        lines = [f'{"metric":<36}{"value":>12}  {"unit":<8}{"baseline":>12}{"change":>9}']
+        for metric in self.metrics:
+            comparison = compared.get(metric.name)
+            baseline = f'{comparison.baseline:>12.2f}{comparison.change:>+9.0%}' if comparison else ''
+            status = '  REGRESSED' if comparison and comparison.regressed else ''
+            lines.append(f'{metric.name:<36}{metric.value:>12.2f}  {metric.unit:<8}{baseline}{status}')
+        for probe, reason in self.failures.items():
+            lines.append(f'{probe:<36}{"FAILED":>12}  {reason}')
+        return '\n'.join(lines)
+
+
+class ClusterSelfTest:
+    NAMESPACE: Final[str] = 'cloud-iy'
+    POD_LABEL: Final[Dict[str, str]] = {'app': 'ciy-selftest'}
+    # Images the install already prefetched, so no probe waits on a registry
+    SHELL_IMAGE: Final[str] = 'redis:7.2.4'
+    POSTGRES_IMAGE: Final[str] = 'postgres:latest'
+    API_REQUESTS: Final[int] = 50
+    ROUND_TRIPS: Final[int] = 200
+    VPN_PINGS: Final[int] = 10
+    VPN_THROUGHPUT_SECONDS: Final[int] = 5
+    STORAGE_SIZE_MIB: Final[int] = 64
+    STORAGE_FSYNCS: Final[int] = 200
+    POD_TIMEOUT_IN_SECONDS: Final[int] = 300
+
+    def __init__(self, api_client: client.ApiClient, storage_classes: Sequence[str] = (NFS_STORAGE_CLASS,
+                                                                                          NFS_BULK_STORAGE_CLASS),
+                 vpn_peer: Optional[str] = None):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._api_client = api_client
+        self._core = client.CoreV1Api(api_client)
+        self._storage_classes = storage_classes
+        self._vpn_peer = vpn_peer
+        self._run_id = f'{int(time.time())}'
+
+    @staticmethod
+    def connect(config_file: str, storage_classes: Sequence[str] = (NFS_STORAGE_CLASS, NFS_BULK_STORAGE_CLASS),
+                vpn_peer: Optional[str] = None) -> 'ClusterSelfTest':
+        configuration = client.Configuration()
+        kubernetes.config.load_kube_config(config_file=config_file, client_configuration=configuration)
+        return ClusterSelfTest(client.ApiClient(configuration), storage_classes, vpn_peer)
+
+    def run(self) -> SelfTestReport:
+        probes = [('api-latency', self.measure_api_latency),
+                  ('pod-startup', self.measure_pod_startup),
+                  ('vpn', self.measure_vpn),
+                  *((f'storage-{storage_class}', lambda storage_class=storage_class: self.measure_storage(
+                      storage_class)) for storage_class in self._storage_classes),
+                  ('redis', self.measure_redis),
+                  ('postgres', self.measure_postgres)]
+        metrics: List[SelfTestMetric] = []
+        failures: Dict[str, str] = {}
+        # One after the other, concurrent probes would mostly measure each other
+        for probe, measure in probes:
+            with tracer().span(probe, 'selftest') as span:
+                try:
+                    measured = measure()
+                except (ApiException, ReadinessTimeoutError, RuntimeError, ValueError, KeyError) as e:
+                    self._logger.warning(f"Self-test probe {probe} failed: {e}")
+                    failures[probe] = str(e).splitlines()[0] if str(e) else type(e).__name__
+                    span.set(failed=True)
+                    continue
+            metrics += measured
+        return SelfTestReport(hostname=host_facts().hostname, created_at=time.time(), metrics=metrics,
+                              failures=failures)
+
+    def measure_api_latency(self) -> List[SelfTestMetric]:
+        samples = []
+        for _ in range(ClusterSelfTest.API_REQUESTS):
+            start = time.perf_counter()
+            self._core.list_namespaced_pod(ClusterSelfTest.NAMESPACE, limit=1)
+            samples.append((time.perf_counter() - start) * 1000)
+        return [SelfTestMetric('api_list_p50', _percentile(samples, 50), 'ms'),
+                SelfTestMetric('api_list_p99', _percentile(samples, 99), 'ms')]
+
+    def measure_pod_startup(self) -> List[SelfTestMetric]:
+        # k3s runs with its scheduler disabled, so the time to a node binding is the ciy-scheduler's
+        name = f'ciy-selftest-startup-{self._run_id}'
+        start = time.monotonic()
+        self._create_pod(name, ['sh', '-c', 'sleep 5'])
+        try:
+            PodScheduledGate(ClusterSelfTest.NAMESPACE, name).wait(self._api_client)
+            scheduled = time.monotonic() - start
+            PodPhaseGate(ClusterSelfTest.NAMESPACE, name, ['Running', 'Succeeded']).wait(self._api_client)
+            running = time.monotonic() - start
+        finally:
+            self._delete_pod(name)
+        return [SelfTestMetric('pod_scheduled', scheduled * 1000, 'ms'),
+                SelfTestMetric('pod_running', running * 1000, 'ms')]
+
+    def _find_vpn_peer(self) -> str:
+        if self._vpn_peer:
+            return self._vpn_peer
+        result = command_runner().run(['tailscale', 'status', '--json'], timeout_in_seconds=10)
+        if not result.succeeded:
+            raise RuntimeError('tailscale status failed')
+        for peer in (json.loads(result.stdout).get('Peer') or {}).values():
+            addresses = [address for address in peer.get('TailscaleIPs') or [] if ':' not in address]
+            if peer.get('Online') and addresses:
+                return addresses[0]
+        raise RuntimeError('no tailscale peer is online')
+
+    def measure_vpn(self) -> List[SelfTestMetric]:
+        peer = self._find_vpn_peer()
+        runner = command_runner()
+        result = runner.run(['tailscale', 'ping', '--c', str(ClusterSelfTest.VPN_PINGS), '--until-direct=false',
+                             peer], timeout_in_seconds=ClusterSelfTest.VPN_PINGS * 10)
+        samples = [float(rtt) for rtt in TAILSCALE_PONG_PATTERN.findall(result.stdout)]
+        if not samples:
+            raise RuntimeError(f'no pong from {peer}')
+        metrics = [SelfTestMetric('vpn_rtt_p50', _percentile(samples, 50), 'ms'),
+                   SelfTestMetric('vpn_rtt_max', max(samples), 'ms')]
+        # Throughput needs an iperf3 server on the peer, without one only the round trip is measured
+        if shutil.which('iperf3') is None:
+            self._logger.info("iperf3 is not installed, skipping the VPN throughput measurement")
+            return metrics
+        result = runner.run(['iperf3', '--client', peer, '--time', str(ClusterSelfTest.VPN_THROUGHPUT_SECONDS),
+                             '--json'], timeout_in_seconds=ClusterSelfTest.VPN_THROUGHPUT_SECONDS + 30)
+        if result.succeeded:
+            bits_per_second = json.loads(result.stdout)['end']['sum_received']['bits_per_second']
+            metrics.append(SelfTestMetric('vpn_throughput', bits_per_second / 1e6, 'Mbit/s', higher_is_better=True))
+        return metrics
+
+    def measure_storage(self, storage_class: str) -> List[SelfTestMetric]:
+        claim = f'ciy-selftest-{storage_class}-{self._run_id}'
+        start = time.monotonic()
+        self._core.create_namespaced_persistent_volume_claim(ClusterSelfTest.NAMESPACE, client.V1PersistentVolumeClaim(
+            metadata=client.V1ObjectMeta(name=claim, labels=ClusterSelfTest.POD_LABEL),
+            spec=client.V1PersistentVolumeClaimSpec(
+                storage_class_name=storage_class, access_modes=['ReadWriteOnce'],
+                resources=client.V1ResourceRequirements(requests={'storage': '1Gi'}))))
+        try:
+            PvcBoundGate(ClusterSelfTest.NAMESPACE, claim).wait(self._api_client)
+            bound = time.monotonic() - start
+            # The same write, direct read and commit pattern as the host side storage benchmark, through the mount
+            # options of the storage class
+            size, fsyncs = ClusterSelfTest.STORAGE_SIZE_MIB, ClusterSelfTest.STORAGE_FSYNCS
+            output = self._run_pod(f'{claim}-io', [
+                'sh', '-c',
+                f'dd if=/dev/zero of=/data/sequential bs=1M count={size} conv=fdatasync 2>&1 && '
+                f'dd if=/data/sequential of=/dev/null bs=1M iflag=direct 2>&1 && '
+                f'dd if=/dev/zero of=/data/commits bs=4k count={fsyncs} oflag=dsync 2>&1'],
+                volumes={claim: '/data'})
+        finally:
+            self._core.delete_namespaced_persistent_volume_claim(claim, ClusterSelfTest.NAMESPACE)
+        summaries = DD_SUMMARY_PATTERN.findall(output)
+        if len(summaries) != 3:
+            raise RuntimeError(f'unexpected dd output: {output.strip()[-200:]}')
+        (write_bytes, write_seconds), (read_bytes, read_seconds), (_, fsync_seconds) = \
+            [(int(size_bytes), float(seconds)) for size_bytes, seconds in summaries]
+        return [SelfTestMetric(f'{storage_class}.pvc_bound', bound * 1000, 'ms'),
+                SelfTestMetric(f'{storage_class}.write', write_bytes / 1024 ** 2 / write_seconds, 'MiB/s',
+                               higher_is_better=True),
+                SelfTestMetric(f'{storage_class}.read', read_bytes / 1024 ** 2 / read_seconds, 'MiB/s',
+                               higher_is_better=True),
+                SelfTestMetric(f'{storage_class}.fsync', fsync_seconds * 1000 / fsyncs, 'ms')]
+
+    def measure_redis(self) -> List[SelfTestMetric]:
+        # One connection, sequential PINGs; the password reaches the pod from its secret, never this process
+        round_trips = ClusterSelfTest.ROUND_TRIPS
+        output = self._run_pod(f'ciy-selftest-redis-{self._run_id}', [
+            'sh', '-c',
+            f'start=$(date +%s%N) && '
+            f'redis-cli -h redis-service -a "$REDIS_PASSWORD" --no-auth-warning -r {round_trips} ping >/dev/null && '
+            f'end=$(date +%s%N) && echo "round trip ns $(( (end - start) / {round_trips} ))"'],
+            env={'REDIS_PASSWORD': ('redis-pwd', 'redis-pwd')})
+        match = re.search(r'round trip ns (\d+)', output)
+        if match is None:
+            raise RuntimeError(f'unexpected redis-cli output: {output.strip()[-200:]}')
+        return [SelfTestMetric('redis_round_trip', int(match.group(1)) / 1e6, 'ms')]
+
+    def measure_postgres(self) -> List[SelfTestMetric]:
+        output = self._run_pod(f'ciy-selftest-postgres-{self._run_id}', [
+            'sh', '-c',
+            f"echo 'SELECT 1;' > /tmp/select.sql && "
+            f"pgbench -h postgres-service -n -f /tmp/select.sql -t {ClusterSelfTest.ROUND_TRIPS} ciy_metrics 2>&1"],
+            env={'PGUSER': ('metrics-postgres-details', 'user'),
+                 'PGPASSWORD': ('metrics-postgres-details', 'pwd')},
+            image=ClusterSelfTest.POSTGRES_IMAGE)
+        match = PGBENCH_LATENCY_PATTERN.search(output)
+        if match is None:
+            raise RuntimeError(f'unexpected pgbench output: {output.strip()[-200:]}')
+        return [SelfTestMetric('postgres_query', float(match.group(1)), 'ms')]
+
+    def _create_pod(self, name: str, command: List[str], env: Optional[Dict[str, Tuple[str, str]]] = None,
+                    volumes: Optional[Dict[str, str]] = None, image: str = SHELL_IMAGE):
+        # env: variable -> (secret, key), volumes: claim -> mount path
+        container = client.V1Container(
+            name='selftest', image=image, image_pull_policy='IfNotPresent', command=command,
+            env=[client.V1EnvVar(name=variable, value_from=client.V1EnvVarSource(
+                secret_key_ref=client.V1SecretKeySelector(name=secret, key=key)))
+                for variable, (secret, key) in (env or {}).items()],
+            volume_mounts=[client.V1VolumeMount(name=f'volume-{index}', mount_path=path)
+                           for index, path in enumerate((volumes or {}).values())])
+        self._core.create_namespaced_pod(ClusterSelfTest.NAMESPACE, client.V1Pod(
+            metadata=client.V1ObjectMeta(name=name, labels=ClusterSelfTest.POD_LABEL),
+            spec=client.V1PodSpec(
+                restart_policy='Never', containers=[container],
+                volumes=[client.V1Volume(name=f'volume-{index}', persistent_volume_claim=(
+                    client.V1PersistentVolumeClaimVolumeSource(claim_name=claim)))
+                    for index, claim in enumerate((volumes or {}).keys())])))
+
+    def _delete_pod(self, name: str):
+        try:
+            self._core.delete_namespaced_pod(name, ClusterSelfTest.NAMESPACE, grace_period_seconds=0)
+        except ApiException as e:
+            self._logger.warning(f"Could not delete self-test pod {name}: {e.reason}")
+
+    def _run_pod(self, name: str, command: List[str], env: Optional[Dict[str, Tuple[str, str]]] = None,
+                 volumes: Optional[Dict[str, str]] = None, image: str = SHELL_IMAGE) -> str:
+        self._create_pod(name, command, env, volumes, image)
+        try:
+            PodPhaseGate(ClusterSelfTest.NAMESPACE, name, ['Succeeded'],
+                         ClusterSelfTest.POD_TIMEOUT_IN_SECONDS).wait(self._api_client)
+            return self._core.read_namespaced_pod_log(name, ClusterSelfTest.NAMESPACE)
+        finally:
+            self._delete_pod(name)
+
+
+def run_selftest(config_file: str, baseline_path: pathlib.Path = DEFAULT_BASELINE_PATH,
+                 tolerance: float = DEFAULT_TOLERANCE, save_baseline: bool = False,
+                 vpn_peer: Optional[str] = None) -> Tuple[SelfTestReport, List[MetricComparison]]:
+    logger = logging.getLogger(LOGGER_NAME)
+    report = ClusterSelfTest.connect(config_file, vpn_peer=vpn_peer).run()
+    if baseline_path.exists() and not save_baseline:
+        return report, report.compare(SelfTestReport.load(baseline_path), tolerance)
+    # The first complete run after an install becomes the reference later runs are held to
+    if report.failures:
+        logger.warning(f"Not writing the self-test baseline, probes failed: {', '.join(report.failures)}")
+    else:
+        report.save(baseline_path)
+        logger.info(f"Self-test baseline written to {baseline_path}")
+    return report, []
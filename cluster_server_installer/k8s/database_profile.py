@@ -0,0 +1,146 @@
+import json
+from dataclasses import dataclass
+from typing import Final, Any, Dict, Mapping, Sequence
+
+import yaml
+
+from cluster_server_installer.utilities.host_facts import HostCapacity
+
+DATABASES: Final[Sequence[str]] = ('postgres', 'redis')
+POSTGRES_MAX_CONNECTIONS: Final[int] = 100
+# Share of the host either database may be given at most, whatever the tier asks for
+POSTGRES_MAX_MEMORY_SHARE: Final[float] = 0.25
+REDIS_MAX_MEMORY_SHARE: Final[float] = 0.125
+# Redis needs room above maxmemory for client buffers and fragmentation before the container limit is hit
+REDIS_MAXMEMORY_SHARE: Final[float] = 0.75
+
+
+@dataclass(frozen=True)
+class DatabaseTier:
+    postgres_memory_mib: int
+    postgres_cpus: float
+    redis_memory_mib: int
+    redis_cpus: float
+    max_wal_size_mib: int
+
+
+DATABASE_TIERS: Final[Dict[str, DatabaseTier]] = {
+    'small': DatabaseTier(postgres_memory_mib=512, postgres_cpus=1, redis_memory_mib=256, redis_cpus=0.5,
+                          max_wal_size_mib=512),
+    'medium': DatabaseTier(postgres_memory_mib=2048, postgres_cpus=2, redis_memory_mib=1024, redis_cpus=1,
+                           max_wal_size_mib=2048),
+    'large': DatabaseTier(postgres_memory_mib=8192, postgres_cpus=4, redis_memory_mib=4096, redis_cpus=1,
+                          max_wal_size_mib=8192),
+}
+DATABASE_PROFILES: Final[Sequence[str]] = ('auto', *DATABASE_TIERS)
+
+
+def _quantity(value: int, unit: int, suffixes: Sequence[str]) -> str:
+    # The canonical form the API server stores (1000m -> 1, 1024Mi -> 1Gi), so a reconcile sees no difference
+    for suffix in suffixes:
+        if value % unit:
+            return f'{value}{suffix}'
+        value //= unit
+    return f'{value}{suffixes[-1]}'
+
+
+def _resources(memory_mib: int, cpus: float) -> Dict[str, Dict[str, str]]:
+    # Requests at half the limits, so the databases are guaranteed a share without reserving the whole budget
+    def cpu(millicores: int) -> str:
+        return _quantity(millicores, 1000, ('m', ''))
+
+    def memory(mib: int) -> str:
+        return _quantity(mib, 1024, ('Mi', 'Gi'))
+
+    return {'requests': {'cpu': cpu(int(cpus * 500)), 'memory': memory(memory_mib // 2)},
+            'limits': {'cpu': cpu(int(cpus * 1000)), 'memory': memory(memory_mib)}}
+
+
+class DatabaseProfile:
+    def __init__(self, tier: str, settings: Dict[str, Dict[str, Any]]):
+        self.tier = tier
+        self._settings = settings
+
+    @staticmethod
+    def tier_for_host(capacity: HostCapacity) -> str:
+        if capacity.memory_gib < 4:
+            return 'small'
+        return 'medium' if capacity.memory_gib < 16 else 'large'
+
+    @staticmethod
+    def for_host(capacity: HostCapacity, tier: str = 'auto', latency_backend: str = 'nfs') -> 'DatabaseProfile':
+        if tier not in DATABASE_PROFILES:
+            raise ValueError(f"Unknown database profile {tier}, expected one of {DATABASE_PROFILES}")
+        tier = DatabaseProfile.tier_for_host(capacity) if tier == 'auto' else tier
+        sizes = DATABASE_TIERS[tier]
+        memory_mib = capacity.memory_bytes // 1024 ** 2
+        postgres_memory = min(sizes.postgres_memory_mib, int(memory_mib * POSTGRES_MAX_MEMORY_SHARE))
+        redis_memory = min(sizes.redis_memory_mib, int(memory_mib * REDIS_MAX_MEMORY_SHARE))
+
+        postgres = {
+            'shared_buffers': f'{postgres_memory // 4}MB',
+            'effective_cache_size': f'{postgres_memory * 3 // 4}MB',
+            'maintenance_work_mem': f'{max(32, postgres_memory // 16)}MB',
+            'work_mem': f'{max(4, postgres_memory * 3 // 4 // (POSTGRES_MAX_CONNECTIONS * 4))}MB',
+            'max_connections': str(POSTGRES_MAX_CONNECTIONS),
+            'max_wal_size': f'{sizes.max_wal_size_mib}MB',
+            'min_wal_size': f'{sizes.max_wal_size_mib // 4}MB',
+        }
+        if latency_backend == 'nfs':
+            # Every WAL byte crosses the network to the sync export, compressing full page writes pays for itself
+            postgres['wal_compression'] = 'on'
+        else:
+            postgres['random_page_cost'] = '1.1'
+        redis = {
+            'maxmemory': f'{int(redis_memory * REDIS_MAXMEMORY_SHARE)}mb',
+            # Only keys with a TTL are evicted, writes fail instead of silently dropping data that has none
+            'maxmemory-policy': 'volatile-lru',
+            # The container has no volume, snapshots and the AOF would only cost forks and disk writes
+            'save': '',
+            'appendonly': 'no',
+        }
+        return DatabaseProfile(tier, {
+            'postgres': {'resources': _resources(postgres_memory, min(sizes.postgres_cpus, capacity.cpu_count)),
+                         'settings': postgres},
+            'redis': {'resources': _resources(redis_memory, min(sizes.redis_cpus, capacity.cpu_count)),
+                      'settings': redis},
+        })
+
+    def with_overrides(self, overrides: Mapping[str, Any]) -> 'DatabaseProfile':
+        # 'postgres.shared_buffers=1GB' or 'redis.maxmemory-policy=allkeys-lru' set a server setting,
+        # 'postgres.resources.limits.memory=4Gi' a container resource, a null value removes either
+        settings = json.loads(json.dumps(self._settings))
+        for key, value in overrides.items():
+            database, _, path = key.partition('.')
+            if database not in DATABASES or not path:
+                raise ValueError(f"Database overrides look like postgres.<setting> or redis.<setting>, got {key!r}")
+            if path.startswith('resources.'):
+                _, bound, resource = (path.split('.') + ['', ''])[:3]
+                if bound not in ('requests', 'limits') or resource not in ('cpu', 'memory'):
+                    raise ValueError(f"Resource overrides look like {database}.resources.limits.memory, got {key!r}")
+                target, name = settings[database]['resources'][bound], resource
+            else:
+                target, name = settings[database]['settings'], path
+            if isinstance(value, bool):
+                # YAML reads on/yes as booleans, postgres spells them on/off and redis yes/no
+                value = ('yes' if value else 'no') if database == 'redis' else ('on' if value else 'off')
+            if value is None:
+                target.pop(name, None)
+            else:
+                target[name] = str(value)
+        return DatabaseProfile(self.tier, settings)
+
+    def dump(self) -> str:
+        return yaml.safe_dump({'tier': self.tier, **self._settings}, default_flow_style=False, sort_keys=False)
+
+    def template_values(self) -> Dict[str, str]:
+        postgres, redis = self._settings['postgres'], self._settings['redis']
+        # JSON is valid YAML flow syntax, the values drop straight into the manifests
+        return {
+            'POSTGRES_RESOURCES': json.dumps(postgres['resources']),
+            'POSTGRES_ARGS': json.dumps([argument for name, value in postgres['settings'].items()
+                                         for argument in ('-c', f'{name}={value}')]),
+            'REDIS_RESOURCES': json.dumps(redis['resources']),
+            'REDIS_ARGS': json.dumps([argument for name, value in redis['settings'].items()
+                                      for argument in (f'--{name}', value)]),
+        }
@@ -0,0 +1,174 @@
+import logging
+import pathlib
+import re
+from dataclasses import dataclass
+from typing import Final, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.tracing import tracer
+
+IMAGE_LINE_PATTERN: Final[re.Pattern] = re.compile(r'^(\s*(?:-\s+)?image:\s*)(["\']?)([^\s"\'#]+)\2[ \t]*$',
+                                                   re.MULTILINE)
+PULL_TOTAL_PATTERN: Final[re.Pattern] = re.compile(r'total:\s*([\d.]+)\s*([KMGT]i?B?|B)?')
+IMPORT_LINE_PATTERN: Final[re.Pattern] = re.compile(r'unpacking (\S+) \((sha256:[0-9a-f]{64})\)')
+DEFAULT_REGISTRY: Final[str] = 'docker.io'
+SIZE_UNITS: Final[Dict[str, int]] = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def _parse_size(number: str, unit: Optional[str]) -> int:
+    return int(float(number) * SIZE_UNITS[(unit or '')[:1]])
+
+
+@dataclass(frozen=True)
+class ImageReference:
+    repository: str
+    tag: Optional[str] = None
+    digest: Optional[str] = None
+
+    @staticmethod
+    def parse(text: str) -> 'ImageReference':
+        # Normalized the way containerd names images, so 'redis:7.2.4' becomes 'docker.io/library/redis:7.2.4'
+        name, _, digest = text.partition('@')
+        slash = name.rfind('/')
+        colon = name.rfind(':')
+        tag = None
+        if colon > slash:
+            name, tag = name[:colon], name[colon + 1:]
+        first, _, rest = name.partition('/')
+        if not rest:
+            name = f'{DEFAULT_REGISTRY}/library/{first}'
+        elif '.' not in first and ':' not in first and first != 'localhost':
+            name = f'{DEFAULT_REGISTRY}/{name}'
+        return ImageReference(name, tag or (None if digest else 'latest'), digest or None)
+
+    @property
+    def registry(self) -> str:
+        return self.repository.partition('/')[0]
+
+    @property
+    def name(self) -> str:
+        return f'{self.repository}:{self.tag}' if self.tag else f'{self.repository}@{self.digest}'
+
+    def pinned(self, digest: str) -> str:
+        # Without a tag the kubelet defaults to IfNotPresent, even for images that were referenced as :latest
+        return f'{self.repository}@{digest}'
+
+
+@dataclass(frozen=True)
+class ImagePullResult:
+    image: str
+    source: str
+    succeeded: bool
+    digest: Optional[str] = None
+    transferred_bytes: int = 0
+    seconds: float = 0.0
+
+
+def images_in_manifests(texts: Iterable[str]) -> List[ImageReference]:
+    # Only plain 'image:' fields, the images of helm charts are chosen when the chart renders in the cluster
+    images: Dict[str, ImageReference] = {}
+    for text in texts:
+        for match in IMAGE_LINE_PATTERN.finditer(text):
+            reference = ImageReference.parse(match.group(3))
+            images.setdefault(reference.name, reference)
+    return list(images.values())
+
+
+def pin_images(manifest: str, digests: Mapping[str, str]) -> str:
+    def replace(match: re.Match) -> str:
+        reference = ImageReference.parse(match.group(3))
+        digest = digests.get(reference.name)
+        if digest is None:
+            return match.group(0)
+        return f'{match.group(1)}{match.group(2)}{reference.pinned(digest)}{match.group(2)}'
+
+    return IMAGE_LINE_PATTERN.sub(replace, manifest)
+
+
+class ImagePrefetcher:
+    CONTAINERD_NAMESPACE: Final[str] = 'k8s.io'
+    PULL_TIMEOUT_IN_SECONDS: Final[int] = 15 * 60
+    IMPORT_TIMEOUT_IN_SECONDS: Final[int] = 30 * 60
+
+    def __init__(self, registry: Optional[str] = None, access_key: Optional[str] = None):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._registry = registry
+        self._access_key = access_key
+
+    @staticmethod
+    def _ctr(*arguments: str) -> List[str]:
+        return ['k3s', 'ctr', '--namespace', ImagePrefetcher.CONTAINERD_NAMESPACE, 'images', *arguments]
+
+    def list_images(self) -> Dict[str, Tuple[str, int]]:
+        # name -> (digest, size), from the REF TYPE DIGEST SIZE PLATFORMS LABELS table
+        result = command_runner().run(ImagePrefetcher._ctr('ls'))
+        images = {}
+        for line in result.stdout.splitlines()[1:] if result.succeeded else []:
+            columns = line.split()
+            if len(columns) >= 5 and columns[2].startswith('sha256:'):
+                images[columns[0]] = (columns[2], _parse_size(columns[3], columns[4]))
+        return images
+
+    def missing_images(self, digests: Mapping[str, str]) -> List[str]:
+        present = self.list_images()
+        return [image for image, digest in digests.items() if present.get(image, (None,))[0] != digest]
+
+    def pull_all(self, images: List[ImageReference]) -> List[ImagePullResult]:
+        runner = command_runner()
+        pulls = []
+        for image in images:
+            arguments, secrets = ['pull'], []
+            if self._registry and self._access_key and image.registry == self._registry:
+                arguments += ['--user', f'usr:{self._access_key}']
+                secrets = [self._access_key]
+            pulls.append((image, runner.submit(ImagePrefetcher._ctr(*arguments, image.name), secrets=secrets,
+                                               timeout_in_seconds=ImagePrefetcher.PULL_TIMEOUT_IN_SECONDS)))
+        pulled = [(image, future.result()) for image, future in pulls]
+
+        present = self.list_images()
+        results = []
+        for image, result in pulled:
+            if not result.succeeded:
+                self._logger.warning(f"Prefetching {image.name} failed, the kubelet will pull it on demand")
+                results.append(ImagePullResult(image.name, 'pull', False, seconds=result.duration))
+                continue
+            digest, size = present.get(image.name, (None, 0))
+            totals = PULL_TOTAL_PATTERN.findall(result.stdout)
+            transferred = _parse_size(*totals[-1]) if totals else size
+            results.append(ImagePullResult(image.name, 'pull', digest is not None, digest, transferred,
+                                           result.duration))
+        return results
+
+    def import_archive(self, archive: pathlib.Path) -> List[ImagePullResult]:
+        result = command_runner().run(ImagePrefetcher._ctr('import', str(archive)),
+                                      timeout_in_seconds=ImagePrefetcher.IMPORT_TIMEOUT_IN_SECONDS)
+        if not result.succeeded:
+            self._logger.error(f"Could not import images from {archive}")
+            return []
+        present = self.list_images()
+        return [ImagePullResult(name, 'import', True, digest, present.get(name, (None, 0))[1],
+                                result.duration)
+                for name, digest in IMPORT_LINE_PATTERN.findall(result.stdout)]
+
+    def prefetch(self, images: List[ImageReference],
+                 archive: Optional[pathlib.Path] = None) -> List[ImagePullResult]:
+        results: List[ImagePullResult] = []
+        with tracer().span('image-prefetch', 'install', images=len(images)) as span:
+            if archive is not None:
+                results += self.import_archive(archive)
+            imported = {result.image for result in results}
+            results += self.pull_all([image for image in images if image.name not in imported])
+            span.set(transferred_bytes=sum(result.transferred_bytes for result in results),
+                     failures=sum(not result.succeeded for result in results))
+        self._logger.info(f"Image prefetch:\n{ImagePrefetcher.format_report(results)}")
+        return results
+
+    @staticmethod
+    def format_report(results: List[ImagePullResult]) -> str:
+        lines = [f'{"image":<70}{"source":>8}{"MiB":>10}{"seconds":>9}']
+        for result in results:
+            status = '' if result.succeeded else '  FAILED'
+            lines.append(f'{result.image:<70}{result.source:>8}{result.transferred_bytes / 1024 ** 2:>10.1f}'
+                         f'{result.seconds:>9.1f}{status}')
+        return '\n'.join(lines)
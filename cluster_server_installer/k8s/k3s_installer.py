@@ -1,92 +1,222 @@
 import base64
+import dataclasses
+import io
 import json
 import logging
-import os
 import pathlib
 import random
+import re
+import shutil
 import string
-import platform
-import time
-from tempfile import TemporaryDirectory
-from typing import Final, Optional, Dict, List
+from typing import Final, Any, Optional, Dict, List, FrozenSet, Mapping, Tuple
 
-import requests
 from kubernetes import client
+from kubernetes.client.rest import ApiException
 import kubernetes
 
 from cluster_server_installer import LOGGER_NAME
-from cluster_server_installer.utilities.socket_utils import get_ethernet_ip
+from cluster_server_installer.certificates.lego_certificate_installer import LegoCertificateInstaller
+from cluster_server_installer.k8s.cluster_network import ClusterNetwork
+from cluster_server_installer.k8s.database_profile import DatabaseProfile
+from cluster_server_installer.k8s.image_prefetch import ImagePrefetcher, ImageReference, images_in_manifests, \
+    pin_images
+from cluster_server_installer.k8s.k3s_profile import K3sProfile
+from cluster_server_installer.k8s.manifest_applier import ManifestApplier
+from cluster_server_installer.k8s.manifest_reconciler import ManifestReconciler
+from cluster_server_installer.k8s.manifest_templates import ManifestTemplateSet
+from cluster_server_installer.k8s.storage_profile import StorageProfile
+from cluster_server_installer.k8s.readiness_gates import ReadinessGate, CrdEstablishedGate, DeploymentRolloutGate, \
+    DaemonSetRolloutGate, ServiceEndpointsGate, HelmChartJobGate, ReadinessTimeoutError, \
+    ReadinessFailedError, wait_for_gates
+from cluster_server_installer.utilities.artifact_cache import ArtifactCache, ArtifactSpec
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.host_facts import host_facts, invalidate_host_facts
+from cluster_server_installer.utilities.probes import default_probe_engine, HttpProbe, KubernetesApiProbe
+from cluster_server_installer.utilities.resources import resources
+from cluster_server_installer.utilities.tracing import tracer
 from cluster_server_installer.vpn.vpn_installer import VpnServerInstaller
 
 
 class K3sInstaller:
     K3S_MAX_STARTUP_TIME_IN_SECONDS: Final[int] = 600
+    K3S_VERIFICATION_TIME_IN_SECONDS: Final[int] = 30
     DASHBOARD_STARTUP_TIME_IN_SECONDS: Final[int] = 600
+    APT_TIMEOUT_IN_SECONDS: Final[int] = 15 * 60
+
+    HTTP_NOT_FOUND: Final[int] = 404
+    HTTP_CONFLICT: Final[int] = 409
 
     RELEVANT_CONFIG_FILE: Final[str] = '/etc/rancher/k3s/k3s.yaml'
-    DEPLOYMENTS: Final[List[pathlib.Path]] = [
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'loadbalancer' / 'metallb-deployment.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'loadbalancer' / 'metallb-config.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'traefik' / 'traefik-namespace.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'traefik' / 'traefik-helm.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'certificates' / 'cert-manager.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'certificates' / 'lets-encrypt.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'certificates' / 'traefik-middleware.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'dashboard' / 'rancher-namespace.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'dashboard' / 'rancher.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'storage' / 'nfs-provisioner-namespace.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'storage' / 'nfs-provisioner.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'database' / 'postgresql-deployment.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'ciy' / 'redis.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'ciy' / 'cluster-access-control.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'descheduler' / 'rbac.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'descheduler' / 'configmap.yaml',
-        pathlib.Path(__file__).parent.parent / 'resources' / 'deployments' / 'descheduler' / 'deployment.yaml',
+    K3S_VERSION: Final[str] = 'v1.27.9+k3s1'
+    K3S_BINARY_PATH: Final[pathlib.Path] = pathlib.Path('/usr/local/bin/k3s')
+    K3S_NODE_TOKEN_PATH: Final[pathlib.Path] = pathlib.Path('/var/lib/rancher/k3s/server/agent-token')
+    K3S_CONFIG_PATH: Final[pathlib.Path] = pathlib.Path('/etc/rancher/k3s/config.yaml')
+    K3S_VPN_AUTH_PATH: Final[pathlib.Path] = pathlib.Path('/etc/rancher/k3s/vpn-auth')
+    NFS_SHARE_PATH: Final[pathlib.Path] = pathlib.Path('/var/share-storage')
+    NFS_BULK_SHARE_PATH: Final[pathlib.Path] = pathlib.Path('/var/share-storage-bulk')
+    NFS_EXPORTS_PATH: Final[pathlib.Path] = pathlib.Path('/etc/exports')
+    NFS_CONF_PATH: Final[pathlib.Path] = pathlib.Path('/etc/nfs.conf.d/ciy-installer.conf')
+    LOCAL_PATH_STORAGE_PATH: Final[pathlib.Path] = pathlib.Path('/var/lib/rancher/k3s/storage')
+    STORAGE_BENCHMARK_SIZE_MIB: Final[int] = 64
+    STORAGE_BENCHMARK_FSYNCS: Final[int] = 200
+    CLUSTER_NETWORK: Final[ClusterNetwork] = ClusterNetwork()
+    # Resource names, resolved (and extracted from the bundled archive if need be) only when the manifests are applied
+    DEPLOYMENTS: Final[List[str]] = [
+        'deployments/loadbalancer/metallb-deployment.yaml',
+        'deployments/loadbalancer/metallb-config.yaml',
+        'deployments/traefik/traefik-namespace.yaml',
+        'deployments/traefik/traefik-helm.yaml',
+        'deployments/certificates/cert-manager.yaml',
+        'deployments/certificates/lets-encrypt.yaml',
+        'deployments/certificates/traefik-middleware.yaml',
+        'deployments/dashboard/rancher-namespace.yaml',
+        'deployments/dashboard/rancher.yaml',
+        'deployments/storage/nfs-provisioner-namespace.yaml',
+        'deployments/storage/nfs-provisioner.yaml',
+        'deployments/storage/nfs-provisioner-bulk.yaml',
+        'deployments/database/postgresql-deployment.yaml',
+        'deployments/ciy/redis.yaml',
+        'deployments/ciy/cluster-access-control.yaml',
+        'deployments/descheduler/rbac.yaml',
+        'deployments/descheduler/configmap.yaml',
+        'deployments/descheduler/deployment.yaml',
     ]
+    # The certificate lego issues for the server also covers the ingress hostnames, it is handed to them as these
+    # pre-provisioned secrets instead of each ingress running its own ACME order
+    TLS_SECRETS: Final[List[Tuple[str, str]]] = [('cloud-iy', 'cluster-access-tls'),
+                                                  ('cattle-system', 'tls-rancher-ingress')]
+    TEMPLATE_VARIABLES: Final[FrozenSet[str]] = frozenset(
+        {'EMAIL', 'DOMAIN', 'DASHBOARD_PASSWORD', 'REDIS_PASSWORD', 'HOST_NAME', 'HOST_IP', 'NFS_MOUNT_OPTIONS',
+         'DATABASE_STORAGE_CLASS', 'POSTGRES_RESOURCES', 'POSTGRES_ARGS', 'REDIS_RESOURCES', 'REDIS_ARGS'})
+    READINESS_GATES: Final[Dict[str, List[ReadinessGate]]] = {
+        'metallb-deployment.yaml': [
+            CrdEstablishedGate(['ipaddresspools.metallb.io', 'l2advertisements.metallb.io']),
+            DeploymentRolloutGate('cloud-iy', 'controller'),
+            # The speakers announce LoadBalancer IPs, until they run an assigned IP is not reachable
+            DaemonSetRolloutGate('cloud-iy', 'speaker'),
+            ServiceEndpointsGate('cloud-iy', 'webhook-service'),
+        ],
+        'traefik-helm.yaml': [
+            HelmChartJobGate('traefik', 'traefik'),
+            CrdEstablishedGate(['middlewares.traefik.containo.us']),
+        ],
+        'cert-manager.yaml': [
+            CrdEstablishedGate(['certificaterequests.cert-manager.io', 'certificates.cert-manager.io',
+                                'challenges.acme.cert-manager.io', 'clusterissuers.cert-manager.io',
+                                'issuers.cert-manager.io', 'orders.acme.cert-manager.io']),
+            DeploymentRolloutGate('cert-manager', 'cert-manager'),
+            DeploymentRolloutGate('cert-manager', 'cert-manager-cainjector'),
+            DeploymentRolloutGate('cert-manager', 'cert-manager-webhook'),
+            ServiceEndpointsGate('cert-manager', 'cert-manager-webhook'),
+        ],
+        'nfs-provisioner.yaml': [
+            HelmChartJobGate('nfs-provisioner', 'nfs-provisioner'),
+        ],
+        'nfs-provisioner-bulk.yaml': [
+            HelmChartJobGate('nfs-provisioner', 'nfs-provisioner-bulk'),
+        ],
+    }
+
+    @staticmethod
+    def load_manifest_templates() -> ManifestTemplateSet:
+        return ManifestTemplateSet([resources().path(name) for name in K3sInstaller.DEPLOYMENTS],
+                                   K3sInstaller.TEMPLATE_VARIABLES)
+
+    @staticmethod
+    def manifest_images() -> List[ImageReference]:
+        return images_in_manifests(resources().path(name).read_text() for name in K3sInstaller.DEPLOYMENTS)
+
+    @staticmethod
+    def prefetch_images(registry_url: str, access_key: str,
+                        image_archive: Optional[pathlib.Path] = None) -> Dict[str, str]:
+        # Pulled concurrently as soon as containerd is up instead of one by one as the kubelet meets each manifest,
+        # the digests returned pin the manifests to exactly what was prefetched
+        results = ImagePrefetcher(registry_url, access_key).prefetch(K3sInstaller.manifest_images(), image_archive)
+        return {result.image: result.digest for result in results if result.succeeded}
 
-    def __init__(self):
+    @staticmethod
+    def default_storage_profile(latency_backend: str = 'nfs') -> StorageProfile:
+        return StorageProfile.for_host(host_facts().capacity.cpu_count, K3sInstaller.NFS_SHARE_PATH,
+                                       K3sInstaller.NFS_BULK_SHARE_PATH, latency_backend)
+
+    @staticmethod
+    def default_database_profile(tier: str = 'auto', latency_backend: str = 'nfs',
+                                 overrides: Optional[Dict[str, Any]] = None) -> DatabaseProfile:
+        return DatabaseProfile.for_host(host_facts().capacity, tier, latency_backend).with_overrides(overrides or {})
+
+    def __init__(self, k3s_overrides: Optional[Dict[str, Any]] = None,
+                 storage_profile: Optional[StorageProfile] = None, nic_policy: str = 'default-route',
+                 database_profile: Optional[DatabaseProfile] = None):
         self._logger = logging.getLogger(LOGGER_NAME)
+        self._k3s_overrides = k3s_overrides or {}
+        self._storage_profile = storage_profile or K3sInstaller.default_storage_profile()
+        self._database_profile = database_profile or K3sInstaller.default_database_profile(
+            latency_backend=self._storage_profile.latency_backend)
         self._kube_client: Optional[kubernetes.client.CoreV1Api] = None
+        self._manifest_applier: Optional[ManifestApplier] = None
         self._preauth_key: Optional[str] = None
-        self._hostname = platform.node()
+        self._nic_policy = nic_policy
 
-    def check_if_kubernetes_installed_properly(self):
+    def check_if_kubernetes_installed_properly(
+            self, timeout_in_seconds: int = K3S_VERIFICATION_TIME_IN_SECONDS) -> bool:
         self._logger.info("Checking if k3s is installed properly...")
-        kubernetes_installed = os.system('kubectl --help') == 0
+        kubernetes_installed = shutil.which('kubectl') is not None and \
+            pathlib.Path(K3sInstaller.RELEVANT_CONFIG_FILE).exists()
         if not kubernetes_installed:
             self._logger.info("Kubectl not found... reinstalling")
             return False
 
-        kubernetes.config.load_kube_config(config_file=K3sInstaller.RELEVANT_CONFIG_FILE)
+        self._ensure_kube_clients()
         self._logger.info("Waiting for metrics-server...")
-        if not K3sInstaller.wait_for_metrics_server_to_start():
-            self._logger.error("Metrics-server failed to initialize... uninstalling")
-            os.system('/usr/local/bin/k3s-uninstall.sh')
-        return False
+        if not K3sInstaller.wait_for_metrics_server_to_start(timeout_in_seconds):
+            self._logger.warning("Metrics-server did not respond... k3s will be reinstalled")
+            return False
+        return True
 
     @staticmethod
-    def wait_for_metrics_server_to_start():
-        start = time.time()
+    def check_if_nfs_server_is_installed() -> bool:
+        exports = K3sInstaller.NFS_EXPORTS_PATH
+        return host_facts().unit_active('nfs-kernel-server') and exports.exists() and \
+            all(str(path) in exports.read_text() for path in (K3sInstaller.NFS_SHARE_PATH,
+                                                               K3sInstaller.NFS_BULK_SHARE_PATH))
+
+    def benchmark_storage(self) -> List[Dict[str, Any]]:
+        from cluster_server_installer.benchmarks.storage_benchmark import format_report, run_benchmark
+
+        profile = self._storage_profile
+        with tracer().span('storage-benchmark', 'install') as span:
+            results = run_benchmark({export.storage_class: export.path for export in profile.exports},
+                                    K3sInstaller.STORAGE_BENCHMARK_SIZE_MIB, K3sInstaller.STORAGE_BENCHMARK_FSYNCS,
+                                    profile.mount_options)
+            if profile.latency_backend == 'local-path':
+                K3sInstaller.LOCAL_PATH_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
+                results += run_benchmark({'local-path': K3sInstaller.LOCAL_PATH_STORAGE_PATH},
+                                         K3sInstaller.STORAGE_BENCHMARK_SIZE_MIB,
+                                         K3sInstaller.STORAGE_BENCHMARK_FSYNCS)
+            span.set(**{f'{result.target}_fsync_p99_ms': round(result.fsync_p99_ms, 3) for result in results})
+        self._logger.info(f"Storage benchmark:\n{format_report(results)}")
+        return [dataclasses.asdict(result) for result in results]
+
+    @staticmethod
+    def wait_for_metrics_server_to_start(timeout_in_seconds: int = K3S_MAX_STARTUP_TIME_IN_SECONDS) -> bool:
         custom_object_api = client.CustomObjectsApi()
-        while time.time() - start < K3sInstaller.K3S_MAX_STARTUP_TIME_IN_SECONDS:
-            try:
-                custom_object_api.list_cluster_custom_object('metrics.k8s.io', 'v1beta1', 'pods')
-                return True
-            except Exception as e:
-                time.sleep(0.5)
-                pass
-        return False
+        return default_probe_engine().wait(KubernetesApiProbe(
+            'metrics-server', lambda: custom_object_api.list_cluster_custom_object('metrics.k8s.io', 'v1beta1', 'pods')),
+            timeout_in_seconds).ready
 
     def install_kubernetes(self, host_url: str, email: str, registry_url: str, access_key: str):
         self._logger.info("Verifiying k3s installation...")
         if not self.check_if_kubernetes_installed_properly():
             self._logger.info("Installing nfs storage provider...")
-            if not self._install_nfs_server():
+            if not self.install_nfs_server():
                 self._logger.error("NFS installation failed...")
                 return
 
             self._logger.info("Installing k3s...")
-            if not self._install_kube_env(host_url):
+            if not self.install_kube_env(host_url, api_key=VpnServerInstaller.get_api_key(),
+                                         preauth_key=VpnServerInstaller.get_headscale_preauthkey(),
+                                         k3s_artifacts=K3sInstaller.download_k3s(ArtifactCache())):
                 self._logger.error("K3s installation failed...")
                 return
 
@@ -94,49 +224,163 @@ class K3sInstaller:
                 self._logger.error("K3s installation failed... failed to create cloud-iy pull permissions")
                 return
 
-            if not self._install_deployments(email=email, domain=host_url):
+            if not self.apply_tls_secrets(host_url):
+                self._logger.error("K3s installation failed... failed to provision TLS secrets")
+                return
+
+            if not self.install_deployments(email=email, domain=host_url,
+                                            credentials=K3sInstaller.generate_credentials()):
                 self._logger.error("K3s installation failed... failed to deploy pre-requisites")
                 return
         self._logger.info("K3S installed properly")
 
+    def install_nfs_server(self) -> bool:
+        runner = command_runner()
+        apt_env = {'DEBIAN_FRONTEND': 'noninteractive'}
+        # Re-runs only rewrite the exports, refreshing the package index is the slowest part of the step
+        if host_facts().package_version('nfs-kernel-server') is None:
+            installation_status = True
+            installation_status &= runner.run(['apt-get', 'update'], env=apt_env,
+                                              timeout_in_seconds=K3sInstaller.APT_TIMEOUT_IN_SECONDS).succeeded
+            installation_status &= runner.run(['apt-get', 'install', '-y', 'nfs-kernel-server'], env=apt_env,
+                                              timeout_in_seconds=K3sInstaller.APT_TIMEOUT_IN_SECONDS).succeeded
+            invalidate_host_facts()
+            if not installation_status:
+                return False
+
+        profile = self._storage_profile
+        for export in profile.exports:
+            export.path.mkdir(exist_ok=True)
+            export.path.chmod(0o777)
+        deployer = ArtifactDeployer()
+        deployer.deploy_stream(io.BytesIO(profile.exports_file().encode('utf-8')), K3sInstaller.NFS_EXPORTS_PATH,
+                               mode=0o644)
+        # nfsd only picks its thread count up on start
+        deployer.deploy_stream(io.BytesIO(profile.nfs_conf().encode('utf-8')), K3sInstaller.NFS_CONF_PATH,
+                               mode=0o644)
+        self._logger.info(f"NFS storage profile: {profile.nfsd_threads} nfsd threads, exports:\n"
+                          f"{profile.exports_file()}")
+        status = runner.run(['systemctl', 'restart', 'nfs-kernel-server.service']).succeeded
+        invalidate_host_facts()
+        return status and runner.run(['exportfs', '-ra']).succeeded
+
+    @staticmethod
+    def k3s_artifacts() -> List[ArtifactSpec]:
+        quoted_version = K3sInstaller.K3S_VERSION.replace('+', '%2B')
+        return [
+            ArtifactSpec(name='k3s-install', version=K3sInstaller.K3S_VERSION, suffix='.sh',
+                         url=f'https://raw.githubusercontent.com/k3s-io/k3s/{quoted_version}/install.sh'),
+            ArtifactSpec(name='k3s', version=K3sInstaller.K3S_VERSION,
+                         url=f'https://github.com/k3s-io/k3s/releases/download/{quoted_version}/k3s'),
+        ]
+
     @staticmethod
-    def _install_nfs_server():
-        installation_status = True
-        installation_status &= os.system('apt-get update') == 0
-        installation_status &= os.system('apt install nfs-kernel-server -y') == 0
-        installation_status &= os.system('systemctl start nfs-kernel-server.service') == 0
-        pathlib.Path('/var/share-storage').mkdir(exist_ok=True)
-        os.system('chmod 777 /var/share-storage')
-        pathlib.Path('/etc/exports').write_text(f'/var/share-storage *(rw,sync,no_subtree_check,no_root_squash)')
-        os.system('chmod 777 /etc/exports')
-        return installation_status and os.system('exportfs -a') == 0
-
-    def install_k3s(self, host_url: str) -> bool:
-        os.system('tailscale down')
-        external_ip = get_ethernet_ip()
-        return os.system(
-            f'curl -sfL https://get.k3s.io | K3S_URL=https://{host_url}:6443 INSTALL_K3S_VERSION=v1.27.9+k3s1 INSTALL_K3S_EXEC="server --disable=servicelb,traefik,local-storage --disable-scheduler --node-label ciy.persistent_node=True --node-external-ip={external_ip} --flannel-external-ip --cluster-cidr=10.42.0.0/16 --service-cidr=10.43.0.0/16 --vpn-auth="name=tailscale,joinKey={VpnServerInstaller.get_headscale_preauthkey()},controlServerURL=https://{host_url}:{VpnServerInstaller.VPN_PORT}"" sh -s -') == 0
+    def download_k3s(artifact_cache: ArtifactCache) -> Dict[str, str]:
+        script_spec, binary_spec = K3sInstaller.k3s_artifacts()
+        paths = artifact_cache.prefetch([script_spec, binary_spec])
+        return {'script': str(paths[script_spec.key]), 'binary': str(paths[binary_spec.key])}
+
+    def install_k3s(self, host_url: str, preauth_key: str, k3s_artifacts: Dict[str, str]) -> bool:
+        runner = command_runner()
+        runner.run(['tailscale', 'down'])
+        external_ip = host_facts().primary_ip(self._nic_policy)
+        # Written beside and renamed over the binary a running k3s may be executing from (ETXTBSY otherwise)
+        ArtifactDeployer().deploy_file(pathlib.Path(k3s_artifacts['binary']), K3sInstaller.K3S_BINARY_PATH, mode=0o755)
+        profile = K3sProfile.for_host(host_facts().capacity, K3sInstaller.CLUSTER_NETWORK).with_overrides(
+            self._storage_profile.k3s_overrides()).with_overrides(self._k3s_overrides)
+        self._logger.info(f"K3s server profile:\n{profile.dump()}")
+
+        # Kept in its own root-only file so the join key shows up neither in the config nor in the unit's environment
+        vpn_auth = f'name=tailscale,joinKey={preauth_key},' \
+                   f'controlServerURL=https://{host_url}:{VpnServerInstaller.VPN_PORT}'
+        ArtifactDeployer().deploy_stream(io.BytesIO(vpn_auth.encode('utf-8')), K3sInstaller.K3S_VPN_AUTH_PATH,
+                                         mode=0o600)
+        profile.save(K3sInstaller.K3S_CONFIG_PATH, {'node-external-ip': external_ip, 'flannel-external-ip': True,
+                                                    'vpn-auth-file': str(K3sInstaller.K3S_VPN_AUTH_PATH)})
+        env = {'INSTALL_K3S_SKIP_DOWNLOAD': 'true', 'INSTALL_K3S_VERSION': K3sInstaller.K3S_VERSION,
+               'INSTALL_K3S_EXEC': 'server'}
+        if not profile.embedded_etcd:
+            # With cluster-init a server URL means joining an etcd cluster, this one would try to join itself
+            env['K3S_URL'] = f'https://{host_url}:6443'
+        return runner.run(['sh', k3s_artifacts['script']],
+                          timeout_in_seconds=K3sInstaller.K3S_MAX_STARTUP_TIME_IN_SECONDS, env=env,
+                          secrets=[preauth_key]).succeeded
+
+    def _ensure_kube_clients(self):
+        if self._kube_client is None:
+            self._load_kube_clients()
+
+    def _load_kube_clients(self):
+        configuration = client.Configuration()
+        kubernetes.config.load_kube_config(config_file=K3sInstaller.RELEVANT_CONFIG_FILE,
+                                           client_configuration=configuration)
+        # One pooled connection set shared by the core client, readiness watches and concurrent applies
+        configuration.connection_pool_maxsize = ManifestApplier.DEFAULT_MAX_WORKERS
+        client.Configuration.set_default(configuration)
+        api_client = client.ApiClient(configuration)
+        self._kube_client = client.CoreV1Api(api_client)
+        self._manifest_applier = ManifestApplier(api_client)
 
     def _create_namespaced_secret(self, secret_name: str, namespace: str, fields: Dict[str, str]):
-        self._kube_client.create_namespaced_secret(
-            namespace=namespace,
-            body=client.V1Secret(
+        self._apply_namespaced_secret(namespace=namespace, body=client.V1Secret(
+            api_version='v1',
+            metadata=client.V1ObjectMeta(name=secret_name),
+            type='Opaque',
+            data=fields
+        ))
+
+    def _apply_namespaced_secret(self, namespace: str, body: client.V1Secret):
+        try:
+            self._kube_client.create_namespaced_secret(namespace=namespace, body=body)
+        except ApiException as e:
+            if e.status != K3sInstaller.HTTP_CONFLICT:
+                raise
+            self._kube_client.replace_namespaced_secret(name=body.metadata.name, namespace=namespace, body=body)
+
+    def _ensure_namespace(self, namespace: str):
+        try:
+            self._kube_client.create_namespace(body=client.V1Namespace(metadata=client.V1ObjectMeta(name=namespace)))
+        except ApiException as e:
+            if e.status != K3sInstaller.HTTP_CONFLICT:
+                raise
+
+    def apply_tls_secrets(self, domain: str) -> bool:
+        cert_path, key_path = LegoCertificateInstaller.certificate_paths(domain)
+        if not cert_path.exists() or not key_path.exists():
+            self._logger.error(f"No certificate for {domain} under {cert_path.parent}")
+            return False
+
+        self._ensure_kube_clients()
+        data = {'tls.crt': base64.b64encode(cert_path.read_bytes()).decode('utf-8'),
+                'tls.key': base64.b64encode(key_path.read_bytes()).decode('utf-8')}
+        for namespace, secret_name in K3sInstaller.TLS_SECRETS:
+            self._ensure_namespace(namespace)
+            self._apply_namespaced_secret(namespace=namespace, body=client.V1Secret(
                 api_version='v1',
                 metadata=client.V1ObjectMeta(name=secret_name),
-                type='Opaque',
-                data=fields
-            )
-        )
+                type='kubernetes.io/tls',
+                data=data
+            ))
+        return True
+
+    def check_if_secret_exists(self, namespace: str, secret_name: str) -> bool:
+        self._ensure_kube_clients()
+        try:
+            self._kube_client.read_namespaced_secret(name=secret_name, namespace=namespace)
+            return True
+        except ApiException as e:
+            if e.status == K3sInstaller.HTTP_NOT_FOUND:
+                return False
+            raise
 
     @staticmethod
     def get_k3s_node_token() -> str:
-        return pathlib.Path('/var/lib/rancher/k3s/server/agent-token').read_text().replace("\n", "")
+        return K3sInstaller.K3S_NODE_TOKEN_PATH.read_text().replace("\n", "")
 
-    def _install_kube_env(self, host_url: str) -> bool:
-        self._preauth_key = VpnServerInstaller.get_api_key()
-        if self.install_k3s(host_url) and os.system('kubectl --help') == 0:
-            kubernetes.config.load_kube_config(config_file=K3sInstaller.RELEVANT_CONFIG_FILE)
-            self._kube_client = kubernetes.client.CoreV1Api()
+    def install_kube_env(self, host_url: str, api_key: str, preauth_key: str, k3s_artifacts: Dict[str, str]) -> bool:
+        self._preauth_key = api_key
+        if self.install_k3s(host_url, preauth_key, k3s_artifacts) and shutil.which('kubectl') is not None:
+            self._load_kube_clients()
             try:
                 self._kube_client.create_namespace(
                     body=client.V1Namespace(metadata=client.V1ObjectMeta(name="cloud-iy"))
@@ -171,7 +415,8 @@ class K3sInstaller:
             }
         }
 
-        self._kube_client.create_namespaced_secret(
+        self._ensure_kube_clients()
+        self._apply_namespaced_secret(
             namespace='cloud-iy',
             body=client.V1Secret(
                 metadata=client.V1ObjectMeta(name='cloud-iy-credentials'),
@@ -184,25 +429,65 @@ class K3sInstaller:
 
     @staticmethod
     def wait_for_dashboard_to_respond(domain: str, timeout_in_seconds: int) -> bool:
-        start_time = time.time()
-        while time.time() - start_time < timeout_in_seconds:
-            try:
-                resp = requests.get(f"https://dashboard.{domain}")
-                if resp.status_code != 404:
-                    return True
-            except Exception:
-                pass
-            time.sleep(1)
-        return False
+        return default_probe_engine().wait(HttpProbe(
+            'dashboard', f"https://dashboard.{domain}", is_ready=lambda response: response.status_code != 404),
+            timeout_in_seconds).ready
+
+    @staticmethod
+    def generate_credentials() -> Dict[str, str]:
+        return {
+            'dashboard-password': ''.join(random.choices(string.ascii_uppercase + string.digits, k=16)),
+            'redis-password': ''.join(random.choices(string.ascii_uppercase + string.digits, k=16)),
+            'postgres-user': ''.join(random.choices(string.ascii_uppercase + string.digits, k=8)),
+            'postgres-password': ''.join(random.choices(string.ascii_uppercase + string.digits, k=16)),
+        }
+
+    def read_credentials(self) -> Dict[str, str]:
+        # The credentials an earlier install generated, as the cluster holds them
+        self._ensure_kube_clients()
+
+        def decode(value: str) -> str:
+            return base64.b64decode(value).decode('utf-8')
+
+        redis = self._kube_client.read_namespaced_secret('redis-pwd', 'cloud-iy').data
+        postgres = self._kube_client.read_namespaced_secret('metrics-postgres-details', 'cloud-iy').data
+        rancher = client.CustomObjectsApi(self._kube_client.api_client).get_namespaced_custom_object(
+            'helm.cattle.io', 'v1', 'cattle-system', 'helmcharts', 'rancher')
+        bootstrap_password = re.search(r'^\s*bootstrapPassword: (\S+)\s*$', rancher['spec']['valuesContent'],
+                                       re.MULTILINE)
+        if bootstrap_password is None:
+            raise ValueError('The rancher HelmChart has no bootstrapPassword')
+        return {
+            'dashboard-password': bootstrap_password.group(1),
+            'redis-password': decode(redis['redis-pwd']),
+            'postgres-user': decode(postgres['user']),
+            'postgres-password': decode(postgres['pwd']),
+        }
+
+    def template_values(self, email: str, domain: str, credentials: Dict[str, str]) -> Dict[str, str]:
+        return {
+            'EMAIL': email,
+            'DOMAIN': domain,
+            'DASHBOARD_PASSWORD': credentials['dashboard-password'],
+            'REDIS_PASSWORD': credentials['redis-password'],
+            'HOST_NAME': host_facts().hostname,
+            'HOST_IP': host_facts().primary_ip(self._nic_policy),
+            **self._storage_profile.template_values(),
+            **self._database_profile.template_values(),
+        }
 
-    def _install_deployments(self, email: str, domain: str) -> bool:
-        dashboard_initial_pwd = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
-        redis_pwd = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
+    def install_deployments(self, email: str, domain: str, credentials: Dict[str, str],
+                            image_digests: Optional[Mapping[str, str]] = None) -> bool:
+        self._ensure_kube_clients()
+        dashboard_initial_pwd = credentials['dashboard-password']
+        redis_pwd = credentials['redis-password']
 
-        postgres_user = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        postgres_pwd = ''.join(random.choices(string.ascii_uppercase + string.digits, k=16))
+        postgres_user = credentials['postgres-user']
+        postgres_pwd = credentials['postgres-password']
 
-        external_ip = get_ethernet_ip()
+        rendered_manifests = K3sInstaller.load_manifest_templates().render(
+            self.template_values(email, domain, credentials))
+        self._logger.info(f"Database profile:\n{self._database_profile.dump()}")
 
         self._create_namespaced_secret(secret_name='redis-pwd', namespace='cloud-iy', fields={
             'redis-pwd': base64.b64encode(redis_pwd.encode('utf-8')).decode('utf-8')
@@ -213,29 +498,65 @@ class K3sInstaller:
             'pwd': base64.b64encode(postgres_pwd.encode('utf-8')).decode('utf-8'),
         })
 
-        with TemporaryDirectory() as tmp_dir:
-            tmp_dir_path = pathlib.Path(tmp_dir)
-            for deployment in K3sInstaller.DEPLOYMENTS:
-                tmp_file_name = tmp_dir_path / deployment.name
-                tmp_file_name.write_text(
-                    deployment.read_text().replace('${EMAIL}', email).replace('${DOMAIN}', domain).replace(
-                        '${DASHBOARD_PASSWORD}', dashboard_initial_pwd).replace('${REDIS_PASSWORD}', redis_pwd).replace(
-                        '${HOST_NAME}', self._hostname).replace('${HOST_IP}', external_ip))
-
-                if os.system(f'kubectl apply -f {str(tmp_file_name.absolute())}') != 0:
-                    logging.exception(f"Failed to install {deployment}")
-                    return False
-
-                if 'cert-manager.yaml' in deployment.name:
-                    print("Waiting for cert manager to come up...")
-                    time.sleep(45)
-
-                elif 'metallb-deployment.yaml' in deployment.name:
-                    print("Waiting for metal-lb to come up...")
-                    time.sleep(20)
+        for template, manifest in rendered_manifests:
+            manifest = pin_images(manifest, image_digests or {})
+            with tracer().span(template.name, 'manifest-apply', bytes=len(manifest)) as span:
+                results = self._manifest_applier.apply_manifest(manifest)
+                failures = [result for result in results if not result.succeeded]
+                span.set(objects=len(results), failures=len(failures))
+            if failures:
+                for failure in failures:
+                    self._logger.error(f"Failed to install {template.name}: {failure}")
+                return False
 
+            gates = K3sInstaller.READINESS_GATES.get(template.name, [])
+            if gates:
+                self._logger.info(f"Waiting for {template.name} to become ready...")
+                try:
+                    with tracer().span(template.name, 'readiness', gates=len(gates)):
+                        wait_for_gates(gates, self._kube_client.api_client, self._logger)
+                except (ReadinessTimeoutError, ReadinessFailedError) as e:
+                    self._logger.error(f"{template.name} did not become ready: {e}")
+                    return False
 
         if K3sInstaller.wait_for_dashboard_to_respond(domain, K3sInstaller.DASHBOARD_STARTUP_TIME_IN_SECONDS):
             print(f"Dashboard initial password: {dashboard_initial_pwd}")
             return True
         return False
+
+    def reconcile_deployments(self, email: str, domain: str, dry_run: bool = False) -> bool:
+        # Renders the manifests exactly as the install did, with the credentials and image pins already in place,
+        # and applies only the objects that differ from the cluster
+        self._ensure_kube_clients()
+        try:
+            credentials = self.read_credentials()
+        except (ApiException, ValueError, KeyError) as e:
+            self._logger.error(f"Could not read the installed credentials, was the cluster installed? {e}")
+            return False
+        image_digests = {image: digest for image, (digest, _) in ImagePrefetcher().list_images().items()}
+        manifests = [(template.name, pin_images(manifest, image_digests)) for template, manifest in
+                     K3sInstaller.load_manifest_templates().render(self.template_values(email, domain, credentials))]
+
+        reconciler = ManifestReconciler(self._manifest_applier)
+        with tracer().span('reconcile-plan', 'reconcile', manifests=len(manifests)) as span:
+            plan = reconciler.plan(manifests)
+            span.set(objects=plan.objects, drifted=len(plan.drifts))
+        self._logger.info(plan.format())
+        if dry_run or not plan.drifts:
+            return True
+
+        with tracer().span('reconcile-apply', 'reconcile', objects=len(plan.drifts)):
+            failures = [result for result in reconciler.apply(plan) if not result.succeeded]
+        for failure in failures:
+            self._logger.error(f"Failed to reconcile {failure}")
+        if failures:
+            return False
+
+        gates = [gate for manifest in plan.manifests for gate in K3sInstaller.READINESS_GATES.get(manifest, [])]
+        try:
+            with tracer().span('reconcile', 'readiness', gates=len(gates)):
+                wait_for_gates(gates, self._kube_client.api_client, self._logger)
+        except (ReadinessTimeoutError, ReadinessFailedError) as e:
+            self._logger.error(f"Reconciled objects did not become ready: {e}")
+            return False
+        return True
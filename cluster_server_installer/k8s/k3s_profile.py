@@ -0,0 +1,104 @@
+import io
+import pathlib
+from typing import Final, Any, Dict, Mapping, Sequence, Tuple
+
+import yaml
+
+from cluster_server_installer.k8s.cluster_network import ClusterNetwork
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+from cluster_server_installer.utilities.host_facts import HostCapacity
+
+
+def _clamp(value: int, low: int, high: int) -> int:
+    return max(low, min(high, value))
+
+
+class K3sProfile:
+    SMALL_DISK_GIB: Final[int] = 64
+    # A node gets a /24 out of the cluster CIDR, so it cannot run more pods than that has addresses
+    MAX_PODS_LIMIT: Final[int] = 250
+    DEFAULT_MAX_PODS: Final[int] = 110
+    FLANNEL_BACKEND: Final[str] = 'vxlan'
+    DISABLED_COMPONENTS: Final[Tuple[str, ...]] = ('servicelb', 'traefik', 'local-storage')
+    # Keys of the k3s config file whose values are lists of kubernetes component 'flag=value' arguments
+    COMPONENT_ARGUMENT_KEYS: Final[Tuple[str, ...]] = ('kube-apiserver-arg', 'kube-controller-manager-arg',
+                                                        'kubelet-arg')
+
+    def __init__(self, settings: Dict[str, Any]):
+        self._settings = settings
+
+    @staticmethod
+    def for_host(capacity: HostCapacity, network: ClusterNetwork = ClusterNetwork()) -> 'K3sProfile':
+        cpus = capacity.cpu_count
+        max_inflight = _clamp(100 * cpus, 400, 3200)
+        controller_qps = _clamp(10 * cpus, 20, 200)
+        max_pods = _clamp(int(capacity.memory_gib * 16), K3sProfile.DEFAULT_MAX_PODS, K3sProfile.MAX_PODS_LIMIT)
+        memory_reserve_mib = max(100, int(capacity.memory_bytes * 0.05 / 1024 ** 2))
+        small_disk = capacity.disk_gib < K3sProfile.SMALL_DISK_GIB
+
+        settings: Dict[str, Any] = {
+            'disable': list(K3sProfile.DISABLED_COMPONENTS),
+            'disable-scheduler': True,
+            'node-label': ['ciy.persistent_node=True'],
+            'flannel-backend': K3sProfile.FLANNEL_BACKEND,
+            'cluster-cidr': network.cluster_cidr,
+            'service-cidr': network.service_cidr,
+            'kube-apiserver-arg': [f'max-requests-inflight={max_inflight}',
+                                   f'max-mutating-requests-inflight={max_inflight // 2}'],
+            'kube-controller-manager-arg': [f'kube-api-qps={controller_qps}',
+                                            f'kube-api-burst={controller_qps * 2}'],
+            'kubelet-arg': [f'max-pods={max_pods}',
+                            f'eviction-hard=memory.available<{memory_reserve_mib}Mi,nodefs.available<10%,'
+                            f'imagefs.available<15%',
+                            # Small disks start collecting unused images earlier, before eviction kicks in
+                            f'image-gc-high-threshold={75 if small_disk else 85}',
+                            f'image-gc-low-threshold={60 if small_disk else 70}'],
+        }
+        # The datastore stays the default SQLite (kine). Embedded etcd is opt-in (--k3s-set cluster-init=true), k3s
+        # would otherwise migrate an existing cluster's datastore on a re-install
+        return K3sProfile(settings)
+
+    @staticmethod
+    def parse_override(text: str) -> Tuple[str, Any]:
+        key, separator, value = text.partition('=')
+        if not separator or not key:
+            raise ValueError(f"Overrides look like key=value, got {text!r}")
+        return key.strip(), yaml.safe_load(value)
+
+    def with_overrides(self, overrides: Mapping[str, Any]) -> 'K3sProfile':
+        # 'key=value' sets a config key, 'kubelet-arg.max-pods=200' one flag inside a component argument list,
+        # a null value removes the key or flag
+        settings = {key: list(value) if isinstance(value, list) else value for key, value in self._settings.items()}
+        for key, value in overrides.items():
+            component, _, flag = key.partition('.')
+            if flag and component in K3sProfile.COMPONENT_ARGUMENT_KEYS:
+                arguments = [argument for argument in settings.get(component, [])
+                             if not argument.startswith(f'{flag}=')]
+                if value is not None:
+                    arguments.append(f'{flag}={value}')
+                settings[component] = arguments
+            elif value is None:
+                settings.pop(key, None)
+            else:
+                settings[key] = value
+        return K3sProfile(settings)
+
+    @property
+    def embedded_etcd(self) -> bool:
+        return bool(self._settings.get('cluster-init'))
+
+    def settings(self) -> Dict[str, Any]:
+        return dict(self._settings)
+
+    def dump(self) -> str:
+        return yaml.safe_dump(self._settings, default_flow_style=False, sort_keys=False)
+
+    def save(self, path: pathlib.Path, node_settings: Mapping[str, Any]) -> bool:
+        # Node specific values (addresses, VPN credentials file) are added here only, so the previewed profile is
+        # the same for identically sized hosts
+        document = yaml.safe_dump({**self._settings, **node_settings}, default_flow_style=False, sort_keys=False)
+        return ArtifactDeployer().deploy_stream(io.BytesIO(document.encode('utf-8')), path, mode=0o600).replaced
+
+
+def parse_overrides(texts: Sequence[str]) -> Dict[str, Any]:
+    return dict(K3sProfile.parse_override(text) for text in texts)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Final, Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import yaml
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from kubernetes.dynamic import DynamicClient
+from kubernetes.dynamic.exceptions import ResourceNotFoundError, DynamicApiError
+
+from cluster_server_installer import LOGGER_NAME
+
+
+@dataclass(frozen=True)
+class ApplyResult:
+    api_version: str
+    kind: str
+    namespace: Optional[str]
+    name: str
+    error: Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+    def __str__(self) -> str:
+        location = f'{self.namespace}/{self.name}' if self.namespace else self.name
+        status = 'applied' if self.succeeded else f'failed: {self.error}'
+        return f'{self.kind} {location} {status}'
+
+
+class ManifestApplier:
+    FIELD_MANAGER: Final[str] = 'ciy-installer'
+    # Hash of the manifest an object was last applied from, a reconcile compares it to spot changed manifests
+    APPLIED_HASH_ANNOTATION: Final[str] = 'ciy-installer/applied-hash'
+    DEFAULT_MAX_WORKERS: Final[int] = 8
+    # Objects in an earlier tier are applied (concurrently) before any object of a later tier is sent.
+    # Kinds not listed here go into DEFAULT_TIER.
+    KIND_TIERS: Final[Dict[str, int]] = {
+        'Namespace': 0, 'CustomResourceDefinition': 0, 'PriorityClass': 0, 'StorageClass': 0,
+        'ServiceAccount': 1, 'Secret': 1, 'ConfigMap': 1, 'PersistentVolume': 1, 'PersistentVolumeClaim': 1,
+        'ClusterRole': 1, 'Role': 1, 'ClusterRoleBinding': 1, 'RoleBinding': 1, 'Service': 1,
+        'LimitRange': 1, 'ResourceQuota': 1,
+        'MutatingWebhookConfiguration': 3, 'ValidatingWebhookConfiguration': 3, 'APIService': 3,
+    }
+    DEFAULT_TIER: Final[int] = 2
+
+    def __init__(self, api_client: client.ApiClient, max_workers: int = DEFAULT_MAX_WORKERS):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._dynamic_client = DynamicClient(api_client)
+        self._max_workers = max_workers
+
+    @staticmethod
+    def load_documents(manifest: str) -> List[Dict[str, Any]]:
+        return [document for document in yaml.safe_load_all(manifest) if document]
+
+    @staticmethod
+    def applied_hash(document: Dict[str, Any]) -> str:
+        metadata = document.get('metadata') or {}
+        annotations = {key: value for key, value in (metadata.get('annotations') or {}).items()
+                       if key != ManifestApplier.APPLIED_HASH_ANNOTATION}
+        canonical = {**document, 'metadata': {**metadata, 'annotations': annotations}}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def with_applied_hash(document: Dict[str, Any]) -> Dict[str, Any]:
+        metadata = document.get('metadata') or {}
+        annotations = {**(metadata.get('annotations') or {}),
+                       ManifestApplier.APPLIED_HASH_ANNOTATION: ManifestApplier.applied_hash(document)}
+        return {**document, 'metadata': {**metadata, 'annotations': annotations}}
+
+    def apply_manifest(self, manifest: str) -> List[ApplyResult]:
+        return self.apply_documents(ManifestApplier.load_documents(manifest))
+
+    def apply_documents(self, documents: Iterable[Dict[str, Any]]) -> List[ApplyResult]:
+        tiers: Dict[int, List[Dict[str, Any]]] = {}
+        for document in documents:
+            tiers.setdefault(ManifestApplier.KIND_TIERS.get(document['kind'], ManifestApplier.DEFAULT_TIER),
+                             []).append(ManifestApplier.with_applied_hash(document))
+
+        results: List[ApplyResult] = []
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='manifest-apply') as executor:
+            for tier in sorted(tiers):
+                # Discovery lookups are resolved on this thread so the shared discovery cache is never filled
+                # concurrently, only the apply requests themselves fan out
+                resolved = [self._resolve(document) for document in tiers[tier]]
+                results.extend(executor.map(self._apply_resolved, resolved))
+        return results
+
+    def list_live_objects(self, documents: Sequence[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+        # One list call per kind and namespace instead of a GET per object, returned in the order of the documents.
+        # None for objects that do not exist, including those of kinds the server does not serve (yet)
+        groups: Dict[Tuple[str, str, Optional[str]], Any] = {}
+        keys: List[Optional[Tuple[str, str, Optional[str]]]] = []
+        for document in documents:
+            resource = self._resolve(document)[1]
+            if resource is None:
+                keys.append(None)
+                continue
+            namespace = (document.get('metadata') or {}).get('namespace', 'default') if resource.namespaced else None
+            key = (document['apiVersion'], document['kind'], namespace)
+            groups[key] = resource
+            keys.append(key)
+
+        def list_group(group: Tuple[Tuple[str, str, Optional[str]], Any]) -> Dict[str, Dict[str, Any]]:
+            (_, _, namespace), resource = group
+            listed = self._dynamic_client.get(resource, namespace=namespace).to_dict()
+            return {item['metadata']['name']: item for item in listed.get('items') or []}
+
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='manifest-list') as executor:
+            live = dict(zip(groups, executor.map(list_group, groups.items())))
+        return [None if key is None else live[key].get((document.get('metadata') or {}).get('name'))
+                for key, document in zip(keys, documents)]
+
+    def _resolve(self, document: Dict[str, Any]) -> Tuple[Dict[str, Any], Any, Optional[str]]:
+        try:
+            resource = self._lookup(document['apiVersion'], document['kind'])
+        except ResourceNotFoundError as e:
+            return document, None, str(e)
+        return document, resource, None
+
+    def _lookup(self, api_version: str, kind: str) -> Any:
+        try:
+            return self._dynamic_client.resources.get(api_version=api_version, kind=kind)
+        except ResourceNotFoundError:
+            # The kind may belong to a CRD created after discovery was cached
+            self._dynamic_client.resources.invalidate_cache()
+            return self._dynamic_client.resources.get(api_version=api_version, kind=kind)
+
+    def _apply_resolved(self, resolved: Tuple[Dict[str, Any], Any, Optional[str]]) -> ApplyResult:
+        document, resource, lookup_error = resolved
+        metadata = document.get('metadata', {})
+        namespace = None
+        if resource is not None and resource.namespaced:
+            namespace = metadata.get('namespace', 'default')
+
+        result = ApplyResult(api_version=document['apiVersion'], kind=document['kind'], namespace=namespace,
+                             name=metadata.get('name', ''), error=lookup_error)
+        if resource is None:
+            return result
+
+        try:
+            self._dynamic_client.server_side_apply(resource, body=document, namespace=namespace,
+                                                   field_manager=ManifestApplier.FIELD_MANAGER,
+                                                   force_conflicts=True)
+        except (ApiException, DynamicApiError) as e:
+            return ApplyResult(api_version=result.api_version, kind=result.kind, namespace=result.namespace,
+                               name=result.name, error=ManifestApplier._error_message(e))
+        return result
+
+    @staticmethod
+    def _error_message(error: Exception) -> str:
+        body = getattr(error, 'body', None)
+        try:
+            return json.loads(body)['message']
+        except (TypeError, ValueError, KeyError):
+            return str(error)
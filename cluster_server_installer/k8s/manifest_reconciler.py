@@ -0,0 +1,104 @@
+import base64
+from dataclasses import dataclass, field
+from typing import Final, Any, Dict, Iterable, List, Optional, Tuple
+
+from cluster_server_installer.k8s.manifest_applier import ApplyResult, ManifestApplier
+
+MAX_LISTED_DIFFERENCES: Final[int] = 4
+
+
+def semantic_differences(desired: Any, live: Any, path: str = '') -> List[str]:
+    # Paths where the live object does not match the manifest. Fields only the live object has (defaults, status,
+    # values other controllers fill in) are not differences
+    if isinstance(desired, dict):
+        if not isinstance(live, dict):
+            return [path or '.']
+        differences = []
+        for key, value in desired.items():
+            differences += semantic_differences(value, live.get(key), f'{path}.{key}' if path else key)
+        return differences
+    if isinstance(desired, list):
+        if not isinstance(live, list) or len(live) != len(desired):
+            return [path]
+        return [difference for index, (desired_item, live_item) in enumerate(zip(desired, live))
+                for difference in semantic_differences(desired_item, live_item, f'{path}[{index}]')]
+    # The API server returns e.g. ports the manifest quotes as numbers
+    if desired == live or (live is not None and str(desired) == str(live)):
+        return []
+    return [path]
+
+
+def _comparable(document: Dict[str, Any]) -> Dict[str, Any]:
+    # The API server folds a Secret's stringData into data
+    if document.get('kind') != 'Secret' or 'stringData' not in document:
+        return document
+    comparable = {key: value for key, value in document.items() if key != 'stringData'}
+    comparable['data'] = {**(document.get('data') or {}),
+                          **{key: base64.b64encode(str(value).encode('utf-8')).decode('utf-8')
+                             for key, value in document['stringData'].items()}}
+    return comparable
+
+
+@dataclass(frozen=True)
+class ObjectDrift:
+    manifest: str
+    kind: str
+    namespace: Optional[str]
+    name: str
+    differences: Tuple[str, ...]
+    document: Dict[str, Any] = field(repr=False, compare=False, default_factory=dict)
+
+    def __str__(self) -> str:
+        location = f'{self.namespace}/{self.name}' if self.namespace else self.name
+        listed = ', '.join(self.differences[:MAX_LISTED_DIFFERENCES])
+        more = len(self.differences) - MAX_LISTED_DIFFERENCES
+        return f'{self.manifest}: {self.kind} {location} ({listed}{f", +{more} more" if more > 0 else ""})'
+
+
+@dataclass(frozen=True)
+class ReconcilePlan:
+    objects: int
+    drifts: Tuple[ObjectDrift, ...]
+
+    @property
+    def manifests(self) -> List[str]:
+        return list(dict.fromkeys(drift.manifest for drift in self.drifts))
+
+    def format(self) -> str:
+        lines = [f'{len(self.drifts)} of {self.objects} objects differ from the bundled manifests']
+        lines += [f'  {drift}' for drift in self.drifts]
+        return '\n'.join(lines)
+
+
+class ManifestReconciler:
+    MISSING: Final[str] = '<missing>'
+
+    def __init__(self, applier: ManifestApplier):
+        self._applier = applier
+
+    def plan(self, manifests: Iterable[Tuple[str, str]]) -> ReconcilePlan:
+        # manifests: (name, rendered manifest)
+        entries = [(name, document) for name, manifest in manifests
+                   for document in ManifestApplier.load_documents(manifest)]
+        live_objects = self._applier.list_live_objects([document for _, document in entries])
+
+        drifts = []
+        for (name, document), live in zip(entries, live_objects):
+            metadata = document.get('metadata') or {}
+            if live is None:
+                differences = [ManifestReconciler.MISSING]
+            else:
+                differences = semantic_differences(_comparable(document), live)
+                # Catches what a field comparison cannot, fields removed from a manifest or objects applied before
+                # the annotation existed
+                applied_hash = ((live.get('metadata') or {}).get('annotations') or {}).get(
+                    ManifestApplier.APPLIED_HASH_ANNOTATION)
+                if applied_hash != ManifestApplier.applied_hash(document):
+                    differences.append(f'metadata.annotations.{ManifestApplier.APPLIED_HASH_ANNOTATION}')
+            if differences:
+                drifts.append(ObjectDrift(name, document['kind'], metadata.get('namespace'), metadata.get('name', ''),
+                                          tuple(differences), document))
+        return ReconcilePlan(len(entries), tuple(drifts))
+
+    def apply(self, plan: ReconcilePlan) -> List[ApplyResult]:
+        return self._applier.apply_documents([drift.document for drift in plan.drifts])
@@ -0,0 +1,86 @@
+import functools
+import pathlib
+import re
+from typing import Final, Dict, FrozenSet, Iterable, Iterator, List, Mapping, Tuple
+
+PLACEHOLDER_PATTERN: Final[re.Pattern] = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class ManifestTemplate:
+    def __init__(self, path: pathlib.Path, text: str):
+        self.path = path
+        self._text = text
+        self._placeholders: List[Tuple[int, int, str]] = [(match.start(), match.end(), match.group(1))
+                                                          for match in PLACEHOLDER_PATTERN.finditer(text)]
+        self.variables: FrozenSet[str] = frozenset(name for _, _, name in self._placeholders)
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def load(path: pathlib.Path) -> 'ManifestTemplate':
+        return ManifestTemplate(path, path.read_text())
+
+    def render(self, values: Mapping[str, str]) -> str:
+        missing = self.variables - values.keys()
+        if missing:
+            raise TemplateError(f"{self.name} is missing template variables: {sorted(missing)}")
+
+        chunks: List[str] = []
+        position = 0
+        for start, end, name in self._placeholders:
+            chunks.append(self._text[position:start])
+            chunks.append(values[name])
+            position = end
+        chunks.append(self._text[position:])
+        return ''.join(chunks)
+
+
+class ManifestTemplateSet:
+    def __init__(self, paths: Iterable[pathlib.Path], known_variables: Iterable[str]):
+        self._templates = [ManifestTemplate.load(path) for path in paths]
+        self._known_variables = frozenset(known_variables)
+        for template in self._templates:
+            unknown = template.variables - self._known_variables
+            if unknown:
+                raise TemplateError(f"{template.name} uses unknown template variables: {sorted(unknown)}")
+
+    @property
+    def templates(self) -> List[ManifestTemplate]:
+        return list(self._templates)
+
+    def variables_by_manifest(self) -> Dict[str, FrozenSet[str]]:
+        return {template.name: template.variables for template in self._templates}
+
+    def manifests_by_variable(self) -> Dict[str, List[str]]:
+        usage: Dict[str, List[str]] = {name: [] for name in sorted(self._known_variables)}
+        for template in self._templates:
+            for variable in template.variables:
+                usage[variable].append(template.name)
+        return usage
+
+    def validate(self, values: Mapping[str, str]):
+        unknown = values.keys() - self._known_variables
+        if unknown:
+            raise TemplateError(f"Unknown template variables supplied: {sorted(unknown)}")
+        required = frozenset().union(*(template.variables for template in self._templates))
+        missing = required - values.keys()
+        if missing:
+            raise TemplateError(f"Missing template variables: {sorted(missing)}")
+
+    def render(self, values: Mapping[str, str]) -> Iterator[Tuple[ManifestTemplate, str]]:
+        self.validate(values)
+        return ((template, template.render(values)) for template in self._templates)
+
+
+if __name__ == '__main__':
+    from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+
+    for variable, manifests in K3sInstaller.load_manifest_templates().manifests_by_variable().items():
+        print(f"{variable}: {', '.join(manifests) if manifests else '(unused)'}")
@@ -0,0 +1,215 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, Any, Callable, Dict, List, Sequence, Optional
+
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+from cluster_server_installer import LOGGER_NAME
+
+
+class ReadinessTimeoutError(RuntimeError):
+    pass
+
+
+class ReadinessFailedError(RuntimeError):
+    pass
+
+
+class ReadinessGate:
+    RESOURCE_VERSION_EXPIRED: Final[int] = 410
+
+    def __init__(self, description: str, timeout_in_seconds: float):
+        self.description = description
+        self.timeout_in_seconds = timeout_in_seconds
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        raise NotImplementedError()
+
+    def _list_arguments(self) -> Dict[str, Any]:
+        return {}
+
+    def _is_ready(self, objects: Dict[str, Any]) -> bool:
+        raise NotImplementedError()
+
+    def wait(self, api_client: client.ApiClient):
+        deadline = time.monotonic() + self.timeout_in_seconds
+        list_function = self._list_function(api_client)
+        list_arguments = self._list_arguments()
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ReadinessTimeoutError(f"Timed out after {self.timeout_in_seconds}s waiting for {self.description}")
+
+            listed = list_function(**list_arguments)
+            objects = {item.metadata.name: item for item in listed.items}
+            if self._is_ready(objects):
+                return
+
+            watcher = watch.Watch()
+            try:
+                for event in watcher.stream(list_function, resource_version=listed.metadata.resource_version,
+                                            timeout_seconds=max(1, int(remaining)), **list_arguments):
+                    if event['type'] == 'ERROR':
+                        break
+                    if event['type'] == 'DELETED':
+                        objects.pop(event['object'].metadata.name, None)
+                    else:
+                        objects[event['object'].metadata.name] = event['object']
+                    if self._is_ready(objects):
+                        return
+            except ApiException as e:
+                if e.status != ReadinessGate.RESOURCE_VERSION_EXPIRED:
+                    raise
+            finally:
+                watcher.stop()
+
+
+class CrdEstablishedGate(ReadinessGate):
+    def __init__(self, crd_names: Sequence[str], timeout_in_seconds: float = 60):
+        super().__init__(f"CRDs established: {', '.join(crd_names)}", timeout_in_seconds)
+        self._crd_names = frozenset(crd_names)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.ApiextensionsV1Api(api_client).list_custom_resource_definition
+
+    def _is_ready(self, objects: Dict[str, Any]) -> bool:
+        for name in self._crd_names:
+            crd = objects.get(name)
+            if crd is None or crd.status is None or not any(
+                    condition.type == 'Established' and condition.status == 'True'
+                    for condition in crd.status.conditions or []):
+                return False
+        return True
+
+
+class _NamespacedObjectGate(ReadinessGate):
+    def __init__(self, description: str, namespace: str, name: str, timeout_in_seconds: float):
+        super().__init__(f"{description} {namespace}/{name}", timeout_in_seconds)
+        self._namespace = namespace
+        self._name = name
+
+    def _list_arguments(self) -> Dict[str, Any]:
+        return {'namespace': self._namespace, 'field_selector': f'metadata.name={self._name}'}
+
+    def _is_object_ready(self, obj: Any) -> bool:
+        raise NotImplementedError()
+
+    def _is_ready(self, objects: Dict[str, Any]) -> bool:
+        obj = objects.get(self._name)
+        return obj is not None and obj.status is not None and self._is_object_ready(obj)
+
+
+class DeploymentRolloutGate(_NamespacedObjectGate):
+    def __init__(self, namespace: str, name: str, timeout_in_seconds: float = 300):
+        super().__init__('Deployment rollout', namespace, name, timeout_in_seconds)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.AppsV1Api(api_client).list_namespaced_deployment
+
+    def _is_object_ready(self, obj: client.V1Deployment) -> bool:
+        desired = obj.spec.replicas if obj.spec.replicas is not None else 1
+        status = obj.status
+        return (status.observed_generation or 0) >= obj.metadata.generation and \
+            (status.updated_replicas or 0) == desired and \
+            (status.replicas or 0) == desired and \
+            (status.available_replicas or 0) == desired
+
+
+class DaemonSetRolloutGate(_NamespacedObjectGate):
+    def __init__(self, namespace: str, name: str, timeout_in_seconds: float = 300):
+        super().__init__('DaemonSet rollout', namespace, name, timeout_in_seconds)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.AppsV1Api(api_client).list_namespaced_daemon_set
+
+    def _is_object_ready(self, obj: client.V1DaemonSet) -> bool:
+        status = obj.status
+        return (status.observed_generation or 0) >= obj.metadata.generation and \
+            status.desired_number_scheduled > 0 and \
+            (status.updated_number_scheduled or 0) == status.desired_number_scheduled and \
+            (status.number_available or 0) == status.desired_number_scheduled
+
+
+class ServiceEndpointsGate(_NamespacedObjectGate):
+    def __init__(self, namespace: str, name: str, timeout_in_seconds: float = 300):
+        super().__init__('Service endpoints', namespace, name, timeout_in_seconds)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.CoreV1Api(api_client).list_namespaced_endpoints
+
+    def _is_ready(self, objects: Dict[str, Any]) -> bool:
+        endpoints = objects.get(self._name)
+        return endpoints is not None and any(subset.addresses for subset in endpoints.subsets or [])
+
+
+class HelmChartJobGate(_NamespacedObjectGate):
+    # The k3s helm-controller installs every HelmChart through a job named helm-install-<chart name>
+    def __init__(self, namespace: str, chart_name: str, timeout_in_seconds: float = 600):
+        super().__init__('HelmChart install job', namespace, f'helm-install-{chart_name}', timeout_in_seconds)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.BatchV1Api(api_client).list_namespaced_job
+
+    def _is_object_ready(self, obj: client.V1Job) -> bool:
+        for condition in obj.status.conditions or []:
+            if condition.type == 'Failed' and condition.status == 'True':
+                raise ReadinessFailedError(f"{self.description} failed: {condition.message}")
+        return (obj.status.succeeded or 0) > 0
+
+
+class PodScheduledGate(_NamespacedObjectGate):
+    def __init__(self, namespace: str, name: str, timeout_in_seconds: float = 120):
+        super().__init__('Pod scheduled', namespace, name, timeout_in_seconds)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.CoreV1Api(api_client).list_namespaced_pod
+
+    def _is_object_ready(self, obj: client.V1Pod) -> bool:
+        return bool(obj.spec.node_name)
+
+
+class PodPhaseGate(_NamespacedObjectGate):
+    def __init__(self, namespace: str, name: str, phases: Sequence[str], timeout_in_seconds: float = 300):
+        super().__init__(f"Pod {'/'.join(phases)}", namespace, name, timeout_in_seconds)
+        self._phases = frozenset(phases)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.CoreV1Api(api_client).list_namespaced_pod
+
+    def _is_object_ready(self, obj: client.V1Pod) -> bool:
+        if obj.status.phase == 'Failed' and 'Failed' not in self._phases:
+            reason = obj.status.reason or obj.status.message or 'no reason'
+            raise ReadinessFailedError(f"{self.description} failed: {reason}")
+        return obj.status.phase in self._phases
+
+
+class PvcBoundGate(_NamespacedObjectGate):
+    def __init__(self, namespace: str, name: str, timeout_in_seconds: float = 120):
+        super().__init__('PersistentVolumeClaim bound', namespace, name, timeout_in_seconds)
+
+    def _list_function(self, api_client: client.ApiClient) -> Callable[..., Any]:
+        return client.CoreV1Api(api_client).list_namespaced_persistent_volume_claim
+
+    def _is_object_ready(self, obj: client.V1PersistentVolumeClaim) -> bool:
+        return obj.status.phase == 'Bound'
+
+
+def wait_for_gates(gates: Sequence[ReadinessGate], api_client: client.ApiClient,
+                   logger: Optional[logging.Logger] = None):
+    logger = logger or logging.getLogger(LOGGER_NAME)
+    if not gates:
+        return
+
+    def wait_for_gate(gate: ReadinessGate) -> float:
+        start = time.monotonic()
+        gate.wait(api_client)
+        logger.info(f"Ready: {gate.description} ({time.monotonic() - start:.1f}s)")
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=len(gates), thread_name_prefix='readiness-gate') as executor:
+        futures: List = [executor.submit(wait_for_gate, gate) for gate in gates]
+        for future in futures:
+            future.result()
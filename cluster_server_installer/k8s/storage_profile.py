@@ -0,0 +1,71 @@
+import json
+import pathlib
+from dataclasses import dataclass
+from typing import Final, Any, Dict, Tuple
+
+from cluster_server_installer.k8s.k3s_profile import K3sProfile
+
+NFS_STORAGE_CLASS: Final[str] = 'nfs-client'
+NFS_BULK_STORAGE_CLASS: Final[str] = 'nfs-bulk'
+LOCAL_PATH_STORAGE_CLASS: Final[str] = 'local-path'
+LATENCY_BACKENDS: Final[Tuple[str, ...]] = ('nfs', 'local-path')
+MIN_NFSD_THREADS: Final[int] = 8
+MAX_NFSD_THREADS: Final[int] = 256
+NFSD_THREADS_PER_CPU: Final[int] = 8
+MAX_NCONNECT: Final[int] = 8
+TRANSFER_SIZE: Final[int] = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class NfsExport:
+    storage_class: str
+    path: pathlib.Path
+    sync: bool
+
+    def exports_line(self) -> str:
+        # async acknowledges writes before they reach the disk, only for data the workload can regenerate
+        return f'{self.path} *(rw,{"sync" if self.sync else "async"},no_subtree_check,no_root_squash)'
+
+
+@dataclass(frozen=True)
+class StorageProfile:
+    nfsd_threads: int
+    exports: Tuple[NfsExport, ...]
+    mount_options: Tuple[str, ...]
+    latency_backend: str = 'nfs'
+
+    @staticmethod
+    def for_host(cpu_count: int, share_path: pathlib.Path, bulk_share_path: pathlib.Path,
+                 latency_backend: str = 'nfs') -> 'StorageProfile':
+        if latency_backend not in LATENCY_BACKENDS:
+            raise ValueError(f"Unknown latency backend {latency_backend}, expected one of {LATENCY_BACKENDS}")
+        nfsd_threads = max(MIN_NFSD_THREADS, min(MAX_NFSD_THREADS, cpu_count * NFSD_THREADS_PER_CPU))
+        return StorageProfile(
+            nfsd_threads=nfsd_threads,
+            exports=(NfsExport(NFS_STORAGE_CLASS, share_path, sync=True),
+                     NfsExport(NFS_BULK_STORAGE_CLASS, bulk_share_path, sync=False)),
+            mount_options=('nfsvers=4.2', 'hard', 'noatime', f'rsize={TRANSFER_SIZE}', f'wsize={TRANSFER_SIZE}',
+                           f'nconnect={max(1, min(MAX_NCONNECT, cpu_count // 2))}'),
+            latency_backend=latency_backend)
+
+    @property
+    def database_storage_class(self) -> str:
+        # Databases fsync on every commit, each one a server round trip on NFS but a local flush on local-path
+        return LOCAL_PATH_STORAGE_CLASS if self.latency_backend == 'local-path' else NFS_STORAGE_CLASS
+
+    def exports_file(self) -> str:
+        return ''.join(f'{export.exports_line()}\n' for export in self.exports)
+
+    def nfs_conf(self) -> str:
+        return f'[nfsd]\nthreads={self.nfsd_threads}\n'
+
+    def k3s_overrides(self) -> Dict[str, Any]:
+        # k3s ships the local-path provisioner, it only has to stay enabled
+        if self.latency_backend == 'local-path':
+            return {'disable': [component for component in K3sProfile.DISABLED_COMPONENTS
+                                if component != 'local-storage']}
+        return {}
+
+    def template_values(self) -> Dict[str, str]:
+        return {'NFS_MOUNT_OPTIONS': json.dumps(list(self.mount_options)),
+                'DATABASE_STORAGE_CLASS': self.database_storage_class}
@@ -1,43 +1,305 @@
 import argparse
+import logging
+import os
+import pathlib
+import sys
+from typing import Optional, List
 
 from cluster_server_installer import LOGGER_NAME
-from cluster_server_installer.certificates.lego_certificate_installer import LegoCertificateInstaller
-from cluster_server_installer.k8s.ciy_scheduler_installer import CiySchedulerInstaller
-from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+from cluster_server_installer.fleet.fleet_runner import FleetRunner
+from cluster_server_installer.fleet.inventory import SECRET_FROM_ENVIRONMENT, ACCESS_KEY_VARIABLE, \
+    GODADDY_SECRET_VARIABLE
+from cluster_server_installer.orchestration.install_graph import InstallGraph
 from cluster_server_installer.utilities.logging import initialize_logger
-from cluster_server_installer.vpn.vpn_installer import VpnServerInstaller
+from cluster_server_installer.utilities.tracing import tracer, Tracer
 
+# Only lightweight modules are imported above. Each command imports what it needs once it runs, so e.g. the cron
+# driven renew-certs never loads kubernetes or requests
+
+# Set by the hidden --startup-probe flag, which startup_benchmark uses to time a command's dispatch and imports
+_startup_probe = False
+
+
+def commands_imported():
+    if _startup_probe:
+        sys.exit(0)
+
+
+def write_trace(command: str, trace_file: Optional[pathlib.Path]):
+    logger = logging.getLogger(LOGGER_NAME)
+    try:
+        path = tracer().export(trace_file or tracer().default_trace_path(command))
+    except OSError as e:
+        logger.warning(f"Could not write the install trace: {e}")
+        return
+    logger.info(f"Slowest steps (trace written to {path}):\n{tracer().summary()}")
+
+
+def secret_argument(value: str, variable: str) -> str:
+    if value != SECRET_FROM_ENVIRONMENT:
+        return value
+    if variable not in os.environ:
+        raise SystemExit(f"{variable} must be set when its argument is '{SECRET_FROM_ENVIRONMENT}'")
+    return os.environ[variable]
+
+
+def main(host_url: str, email: str, registry: str, access_key: str, go_daddy_access_key: str, go_daddy_secret: str,
+         max_workers: int = InstallGraph.DEFAULT_MAX_WORKERS, fresh: bool = False,
+         offline_bundle: Optional[pathlib.Path] = None, trace_file: Optional[pathlib.Path] = None,
+         headscale_profile: str = 'default', k3s_overrides: Optional[List[str]] = None,
+         image_archive: Optional[pathlib.Path] = None, storage_latency_backend: str = 'nfs',
+         storage_benchmark: bool = True, nic_policy: str = 'default-route', database_profile: str = 'auto',
+         database_overrides: Optional[List[str]] = None, score_transport: str = 'tcp',
+         score_workers: Optional[int] = None, score_benchmark: bool = False):
+    from cluster_server_installer.k8s.k3s_profile import parse_overrides
+    from cluster_server_installer.orchestration.install_journal import InstallJournal
+    from cluster_server_installer.orchestration.install_pipeline import build_install_graph
+    from cluster_server_installer.utilities.artifact_cache import ArtifactCache
+    commands_imported()
+
+    initialize_logger(LOGGER_NAME)
+    journal = InstallJournal()
+    if fresh:
+        journal.clear()
+    graph = build_install_graph(host_url=host_url, email=email, registry=registry, access_key=access_key,
+                                go_daddy_access_key=go_daddy_access_key, go_daddy_secret=go_daddy_secret,
+                                max_workers=max_workers, journal=journal,
+                                artifact_cache=ArtifactCache(offline_bundle=offline_bundle),
+                                headscale_profile=headscale_profile,
+                                k3s_overrides=parse_overrides(k3s_overrides or []), image_archive=image_archive,
+                                storage_latency_backend=storage_latency_backend,
+                                storage_benchmark=storage_benchmark, nic_policy=nic_policy,
+                                database_profile=database_profile,
+                                database_overrides=parse_overrides(database_overrides or []),
+                                score_transport=score_transport, score_workers=score_workers,
+                                score_benchmark=score_benchmark)
+    try:
+        with tracer().span('install', 'run', host=host_url, max_workers=max_workers):
+            graph.run()
+    finally:
+        write_trace('install', trace_file)
+
+
+def fleet(inventory_path: pathlib.Path, executor_name: str, concurrency: int, log_dir: pathlib.Path,
+          host_timeout_in_seconds: float, installer_binary: pathlib.Path) -> bool:
+    from cluster_server_installer.fleet.executors import LocalExecutor, SshExecutor, FakeExecutor
+    from cluster_server_installer.fleet.inventory import Inventory
+    commands_imported()
+
+    initialize_logger(LOGGER_NAME)
+    executors = {
+        'local': LocalExecutor,
+        'ssh': lambda: SshExecutor(installer_binary),
+        'fake': FakeExecutor,
+    }
+    runner = FleetRunner(executors[executor_name](), log_dir=log_dir, concurrency=concurrency,
+                         host_timeout_in_seconds=host_timeout_in_seconds)
+    results = runner.run(Inventory.load(inventory_path).hosts)
+    print(FleetRunner.summary(results))
+    return all(result.succeeded for result in results)
+
+
+def create_bundle(bundle_dir: pathlib.Path, access_key: str):
+    from cluster_server_installer.orchestration.install_pipeline import install_artifacts
+    from cluster_server_installer.utilities.artifact_cache import ArtifactCache
+    commands_imported()
+
+    initialize_logger(LOGGER_NAME)
+    ArtifactCache().export_bundle(install_artifacts(access_key), bundle_dir)
+
+
+def k3s_profile(k3s_overrides: List[str], storage_latency_backend: str):
+    from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+    from cluster_server_installer.k8s.k3s_profile import K3sProfile, parse_overrides
+    from cluster_server_installer.utilities.host_facts import host_facts
+    commands_imported()
+
+    capacity = host_facts().capacity
+    print(f'# {capacity.cpu_count} cpus, {capacity.memory_gib:.1f}GiB memory, {capacity.disk_gib:.0f}GiB disk')
+    storage_profile = K3sInstaller.default_storage_profile(storage_latency_backend)
+    print(K3sProfile.for_host(capacity, K3sInstaller.CLUSTER_NETWORK).with_overrides(
+        storage_profile.k3s_overrides()).with_overrides(parse_overrides(k3s_overrides)).dump(), end='')
+
+
+def reconcile(host_url: str, email: str, dry_run: bool, nic_policy: str, storage_latency_backend: str,
+              database_profile: str, database_overrides: List[str]) -> bool:
+    from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+    from cluster_server_installer.k8s.k3s_profile import parse_overrides
+    commands_imported()
 
-def main(host_url: str, email: str, registry: str, access_key: str, go_daddy_access_key: str, go_daddy_secret: str):
     initialize_logger(LOGGER_NAME)
-    vpn_installer = VpnServerInstaller()
-    vpn_installer.install_vpn(host_url=host_url, gitlab_token=access_key, email=email, godaddy_key=go_daddy_access_key,
-                              godaddy_secret=go_daddy_secret)
-    ciy_scheduler_installer = CiySchedulerInstaller()
-    ciy_scheduler_installer.install_kube_scheduler(host_url=host_url, gitlab_token=access_key)
-    k3s_installer = K3sInstaller()
-    k3s_installer.install_kubernetes(host_url=host_url, email=email, registry_url=registry, access_key=access_key)
+    k3s_installer = K3sInstaller(storage_profile=K3sInstaller.default_storage_profile(storage_latency_backend),
+                                 nic_policy=nic_policy,
+                                 database_profile=K3sInstaller.default_database_profile(
+                                     database_profile, storage_latency_backend, parse_overrides(database_overrides)))
+    try:
+        with tracer().span('reconcile', 'run', host=host_url, dry_run=dry_run):
+            return k3s_installer.reconcile_deployments(email=email, domain=host_url, dry_run=dry_run)
+    finally:
+        write_trace('reconcile', None)
+
+
+def selftest(baseline_path: Optional[pathlib.Path], tolerance: float, save_baseline: bool, vpn_peer: Optional[str],
+             as_json: bool) -> bool:
+    import dataclasses
+    import json
+    from cluster_server_installer.k8s.cluster_selftest import DEFAULT_BASELINE_PATH, run_selftest
+    from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+    commands_imported()
+
+    initialize_logger(LOGGER_NAME)
+    try:
+        report, comparisons = run_selftest(K3sInstaller.RELEVANT_CONFIG_FILE,
+                                           baseline_path=baseline_path or DEFAULT_BASELINE_PATH, tolerance=tolerance,
+                                           save_baseline=save_baseline, vpn_peer=vpn_peer)
+    finally:
+        write_trace('selftest', None)
+    if as_json:
+        print(json.dumps({**dataclasses.asdict(report),
+                          'comparisons': [dataclasses.asdict(comparison) for comparison in comparisons]}, indent=2))
+    else:
+        print(report.format_report(comparisons))
+    return not report.failures and not any(comparison.regressed for comparison in comparisons)
+
+
+def renew_certs(window_in_days: Optional[int], force: bool) -> bool:
+    from cluster_server_installer.certificates.lego_certificate_installer import LegoCertificateInstaller
+    commands_imported()
+
+    initialize_logger(LOGGER_NAME)
+    try:
+        return LegoCertificateInstaller.renew_certificates(
+            window_in_days=window_in_days or LegoCertificateInstaller.RENEWAL_WINDOW_IN_DAYS, force=force)
+    finally:
+        write_trace('renew-certs', None)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         prog='CloudIY Server Installer',
         description='Installs VPN and K3S')
+    parser.add_argument('--startup-probe', action='store_true', help=argparse.SUPPRESS)
     subparsers = parser.add_subparsers(dest='command')
     install_parser = subparsers.add_parser('install')
     install_parser.add_argument('server_url', type=str)
     install_parser.add_argument('email', type=str)
     install_parser.add_argument('registry', type=str)
-    install_parser.add_argument('access_key', type=str)
+    install_parser.add_argument('access_key', type=str, help=f"'-' reads it from ${ACCESS_KEY_VARIABLE}")
     install_parser.add_argument('godaddy_access_key', type=str)
-    install_parser.add_argument('godaddy_secret', type=str)
+    install_parser.add_argument('godaddy_secret', type=str, help=f"'-' reads it from ${GODADDY_SECRET_VARIABLE}")
+    install_parser.add_argument('--max-workers', type=int, default=InstallGraph.DEFAULT_MAX_WORKERS)
+    install_parser.add_argument('--fresh', action='store_true', help='Ignore the install journal and redo every step')
+    install_parser.add_argument('--offline-bundle', type=pathlib.Path, default=None,
+                                help='Install packages only from this pre-seeded bundle directory')
+    install_parser.add_argument('--trace-file', type=pathlib.Path, default=None,
+                                help=f'Chrome trace-event JSON output (default: under {Tracer.DEFAULT_TRACE_DIR})')
+    install_parser.add_argument('--headscale-profile', choices=['default', 'large-fleet'], default='default',
+                                help='Headscale tuning, large-fleet targets hundreds of tailscale nodes')
+    install_parser.add_argument('--k3s-set', dest='k3s_overrides', action='append', default=[], metavar='KEY=VALUE',
+                                help='Override a k3s config key (e.g. flannel-backend=wireguard-native) or a '
+                                     'component flag (e.g. kubelet-arg.max-pods=200), preview with k3s-profile')
+    install_parser.add_argument('--image-archive', type=pathlib.Path, default=None,
+                                help='Import container images from this tarball before pulling whatever it lacks')
+    install_parser.add_argument('--storage-latency-backend', choices=['nfs', 'local-path'], default='nfs',
+                                help='Where latency sensitive volumes (postgres) live: the sync NFS export or '
+                                     'node-local k3s local-path volumes')
+    install_parser.add_argument('--skip-storage-benchmark', action='store_true',
+                                help='Do not measure storage throughput and fsync latency after the install')
+    install_parser.add_argument('--nic-policy', default='default-route', metavar='POLICY',
+                                help='Interface whose address k3s advertises: default-route, physical, an interface '
+                                     'name or a CIDR (default: default-route)')
+    install_parser.add_argument('--database-profile', choices=['auto', 'small', 'medium', 'large'], default='auto',
+                                help='Resources and tuning of the bundled postgres and redis, auto sizes them by '
+                                     'host memory')
+    install_parser.add_argument('--database-set', dest='database_overrides', action='append', default=[],
+                                metavar='KEY=VALUE',
+                                help='Override a database setting (e.g. postgres.shared_buffers=1GB, '
+                                     'redis.maxmemory-policy=allkeys-lru) or resource '
+                                     '(e.g. postgres.resources.limits.memory=4Gi)')
+    install_parser.add_argument('--scheduler-score-transport', choices=['tcp', 'uds'], default='tcp',
+                                help='How the co-located scheduler reaches the ciy-scheduler score server. uds '
+                                     '(experimental) adds a socket activated unix domain socket next to the TCP '
+                                     'port')
+    install_parser.add_argument('--scheduler-score-workers', type=int, default=None,
+                                help='Score server worker count, also caps GOMAXPROCS (default: unset, with uds '
+                                     'half the host cores, 2 to 16)')
+    install_parser.add_argument('--score-benchmark', action='store_true',
+                                help='Measure score request latency over TCP and the unix socket after the install')
+
+    k3s_profile_parser = subparsers.add_parser('k3s-profile', help='Print the k3s config generated for this host')
+    k3s_profile_parser.add_argument('--set', dest='k3s_overrides', action='append', default=[], metavar='KEY=VALUE')
+    k3s_profile_parser.add_argument('--storage-latency-backend', choices=['nfs', 'local-path'], default='nfs')
+
+    bundle_parser = subparsers.add_parser('create-bundle')
+    bundle_parser.add_argument('bundle_dir', type=pathlib.Path)
+    bundle_parser.add_argument('access_key', type=str)
+
+    fleet_parser = subparsers.add_parser('fleet')
+    fleet_parser.add_argument('inventory', type=pathlib.Path)
+    fleet_parser.add_argument('--executor', choices=['ssh', 'local', 'fake'], default='ssh')
+    fleet_parser.add_argument('--concurrency', type=int, default=FleetRunner.DEFAULT_CONCURRENCY)
+    fleet_parser.add_argument('--log-dir', type=pathlib.Path, default=pathlib.Path('fleet-logs'))
+    fleet_parser.add_argument('--host-timeout', type=float, default=FleetRunner.DEFAULT_HOST_TIMEOUT_IN_SECONDS)
+    fleet_parser.add_argument('--installer-binary', type=pathlib.Path, default=pathlib.Path(sys.argv[0]).absolute())
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='Apply the bundled manifests that differ from the '
+                                                                'cluster, keeping the installed credentials')
+    reconcile_parser.add_argument('server_url', type=str)
+    reconcile_parser.add_argument('email', type=str)
+    reconcile_parser.add_argument('--dry-run', action='store_true', help='Only list the objects that would be applied')
+    reconcile_parser.add_argument('--nic-policy', default='default-route', metavar='POLICY')
+    reconcile_parser.add_argument('--storage-latency-backend', choices=['nfs', 'local-path'], default='nfs')
+    reconcile_parser.add_argument('--database-profile', choices=['auto', 'small', 'medium', 'large'], default='auto')
+    reconcile_parser.add_argument('--database-set', dest='database_overrides', action='append', default=[],
+                                  metavar='KEY=VALUE')
+
+    selftest_parser = subparsers.add_parser('selftest', help='Measure the installed cluster against a baseline')
+    selftest_parser.add_argument('--baseline', type=pathlib.Path, default=None,
+                                 help='Baseline report, written by the first complete run '
+                                      '(default: /var/lib/ciy-installer/selftest-baseline.json)')
+    selftest_parser.add_argument('--save-baseline', action='store_true',
+                                 help='Replace the baseline with this run instead of comparing against it')
+    selftest_parser.add_argument('--tolerance', type=float, default=0.25,
+                                 help='Relative change a metric may worsen by before it counts as a regression')
+    selftest_parser.add_argument('--vpn-peer', type=str, default=None,
+                                 help='Tailscale peer for the VPN round trip and iperf3 throughput '
+                                      '(default: the first online peer)')
+    selftest_parser.add_argument('--json', action='store_true', help='Print the report as JSON')
 
-    subparsers.add_parser('renew-certs')
+    renew_parser = subparsers.add_parser('renew-certs')
+    renew_parser.add_argument('--window-days', type=int, default=None,
+                              help='Renew only once the certificate expires within this many days (default: 30)')
+    renew_parser.add_argument('--force', action='store_true', help='Renew regardless of the expiry date')
     args = parser.parse_args()
+    _startup_probe = args.startup_probe
 
     if args.command == 'install':
-        main(args.server_url, args.email, args.registry, args.access_key, args.godaddy_access_key, args.godaddy_secret)
+        main(args.server_url, args.email, args.registry, secret_argument(args.access_key, ACCESS_KEY_VARIABLE),
+             args.godaddy_access_key, secret_argument(args.godaddy_secret, GODADDY_SECRET_VARIABLE),
+             max_workers=args.max_workers, fresh=args.fresh, offline_bundle=args.offline_bundle,
+             trace_file=args.trace_file, headscale_profile=args.headscale_profile, k3s_overrides=args.k3s_overrides,
+             image_archive=args.image_archive, storage_latency_backend=args.storage_latency_backend,
+             storage_benchmark=not args.skip_storage_benchmark, nic_policy=args.nic_policy,
+             database_profile=args.database_profile, database_overrides=args.database_overrides,
+             score_transport=args.scheduler_score_transport, score_workers=args.scheduler_score_workers,
+             score_benchmark=args.score_benchmark)
+    elif args.command == 'k3s-profile':
+        k3s_profile(args.k3s_overrides, args.storage_latency_backend)
+    elif args.command == 'create-bundle':
+        create_bundle(args.bundle_dir, args.access_key)
+    elif args.command == 'fleet':
+        if not fleet(args.inventory, args.executor, args.concurrency, args.log_dir, args.host_timeout,
+                     args.installer_binary):
+            sys.exit(1)
+    elif args.command == 'reconcile':
+        if not reconcile(args.server_url, args.email, args.dry_run, args.nic_policy, args.storage_latency_backend,
+                         args.database_profile, args.database_overrides):
+            sys.exit(1)
+    elif args.command == 'selftest':
+        if not selftest(args.baseline, args.tolerance, args.save_baseline, args.vpn_peer, args.json):
+            sys.exit(1)
     elif args.command == 'renew-certs':
-        LegoCertificateInstaller.renew_certificates()
+        if not renew_certs(args.window_days, args.force):
+            sys.exit(1)
     else:
         raise Exception(f"Undefined command: {args.command}")
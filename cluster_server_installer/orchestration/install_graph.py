@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Final, Callable, Any, Dict, List, Optional, Iterable, FrozenSet, Set, Mapping, Tuple
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.orchestration.install_journal import InstallJournal
+from cluster_server_installer.utilities.tracing import tracer, propagate_context
+
+
+class InstallGraphError(RuntimeError):
+    def __init__(self, node_name: str, message: str):
+        super().__init__(f"Install node '{node_name}' failed: {message}")
+        self.node_name = node_name
+
+
+@dataclass(frozen=True)
+class InstallNode:
+    name: str
+    action: Callable[[], Any]
+    dependencies: FrozenSet[str] = field(default_factory=frozenset)
+    # Named host resources (e.g. the dpkg lock) that must not be held by two running nodes at once
+    locks: FrozenSet[str] = field(default_factory=frozenset)
+    # Journaled nodes record their output against a fingerprint of these inputs and may be resumed on re-runs
+    inputs: Optional[Mapping[str, Any]] = None
+    # Cheap check that a journaled completion still holds on the host, given the recorded output
+    verify: Optional[Callable[[Any], bool]] = None
+    # Ephemeral nodes run on every pass (short lived credentials, idempotent checks). Their running again is not a
+    # change, so it does not keep dependents from resuming
+    ephemeral: bool = False
+
+
+class InstallGraph:
+    DEFAULT_MAX_WORKERS: Final[int] = 4
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, cancel_event: Optional[threading.Event] = None,
+                 journal: Optional[InstallJournal] = None):
+        if max_workers < 1:
+            raise ValueError(f"max_workers must be positive, got {max_workers}")
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._max_workers = max_workers
+        self._nodes: Dict[str, InstallNode] = {}
+        self._results: Dict[str, Any] = {}
+        self._durations: Dict[str, float] = {}
+        self._cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self._journal = journal
+        self._executed: Set[str] = set()
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        return self._cancel_event
+
+    @property
+    def durations(self) -> Dict[str, float]:
+        return dict(self._durations)
+
+    @property
+    def executed(self) -> FrozenSet[str]:
+        return frozenset(self._executed)
+
+    def add_node(self, name: str, action: Callable[[], Any], dependencies: Iterable[str] = (),
+                 locks: Iterable[str] = (), inputs: Optional[Mapping[str, Any]] = None,
+                 verify: Optional[Callable[[Any], bool]] = None, ephemeral: bool = False) -> InstallNode:
+        if name in self._nodes:
+            raise ValueError(f"Duplicate install node: {name}")
+        if ephemeral and inputs is not None:
+            raise ValueError(f"Install node '{name}' cannot be both journaled and ephemeral")
+        node = InstallNode(name=name, action=action, dependencies=frozenset(dependencies), locks=frozenset(locks),
+                           inputs=inputs, verify=verify, ephemeral=ephemeral)
+        self._nodes[name] = node
+        return node
+
+    def result(self, name: str) -> Any:
+        if name not in self._results:
+            raise KeyError(f"Install node '{name}' has not completed")
+        return self._results[name]
+
+    def _validate(self):
+        for node in self._nodes.values():
+            unknown = node.dependencies - self._nodes.keys()
+            if unknown:
+                raise ValueError(f"Install node '{node.name}' depends on unknown nodes: {sorted(unknown)}")
+
+        remaining = {name: set(node.dependencies) for name, node in self._nodes.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Dependency cycle between install nodes: {sorted(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def _descendants(self, name: str) -> Set[str]:
+        found: Set[str] = set()
+        frontier = [name]
+        while frontier:
+            current = frontier.pop()
+            for node in self._nodes.values():
+                if current in node.dependencies and node.name not in found:
+                    found.add(node.name)
+                    frontier.append(node.name)
+        return found
+
+    def _resume(self, node: InstallNode) -> Tuple[bool, Any]:
+        if self._journal is None or node.inputs is None:
+            return False, None
+        completed, output = self._journal.lookup(node.name, node.inputs)
+        if not completed:
+            return False, None
+        try:
+            if node.verify is not None and not node.verify(output):
+                self._logger.info(f"Journaled install step {node.name} no longer holds, re-running")
+                return False, None
+        except Exception as e:
+            self._logger.warning(f"Verification of journaled install step {node.name} failed ({e}), re-running")
+            return False, None
+        return True, output
+
+    def _run_node(self, node: InstallNode, may_resume: bool) -> Tuple[Any, bool]:
+        with tracer().span(node.name, 'install-step') as span:
+            output, executed = self._run_node_untraced(node, may_resume)
+            span.set(resumed=not executed)
+            return output, executed
+
+    def _run_node_untraced(self, node: InstallNode, may_resume: bool) -> Tuple[Any, bool]:
+        if self._cancel_event.is_set():
+            raise InstallGraphError(node.name, "cancelled before start")
+        if may_resume:
+            resumed, output = self._resume(node)
+            if resumed:
+                self._logger.info(f"Install step {node.name} already completed, skipping")
+                return output, False
+
+        if self._journal is not None and not node.ephemeral:
+            # Anything downstream was built on the previous outcome of this step
+            self._journal.invalidate({node.name} | self._descendants(node.name))
+        self._logger.info(f"Starting install step: {node.name}")
+        start = time.monotonic()
+        try:
+            output = node.action()
+        finally:
+            self._durations[node.name] = time.monotonic() - start
+            self._logger.info(f"Finished install step: {node.name} ({self._durations[node.name]:.1f}s)")
+
+        if self._journal is not None and node.inputs is not None:
+            self._journal.record(node.name, node.inputs, output)
+        return output, True
+
+    def run(self) -> Dict[str, Any]:
+        self._validate()
+        waiting_on: Dict[str, Set[str]] = {name: set(node.dependencies) for name, node in self._nodes.items()}
+        dependents: Dict[str, List[str]] = {name: [] for name in self._nodes}
+        for node in self._nodes.values():
+            for dependency in node.dependencies:
+                dependents[dependency].append(node.name)
+
+        running: Dict[Future, InstallNode] = {}
+        held_locks: Set[str] = set()
+        executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='install-node')
+        try:
+            while waiting_on or running:
+                for name in sorted(waiting_on):
+                    if len(running) >= self._max_workers:
+                        break
+                    node = self._nodes[name]
+                    if waiting_on[name] or node.locks & held_locks:
+                        continue
+                    del waiting_on[name]
+                    held_locks |= node.locks
+                    may_resume = not node.dependencies & self._executed
+                    running[executor.submit(propagate_context(self._run_node), node, may_resume)] = node
+
+                if not running:
+                    raise ValueError(f"Install nodes can never be scheduled: {sorted(waiting_on)}")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    held_locks -= node.locks
+                    error = future.exception()
+                    if error is not None:
+                        self._logger.error(f"Install step {node.name} failed, cancelling remaining steps")
+                        self._cancel_event.set()
+                        if isinstance(error, InstallGraphError):
+                            raise error
+                        raise InstallGraphError(node.name, str(error)) from error
+
+                    self._results[node.name], executed = future.result()
+                    if executed and not node.ephemeral:
+                        self._executed.add(node.name)
+                    for dependent in dependents[node.name]:
+                        waiting_on[dependent].discard(node.name)
+        finally:
+            executor.shutdown(wait=not self._cancel_event.is_set(), cancel_futures=True)
+
+        return dict(self._results)
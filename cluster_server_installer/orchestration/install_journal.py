@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Final, Any, Dict, Iterable, Mapping, Tuple
+
+
+class InstallJournal:
+    DEFAULT_PATH: Final[pathlib.Path] = pathlib.Path('/var/lib/ciy-installer/install-journal.json')
+    FORMAT_VERSION: Final[int] = 1
+
+    def __init__(self, path: pathlib.Path = DEFAULT_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._steps: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            contents = json.loads(path.read_text())
+            if contents.get('version') == InstallJournal.FORMAT_VERSION:
+                self._steps = contents.get('steps', {})
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self._path
+
+    @staticmethod
+    def fingerprint(inputs: Mapping[str, Any]) -> str:
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def lookup(self, step: str, inputs: Mapping[str, Any]) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._steps.get(step)
+        if entry is None or entry['inputs'] != InstallJournal.fingerprint(inputs):
+            return False, None
+        return True, entry['output']
+
+    def record(self, step: str, inputs: Mapping[str, Any], output: Any):
+        with self._lock:
+            self._steps[step] = {
+                'inputs': InstallJournal.fingerprint(inputs),
+                'output': output,
+                'completed_at': time.time(),
+            }
+            self._flush()
+
+    def invalidate(self, steps: Iterable[str]):
+        with self._lock:
+            removed = [self._steps.pop(step) for step in steps if step in self._steps]
+            if removed:
+                self._flush()
+
+    def clear(self):
+        with self._lock:
+            self._steps.clear()
+            self._flush()
+
+    def _flush(self):
+        # Write-then-rename so an interrupted install never leaves a truncated journal behind
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, tmp_path = tempfile.mkstemp(dir=self._path.parent, prefix=f'.{self._path.name}.')
+        try:
+            with os.fdopen(descriptor, 'w') as tmp_file:
+                json.dump({'version': InstallJournal.FORMAT_VERSION, 'steps': self._steps}, tmp_file, indent=2)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
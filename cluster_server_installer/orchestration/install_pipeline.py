@@ -0,0 +1,167 @@
+import pathlib
+import threading
+from typing import Final, Any, Dict, Optional, List
+
+from cluster_server_installer.k8s.ciy_scheduler_installer import CiySchedulerInstaller
+from cluster_server_installer.k8s.image_prefetch import ImagePrefetcher
+from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+from cluster_server_installer.orchestration.install_graph import InstallGraph
+from cluster_server_installer.orchestration.install_journal import InstallJournal
+from cluster_server_installer.utilities.artifact_cache import ArtifactCache, ArtifactSpec
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.host_facts import host_facts, invalidate_host_facts
+from cluster_server_installer.utilities.probes import default_probe_engine
+from cluster_server_installer.vpn.headscale_config import HEADSCALE_PROFILES
+from cluster_server_installer.vpn.vpn_installer import VpnServerInstaller
+
+DPKG_LOCK: Final[str] = 'dpkg'
+
+
+def _require(status: bool, message: str):
+    if not status:
+        raise RuntimeError(message)
+
+
+def build_install_graph(host_url: str, email: str, registry: str, access_key: str, go_daddy_access_key: str,
+                        go_daddy_secret: str, max_workers: int = InstallGraph.DEFAULT_MAX_WORKERS,
+                        cancel_event: Optional[threading.Event] = None,
+                        journal: Optional[InstallJournal] = None,
+                        artifact_cache: Optional[ArtifactCache] = None,
+                        headscale_profile: str = 'default',
+                        k3s_overrides: Optional[Dict[str, Any]] = None,
+                        image_archive: Optional[pathlib.Path] = None, storage_latency_backend: str = 'nfs',
+                        storage_benchmark: bool = True, nic_policy: str = 'default-route',
+                        database_profile: str = 'auto',
+                        database_overrides: Optional[Dict[str, Any]] = None, score_transport: str = 'tcp',
+                        score_workers: Optional[int] = None, score_benchmark: bool = False) -> InstallGraph:
+    if headscale_profile not in HEADSCALE_PROFILES:
+        raise ValueError(f"Unknown headscale profile {headscale_profile}, expected one of {sorted(HEADSCALE_PROFILES)}")
+    # Surfaces misspelled manifest placeholders before any step touches the host
+    K3sInstaller.load_manifest_templates()
+    # One snapshot of the host for the whole run, a NIC policy that matches no interface fails here already
+    invalidate_host_facts()
+    host_facts().primary_ip(nic_policy)
+
+    graph = InstallGraph(max_workers=max_workers, cancel_event=cancel_event, journal=journal)
+    command_runner().bind_cancel_event(graph.cancel_event)
+    default_probe_engine().bind_cancel_event(graph.cancel_event)
+    vpn_installer = VpnServerInstaller(headscale_tuning=HEADSCALE_PROFILES[headscale_profile])
+    ciy_scheduler_installer = CiySchedulerInstaller(score_transport=score_transport, score_workers=score_workers)
+    storage_profile = K3sInstaller.default_storage_profile(storage_latency_backend)
+    k3s_installer = K3sInstaller(k3s_overrides=k3s_overrides, storage_profile=storage_profile, nic_policy=nic_policy,
+                                 database_profile=K3sInstaller.default_database_profile(
+                                     database_profile, storage_latency_backend, database_overrides))
+    artifact_cache = artifact_cache or ArtifactCache()
+
+    def issue_headscale_certificates() -> Optional[List[str]]:
+        certs_location = vpn_installer.issue_headscale_certificates(
+            host_url=host_url, email=email, godaddy_key=go_daddy_access_key, godaddy_secret=go_daddy_secret)
+        return None if certs_location is None else [str(path) for path in certs_location]
+
+    def download_headscale() -> Optional[str]:
+        package_path = vpn_installer.download_headscale(gitlab_token=access_key, artifact_cache=artifact_cache)
+        return None if package_path is None else str(package_path)
+
+    def setup_headscale():
+        certs_location = graph.result('headscale-certificates')
+        if certs_location is not None:
+            vpn_installer.setup_headscale(host_url=host_url,
+                                          package_path=pathlib.Path(graph.result('headscale-download')),
+                                          cert_crt_path=pathlib.Path(certs_location[0]),
+                                          cert_key_path=pathlib.Path(certs_location[1]))
+
+    def download_ciy_scheduler() -> Optional[str]:
+        package_path = ciy_scheduler_installer.download_ciy_scheduler(gitlab_token=access_key,
+                                                                      artifact_cache=artifact_cache)
+        return None if package_path is None else str(package_path)
+
+    def setup_ciy_scheduler():
+        package_path = graph.result('ciy-scheduler-download')
+        ciy_scheduler_installer.setup_ciy_scheduler(
+            host_url=host_url, package_path=None if package_path is None else pathlib.Path(package_path))
+
+    graph.add_node('headscale-certificates', issue_headscale_certificates, inputs={'host_url': host_url, 'email': email},
+                   verify=lambda certs: certs is None or all(pathlib.Path(path).exists() for path in certs))
+    graph.add_node('headscale-download', download_headscale,
+                   inputs={'version': VpnServerInstaller.HEAD_SCALE_VERSION},
+                   verify=lambda package: package is None or pathlib.Path(package).exists())
+    graph.add_node('headscale', setup_headscale, dependencies=['headscale-certificates', 'headscale-download'],
+                   locks=[DPKG_LOCK], inputs={'host_url': host_url, 'headscale_profile': headscale_profile},
+                   verify=lambda _: VpnServerInstaller.check_if_headscale_is_installed())
+    graph.add_node('headscale-api-key', VpnServerInstaller.get_api_key, dependencies=['headscale'], inputs={},
+                   verify=lambda _: VpnServerInstaller.check_if_headscale_is_installed())
+    # Pre-auth keys expire quickly, so one is minted on every run rather than journaled
+    graph.add_node('headscale-preauth-key', VpnServerInstaller.get_headscale_preauthkey, dependencies=['headscale'],
+                   ephemeral=True)
+    # Checks the installed client first, so it is cheap to run on every pass
+    graph.add_node('tailscale', vpn_installer.setup_tailscale, ephemeral=True)
+
+    graph.add_node('ciy-scheduler-download', download_ciy_scheduler,
+                   inputs={'version': CiySchedulerInstaller.CIY_SCHEDULER_SCALE_VERSION},
+                   verify=lambda package: package is None or pathlib.Path(package).exists())
+    graph.add_node('ciy-scheduler', setup_ciy_scheduler,
+                   dependencies=['ciy-scheduler-download'], locks=[DPKG_LOCK],
+                   inputs={'host_url': host_url, 'score_transport': score_transport,
+                           'score_workers': ciy_scheduler_installer.score_workers},
+                   verify=lambda _: CiySchedulerInstaller.check_if_ciy_scheduler_is_installed())
+
+    graph.add_node('nfs-server', lambda: _require(k3s_installer.install_nfs_server(), "NFS installation failed..."),
+                   locks=[DPKG_LOCK], inputs={'exports': storage_profile.exports_file(),
+                                              'nfs_conf': storage_profile.nfs_conf()},
+                   verify=lambda _: K3sInstaller.check_if_nfs_server_is_installed())
+    graph.add_node('k3s-download', lambda: K3sInstaller.download_k3s(artifact_cache),
+                   inputs={'version': K3sInstaller.K3S_VERSION},
+                   verify=lambda paths: all(pathlib.Path(path).exists() for path in paths.values()))
+    graph.add_node('k3s', lambda: _require(
+        k3s_installer.install_kube_env(host_url, api_key=graph.result('headscale-api-key'),
+                                       preauth_key=graph.result('headscale-preauth-key'),
+                                       k3s_artifacts=graph.result('k3s-download')),
+        "K3s installation failed..."),
+                   dependencies=['headscale-api-key', 'headscale-preauth-key', 'tailscale', 'ciy-scheduler',
+                                 'k3s-download'],
+                   inputs={'host_url': host_url, 'k3s_overrides': k3s_overrides or {},
+                           'storage_latency_backend': storage_latency_backend, 'nic_policy': nic_policy},
+                   verify=lambda _: k3s_installer.check_if_kubernetes_installed_properly())
+    graph.add_node('image-pull-secret', lambda: _require(
+        k3s_installer.create_image_pull_secret(registry_url=registry, access_key=access_key),
+        "K3s installation failed... failed to create cloud-iy pull permissions"), dependencies=['k3s'],
+                   inputs={'registry': registry, 'access_key': access_key},
+                   verify=lambda _: k3s_installer.check_if_secret_exists('cloud-iy', 'cloud-iy-credentials'))
+    graph.add_node('tls-secrets', lambda: _require(
+        k3s_installer.apply_tls_secrets(host_url), "K3s installation failed... failed to provision TLS secrets"),
+                   dependencies=['k3s', 'headscale-certificates'], inputs={'host_url': host_url},
+                   verify=lambda _: all(k3s_installer.check_if_secret_exists(namespace, secret_name)
+                                        for namespace, secret_name in K3sInstaller.TLS_SECRETS))
+    graph.add_node('image-prefetch', lambda: K3sInstaller.prefetch_images(registry, access_key, image_archive),
+                   dependencies=['k3s'],
+                   inputs={'registry': registry,
+                           'image_archive': None if image_archive is None else str(image_archive)},
+                   verify=lambda digests: not ImagePrefetcher().missing_images(digests))
+    graph.add_node('credentials', K3sInstaller.generate_credentials, inputs={})
+    graph.add_node('deployments', lambda: _require(
+        k3s_installer.install_deployments(email=email, domain=host_url, credentials=graph.result('credentials'),
+                                          image_digests=graph.result('image-prefetch')),
+        "K3s installation failed... failed to deploy pre-requisites"),
+                   dependencies=['image-pull-secret', 'tls-secrets', 'nfs-server', 'credentials',
+                                 'image-prefetch'],
+                   inputs={'email': email, 'host_url': host_url, 'storage_latency_backend': storage_latency_backend,
+                           'database_profile': database_profile, 'database_overrides': database_overrides or {}},
+                   verify=lambda _: K3sInstaller.wait_for_dashboard_to_respond(host_url, timeout_in_seconds=5))
+    if storage_benchmark:
+        # Runs last so its disk load does not slow the install down, and only once per storage profile
+        graph.add_node('storage-benchmark', k3s_installer.benchmark_storage, dependencies=['deployments'],
+                       inputs={'exports': storage_profile.exports_file(),
+                               'mount_options': list(storage_profile.mount_options)})
+    if score_benchmark:
+        # Sends its requests to the live scheduler, so only on request, after the deployments so their start up does
+        # not skew it
+        graph.add_node('score-benchmark', ciy_scheduler_installer.benchmark_score_transport,
+                       dependencies=['deployments'],
+                       inputs={'score_transport': score_transport,
+                               'score_workers': ciy_scheduler_installer.score_workers})
+    return graph
+
+
+def install_artifacts(access_key: str) -> List[ArtifactSpec]:
+    return [VpnServerInstaller.headscale_artifact(access_key), CiySchedulerInstaller.ciy_scheduler_artifact(access_key),
+            *K3sInstaller.k3s_artifacts()]
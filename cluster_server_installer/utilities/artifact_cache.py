@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Final, Dict, Mapping, Optional, Sequence
+
+import requests
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.tracing import tracer, propagate_context
+
+
+class ArtifactIntegrityError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class ArtifactSpec:
+    name: str
+    version: str
+    url: str
+    sha256: Optional[str] = None
+    headers: Mapping[str, str] = field(default_factory=dict, compare=False, hash=False)
+    suffix: str = ''
+
+    @property
+    def key(self) -> str:
+        return f'{self.name}@{self.version}'
+
+    @property
+    def file_name(self) -> str:
+        return f'{self.name}-{self.version}{self.suffix}'
+
+
+def sha256_of_file(path: pathlib.Path, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    DEFAULT_ROOT: Final[pathlib.Path] = pathlib.Path('/var/cache/ciy-installer/artifacts')
+    BUNDLE_CHECKSUM_FILE: Final[str] = 'SHA256SUMS'
+    CHUNK_SIZE: Final[int] = 1024 * 1024
+    DOWNLOAD_TIMEOUT_IN_SECONDS: Final[int] = 60
+    HTTP_PARTIAL_CONTENT: Final[int] = 206
+    HTTP_RANGE_NOT_SATISFIABLE: Final[int] = 416
+
+    def __init__(self, root: pathlib.Path = DEFAULT_ROOT, offline_bundle: Optional[pathlib.Path] = None,
+                 session: Optional[requests.Session] = None):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._root = root
+        self._offline_bundle = offline_bundle
+        self._session = session or requests.Session()
+        self._index_path = root / 'index.json'
+        self._index_lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._index: Dict[str, str] = json.loads(self._index_path.read_text()) if self._index_path.exists() else {}
+
+    @property
+    def offline(self) -> bool:
+        return self._offline_bundle is not None
+
+    def _blob_path(self, digest: str) -> pathlib.Path:
+        return self._root / 'sha256' / digest[:2] / digest
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._index_lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _expected_digest(self, spec: ArtifactSpec) -> Optional[str]:
+        with self._index_lock:
+            return spec.sha256 or self._index.get(spec.key)
+
+    def _remember(self, spec: ArtifactSpec, digest: str):
+        with self._index_lock:
+            self._index[spec.key] = digest
+            self._root.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._index_path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(self._index, indent=2, sort_keys=True))
+            os.replace(tmp_path, self._index_path)
+
+    def fetch(self, spec: ArtifactSpec) -> pathlib.Path:
+        with tracer().span(spec.key, 'artifact') as span:
+            path = self._fetch(spec)
+            span.set(bytes=path.stat().st_size, offline=self.offline)
+            return path
+
+    def _fetch(self, spec: ArtifactSpec) -> pathlib.Path:
+        with self._key_lock(spec.key):
+            expected = self._expected_digest(spec)
+            if expected is not None:
+                cached = self._blob_path(expected)
+                if cached.exists():
+                    if sha256_of_file(cached) == expected:
+                        self._logger.info(f"Using cached {spec.key}")
+                        return cached
+                    self._logger.warning(f"Cached {spec.key} is corrupt, fetching again")
+                    cached.unlink()
+
+            if self.offline:
+                source = self._offline_bundle / spec.file_name
+                if not source.exists():
+                    raise FileNotFoundError(f"Offline bundle {self._offline_bundle} has no {spec.file_name}")
+                expected = expected or self._bundle_checksums().get(spec.file_name)
+                if expected is None:
+                    raise ArtifactIntegrityError(f"No checksum for {spec.file_name} in the offline bundle")
+            else:
+                source = self._download(spec)
+
+            digest = sha256_of_file(source)
+            if expected is not None and digest != expected:
+                if not self.offline:
+                    source.unlink()
+                raise ArtifactIntegrityError(f"{spec.key} has sha256 {digest}, expected {expected}")
+            if self.offline:
+                return source
+
+            blob = self._blob_path(digest)
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, blob)
+            self._remember(spec, digest)
+            return blob
+
+    def _bundle_checksums(self) -> Dict[str, str]:
+        checksum_file = self._offline_bundle / ArtifactCache.BUNDLE_CHECKSUM_FILE
+        if not checksum_file.exists():
+            return {}
+        checksums = {}
+        for line in checksum_file.read_text().splitlines():
+            if line.strip():
+                digest, file_name = line.split(maxsplit=1)
+                checksums[file_name.lstrip('*')] = digest
+        return checksums
+
+    def _download(self, spec: ArtifactSpec) -> pathlib.Path:
+        partial = self._root / 'partial' / spec.file_name
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        headers = dict(spec.headers)
+        offset = partial.stat().st_size if partial.exists() else 0
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            self._logger.info(f"Resuming download of {spec.key} at byte {offset}")
+        else:
+            self._logger.info(f"Downloading {spec.key}")
+
+        with self._session.get(spec.url, headers=headers, stream=True,
+                               timeout=ArtifactCache.DOWNLOAD_TIMEOUT_IN_SECONDS) as response:
+            if offset and response.status_code == ArtifactCache.HTTP_RANGE_NOT_SATISFIABLE:
+                # The partial file already holds the whole artifact
+                return partial
+            response.raise_for_status()
+            mode = 'ab' if offset and response.status_code == ArtifactCache.HTTP_PARTIAL_CONTENT else 'wb'
+            with partial.open(mode) as destination:
+                for chunk in response.iter_content(chunk_size=ArtifactCache.CHUNK_SIZE):
+                    destination.write(chunk)
+        return partial
+
+    def prefetch(self, specs: Sequence[ArtifactSpec], max_workers: int = 4) -> Dict[str, pathlib.Path]:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(specs))),
+                                thread_name_prefix='artifact-fetch') as executor:
+            return dict(zip((spec.key for spec in specs), executor.map(propagate_context(self.fetch), specs)))
+
+    def export_bundle(self, specs: Sequence[ArtifactSpec], bundle_dir: pathlib.Path):
+        bundle_dir.mkdir(parents=True, exist_ok=True)
+        lines = []
+        for spec, path in zip(specs, self.prefetch(specs).values()):
+            shutil.copyfile(path, bundle_dir / spec.file_name)
+            lines.append(f'{path.name}  {spec.file_name}')
+        (bundle_dir / ArtifactCache.BUNDLE_CHECKSUM_FILE).write_text('\n'.join(lines) + '\n')
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import pathlib
+import tarfile
+import tempfile
+from dataclasses import dataclass
+from typing import Final, BinaryIO, IO, List, Optional, Sequence
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.tracing import tracer
+
+
+@dataclass(frozen=True)
+class DeployTarget:
+    member: str
+    destination: pathlib.Path
+    mode: int = 0o755
+
+
+@dataclass(frozen=True)
+class DeployResult:
+    destination: pathlib.Path
+    sha256: str
+    size: int
+    replaced: bool
+
+
+class ArtifactDeployer:
+    CHUNK_SIZE: Final[int] = 1024 * 1024
+
+    def __init__(self):
+        self._logger = logging.getLogger(LOGGER_NAME)
+
+    def deploy_archive_members(self, archive: pathlib.Path, targets: Sequence[DeployTarget]) -> List[DeployResult]:
+        # Stream mode reads the compressed archive once, front to back, and never extracts unrelated members
+        wanted = {target.member: target for target in targets}
+        results = {}
+        with tarfile.open(archive, mode='r|*') as tar:
+            for member in tar:
+                target = wanted.get(member.name)
+                if target is None or not member.isfile():
+                    continue
+                with tar.extractfile(member) as source:
+                    results[member.name] = self._deploy(source, member.size, target.destination, target.mode)
+                if len(results) == len(wanted):
+                    break
+
+        missing = wanted.keys() - results.keys()
+        if missing:
+            raise FileNotFoundError(f"{archive} has no members {sorted(missing)}")
+        return [results[target.member] for target in targets]
+
+    def deploy_file(self, source: pathlib.Path, destination: pathlib.Path, mode: int = 0o755) -> DeployResult:
+        with source.open('rb') as source_file:
+            return self._deploy(source_file, source.stat().st_size, destination, mode)
+
+    def deploy_stream(self, source: BinaryIO, destination: pathlib.Path, mode: int = 0o755,
+                      size: Optional[int] = None) -> DeployResult:
+        return self._deploy(source, size, destination, mode)
+
+    def _deploy(self, source: BinaryIO, size: Optional[int], destination: pathlib.Path, mode: int) -> DeployResult:
+        with tracer().span(destination.name, 'deploy', bytes=size) as span:
+            result = self._write_if_changed(source, size, destination, mode)
+            span.set(replaced=result.replaced)
+        if result.replaced:
+            self._logger.info(f"Deployed {destination} ({result.size} bytes)")
+        else:
+            self._logger.info(f"{destination} is already up to date")
+        return result
+
+    def _write_if_changed(self, source: BinaryIO, size: Optional[int], destination: pathlib.Path,
+                          mode: int) -> DeployResult:
+        # The incoming stream is compared chunk by chunk against the installed file; nothing is written unless
+        # they diverge, and then only the verified prefix is copied over before the rest of the stream
+        digest = hashlib.sha256()
+        written = 0
+        existing: Optional[IO[bytes]] = None
+        if destination.exists() and (size is None or destination.stat().st_size == size):
+            existing = destination.open('rb')
+        pending: Optional[IO[bytes]] = None
+        pending_path: Optional[str] = None
+        try:
+            for chunk in iter(lambda: source.read(ArtifactDeployer.CHUNK_SIZE), b''):
+                digest.update(chunk)
+                if pending is None and existing is not None:
+                    if existing.read(len(chunk)) == chunk:
+                        written += len(chunk)
+                        continue
+                if pending is None:
+                    pending, pending_path = self._open_pending(destination)
+                    if existing is not None:
+                        ArtifactDeployer._copy_prefix(existing, pending, written)
+                pending.write(chunk)
+                written += len(chunk)
+
+            if pending is None and existing is not None and not existing.read(1):
+                if destination.stat().st_mode & 0o7777 != mode:
+                    destination.chmod(mode)
+                return DeployResult(destination, digest.hexdigest(), written, replaced=False)
+
+            if pending is None:
+                pending, pending_path = self._open_pending(destination)
+                if existing is not None:
+                    ArtifactDeployer._copy_prefix(existing, pending, written)
+            pending.flush()
+            os.fsync(pending.fileno())
+            pending.close()
+            os.chmod(pending_path, mode)
+            os.replace(pending_path, destination)
+            pending_path = None
+            return DeployResult(destination, digest.hexdigest(), written, replaced=True)
+        finally:
+            if existing is not None:
+                existing.close()
+            if pending is not None:
+                pending.close()
+            if pending_path is not None:
+                pathlib.Path(pending_path).unlink(missing_ok=True)
+
+    @staticmethod
+    def _open_pending(destination: pathlib.Path):
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, path = tempfile.mkstemp(dir=destination.parent, prefix=f'.{destination.name}.')
+        return os.fdopen(descriptor, 'wb'), path
+
+    @staticmethod
+    def _copy_prefix(existing: IO[bytes], pending: IO[bytes], length: int):
+        existing.seek(0)
+        remaining = length
+        while remaining:
+            chunk = existing.read(min(remaining, ArtifactDeployer.CHUNK_SIZE))
+            pending.write(chunk)
+            remaining -= len(chunk)
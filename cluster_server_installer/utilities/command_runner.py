@@ -0,0 +1,192 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from typing import Final, IO, List, Mapping, Optional, Sequence, Tuple
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.tracing import tracer, propagate_context
+
+
+@dataclass(frozen=True)
+class CommandResult:
+    argv: Tuple[str, ...]
+    return_code: Optional[int]
+    stdout: str
+    stderr: str
+    duration: float
+    timed_out: bool = False
+    cancelled: bool = False
+    truncated: bool = False
+
+    @property
+    def succeeded(self) -> bool:
+        return self.return_code == 0 and not self.timed_out and not self.cancelled
+
+    def check(self) -> 'CommandResult':
+        if not self.succeeded:
+            raise CommandError(self)
+        return self
+
+
+class CommandError(RuntimeError):
+    def __init__(self, result: CommandResult):
+        if result.cancelled:
+            reason = 'was cancelled'
+        elif result.timed_out:
+            reason = f'timed out after {result.duration:.1f}s'
+        else:
+            reason = f'exited with {result.return_code}: {result.stderr.strip()[-500:]}'
+        super().__init__(f"Command '{result.argv[0]}' {reason}")
+        self.result = result
+
+
+class _BoundedCapture:
+    # Keeps only the last `limit` bytes of a stream so chatty commands (apt, dpkg) cannot grow memory unbounded
+    def __init__(self, stream: IO[bytes], limit: int):
+        self._stream = stream
+        self._limit = limit
+        self._buffer = bytearray()
+        self.truncated = False
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        for chunk in iter(lambda: self._stream.read1(65536), b''):
+            self._buffer += chunk
+            if len(self._buffer) > self._limit:
+                del self._buffer[:len(self._buffer) - self._limit]
+                self.truncated = True
+        self._stream.close()
+
+    def text(self) -> str:
+        self._thread.join()
+        return self._buffer.decode('utf-8', errors='replace')
+
+
+class CommandRunner:
+    DEFAULT_TIMEOUT_IN_SECONDS: Final[float] = 10 * 60
+    DEFAULT_CAPTURE_LIMIT: Final[int] = 256 * 1024
+    TERMINATE_GRACE_IN_SECONDS: Final[float] = 5
+    POLL_INTERVAL_IN_SECONDS: Final[float] = 0.1
+    REDACTED: Final[str] = '***'
+
+    def __init__(self, cancel_event: Optional[threading.Event] = None, max_concurrency: int = 8):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._cancel_event = cancel_event or threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='command')
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        return self._cancel_event
+
+    def bind_cancel_event(self, cancel_event: threading.Event):
+        # Ties running commands to an install run, so a failed step kills its siblings' processes too
+        self._cancel_event = cancel_event
+
+    @staticmethod
+    def _redact(text: str, secrets: Sequence[str]) -> str:
+        for secret in secrets:
+            if secret:
+                text = text.replace(secret, CommandRunner.REDACTED)
+        return text
+
+    def _terminate(self, process: subprocess.Popen):
+        # The command runs in its own session, so the whole process group (e.g. `sh install.sh` and its children) goes
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                process.wait(timeout=CommandRunner.TERMINATE_GRACE_IN_SECONDS)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+    def run(self, argv: Sequence[str], timeout_in_seconds: Optional[float] = DEFAULT_TIMEOUT_IN_SECONDS,
+            env: Optional[Mapping[str, str]] = None, secret_env: Optional[Mapping[str, str]] = None,
+            secrets: Sequence[str] = (), cwd: Optional[str] = None, stdin: Optional[bytes] = None,
+            capture_limit: int = DEFAULT_CAPTURE_LIMIT) -> CommandResult:
+        argv = tuple(str(argument) for argument in argv)
+        with tracer().span(' '.join([os.path.basename(argv[0]), *argv[1:2]]), 'command') as span:
+            result = self._run(argv, timeout_in_seconds, env, secret_env, secrets, cwd, stdin, capture_limit)
+            span.set(return_code=result.return_code, output_bytes=len(result.stdout) + len(result.stderr),
+                     timed_out=result.timed_out, cancelled=result.cancelled)
+            return result
+
+    def _run(self, argv: Tuple[str, ...], timeout_in_seconds: Optional[float], env: Optional[Mapping[str, str]],
+             secret_env: Optional[Mapping[str, str]], secrets: Sequence[str], cwd: Optional[str],
+             stdin: Optional[bytes], capture_limit: int) -> CommandResult:
+        secret_values = [*secrets, *(secret_env or {}).values()]
+        printable = CommandRunner._redact(' '.join(argv), secret_values)
+        if self._cancel_event.is_set():
+            self._logger.info(f"Not running (cancelled): {printable}")
+            return CommandResult(argv, None, '', '', 0.0, cancelled=True)
+
+        process_env = {**os.environ, **(env or {}), **(secret_env or {})}
+        self._logger.info(f"Running: {printable}")
+        start = time.monotonic()
+        try:
+            process = subprocess.Popen(argv, stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=process_env, cwd=cwd,
+                                       start_new_session=True)
+        except OSError as e:
+            self._logger.error(f"Failed to start: {printable} ({e})")
+            return CommandResult(argv, None, '', str(e), time.monotonic() - start)
+
+        stdout = _BoundedCapture(process.stdout, capture_limit)
+        stderr = _BoundedCapture(process.stderr, capture_limit)
+        if stdin is not None:
+            process.stdin.write(stdin)
+            process.stdin.close()
+
+        timed_out = cancelled = False
+        deadline = None if timeout_in_seconds is None else start + timeout_in_seconds
+        while process.poll() is None:
+            if self._cancel_event.is_set():
+                cancelled = True
+            elif deadline is not None and time.monotonic() >= deadline:
+                timed_out = True
+            if cancelled or timed_out:
+                self._terminate(process)
+                break
+            self._cancel_event.wait(CommandRunner.POLL_INTERVAL_IN_SECONDS)
+
+        result = CommandResult(argv, process.wait(), CommandRunner._redact(stdout.text(), secret_values),
+                               CommandRunner._redact(stderr.text(), secret_values), time.monotonic() - start,
+                               timed_out=timed_out, cancelled=cancelled,
+                               truncated=stdout.truncated or stderr.truncated)
+        if result.succeeded:
+            self._logger.info(f"Finished in {result.duration:.1f}s: {printable}")
+        else:
+            self._logger.error(f"{CommandError(result)}: {printable}")
+        return result
+
+    def submit(self, argv: Sequence[str], **kwargs) -> Future:
+        return self._executor.submit(propagate_context(self.run), argv, **kwargs)
+
+    def run_all(self, commands: Sequence[Sequence[str]], **kwargs) -> List[CommandResult]:
+        return [future.result() for future in [self.submit(argv, **kwargs) for argv in commands]]
+
+
+_default_runner: Optional[CommandRunner] = None
+_default_runner_lock = threading.Lock()
+
+
+def command_runner() -> CommandRunner:
+    global _default_runner
+    with _default_runner_lock:
+        if _default_runner is None:
+            _default_runner = CommandRunner()
+        return _default_runner
+
+
+def set_command_runner(runner: CommandRunner):
+    global _default_runner
+    with _default_runner_lock:
+        _default_runner = runner
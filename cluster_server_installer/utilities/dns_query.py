@@ -0,0 +1,137 @@
+import pathlib
+import random
+import socket
+import struct
+import sys
+from dataclasses import dataclass
+from typing import Final, List, Optional, Sequence, Tuple
+
+
+class DnsError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class DnsRecord:
+    name: str
+    record_type: int
+    value: str
+
+
+@dataclass(frozen=True)
+class DnsResponse:
+    rcode: int
+    answers: List[DnsRecord]
+    authority: List[DnsRecord]
+
+
+class DnsResolver:
+    # Just enough of RFC 1035 to ask the system resolver who serves a zone, no third party resolver library needed
+    DNS_PORT: Final[int] = 53
+    TIMEOUT_IN_SECONDS: Final[float] = 3
+    RESOLV_CONF: Final[pathlib.Path] = pathlib.Path('/etc/resolv.conf')
+    FALLBACK_NAMESERVER: Final[str] = '127.0.0.53'
+
+    TYPE_A: Final[int] = 1
+    TYPE_NS: Final[int] = 2
+
+    def __init__(self, nameservers: Optional[Sequence[str]] = None):
+        self._nameservers = list(nameservers) if nameservers else DnsResolver.system_nameservers()
+
+    @staticmethod
+    def system_nameservers() -> List[str]:
+        try:
+            lines = DnsResolver.RESOLV_CONF.read_text().splitlines()
+        except OSError:
+            lines = []
+        servers = [line.split()[1] for line in lines if line.startswith('nameserver') and len(line.split()) > 1]
+        return servers or [DnsResolver.FALLBACK_NAMESERVER]
+
+    @staticmethod
+    def _encode_name(name: str) -> bytes:
+        encoded = b''
+        for label in name.rstrip('.').split('.'):
+            encoded += bytes([len(label)]) + label.encode('idna')
+        return encoded + b'\x00'
+
+    @staticmethod
+    def _decode_name(message: bytes, offset: int) -> Tuple[str, int]:
+        labels = []
+        end = None
+        for _ in range(128):  # bounds compression pointer loops in malformed answers
+            length = message[offset]
+            if length & 0xC0 == 0xC0:
+                if end is None:
+                    end = offset + 2
+                offset = struct.unpack_from('!H', message, offset)[0] & 0x3FFF
+                continue
+            if length == 0:
+                return '.'.join(labels), end if end is not None else offset + 1
+            labels.append(message[offset + 1:offset + 1 + length].decode('ascii', errors='replace'))
+            offset += 1 + length
+        raise DnsError('Malformed DNS name')
+
+    @staticmethod
+    def _parse_records(message: bytes, offset: int, count: int) -> Tuple[List[DnsRecord], int]:
+        records = []
+        for _ in range(count):
+            name, offset = DnsResolver._decode_name(message, offset)
+            record_type, _, _, length = struct.unpack_from('!HHIH', message, offset)
+            offset += 10
+            if record_type == DnsResolver.TYPE_A and length == 4:
+                value = socket.inet_ntoa(message[offset:offset + 4])
+            elif record_type == DnsResolver.TYPE_NS:
+                value = DnsResolver._decode_name(message, offset)[0].lower()
+            else:
+                value = message[offset:offset + length].hex()
+            records.append(DnsRecord(name.lower(), record_type, value))
+            offset += length
+        return records, offset
+
+    def query(self, name: str, record_type: int) -> DnsResponse:
+        query_id = random.randrange(1 << 16)
+        packet = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + \
+            DnsResolver._encode_name(name) + struct.pack('!HH', record_type, 1)
+        errors = []
+        for server in self._nameservers:
+            try:
+                with socket.socket(socket.AF_INET6 if ':' in server else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.settimeout(DnsResolver.TIMEOUT_IN_SECONDS)
+                    sock.sendto(packet, (server, DnsResolver.DNS_PORT))
+                    message = sock.recv(4096)
+            except OSError as e:
+                errors.append(f'{server}: {e}')
+                continue
+            try:
+                response_id, flags, question_count, answer_count, authority_count, _ = \
+                    struct.unpack_from('!HHHHHH', message)
+                if response_id != query_id:
+                    errors.append(f'{server}: mismatched response id')
+                    continue
+                offset = 12
+                for _ in range(question_count):
+                    offset = DnsResolver._decode_name(message, offset)[1] + 4
+                answers, offset = DnsResolver._parse_records(message, offset, answer_count)
+                authority, _ = DnsResolver._parse_records(message, offset, authority_count)
+            except (struct.error, IndexError):
+                errors.append(f'{server}: malformed response')
+                continue
+            return DnsResponse(flags & 0x000F, answers, authority)
+        raise DnsError(f"No nameserver answered {name}: {'; '.join(errors)}")
+
+    def zone_nameservers(self, domain: str) -> Tuple[str, List[str]]:
+        # Walks up from the host name until a label owns NS records, that label is the zone apex
+        labels = domain.rstrip('.').lower().split('.')
+        for index in range(len(labels) - 1):
+            zone = '.'.join(labels[index:])
+            response = self.query(zone, DnsResolver.TYPE_NS)
+            nameservers = [record.value for record in response.answers
+                           if record.record_type == DnsResolver.TYPE_NS and record.name == zone]
+            if nameservers:
+                return zone, sorted(nameservers)
+        raise DnsError(f"Could not find the zone serving {domain}")
+
+
+if __name__ == '__main__':
+    for queried_domain in sys.argv[1:]:
+        print(queried_domain, *DnsResolver().zone_nameservers(queried_domain))
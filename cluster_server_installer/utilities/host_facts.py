@@ -0,0 +1,253 @@
+import ipaddress
+import logging
+import os
+import pathlib
+import shutil
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Final, Dict, List, Mapping, Optional, Tuple
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.tracing import tracer, propagate_context
+
+GIB: Final[int] = 1024 ** 3
+SYS_CLASS_NET: Final[pathlib.Path] = pathlib.Path('/sys/class/net')
+PROC_ROUTE: Final[pathlib.Path] = pathlib.Path('/proc/net/route')
+PROC_IPV6_ROUTE: Final[pathlib.Path] = pathlib.Path('/proc/net/ipv6_route')
+# Units and packages the installers decide on, gathered with one systemctl and one dpkg-query fork
+RELEVANT_UNITS: Final[Tuple[str, ...]] = ('headscale', 'tailscaled', 'ciy-scheduler', 'nfs-kernel-server', 'k3s')
+NIC_POLICIES: Final[Tuple[str, ...]] = ('default-route', 'physical')
+
+NETLINK_ROUTE: Final[int] = 0
+RTM_NEWADDR: Final[int] = 20
+RTM_GETADDR: Final[int] = 22
+NLMSG_ERROR: Final[int] = 2
+NLMSG_DONE: Final[int] = 3
+NLM_F_REQUEST_DUMP: Final[int] = 0x301
+IFA_ADDRESS: Final[int] = 1
+IFA_LOCAL: Final[int] = 2
+RT_SCOPE_UNIVERSE: Final[int] = 0
+
+
+class HostFactsError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class HostCapacity:
+    cpu_count: int
+    memory_bytes: int
+    disk_bytes: int
+
+    @staticmethod
+    def detect(data_dir: pathlib.Path = pathlib.Path('/var/lib/rancher')) -> 'HostCapacity':
+        # The data dir does not exist before the first install, its closest existing parent is on the same disk
+        while not data_dir.exists():
+            data_dir = data_dir.parent
+        return HostCapacity(cpu_count=len(os.sched_getaffinity(0)),
+                            memory_bytes=os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'),
+                            disk_bytes=shutil.disk_usage(data_dir).total)
+
+    @property
+    def memory_gib(self) -> float:
+        return self.memory_bytes / GIB
+
+    @property
+    def disk_gib(self) -> float:
+        return self.disk_bytes / GIB
+
+
+@dataclass(frozen=True)
+class NetworkInterface:
+    name: str
+    addresses: Tuple[str, ...]
+    is_up: bool
+    is_physical: bool
+    has_default_route: bool
+
+    def ipv4_addresses(self) -> List[str]:
+        return [address for address in self.addresses if ipaddress.ip_address(address).version == 4]
+
+
+@dataclass(frozen=True)
+class HostFacts:
+    hostname: str
+    capacity: HostCapacity
+    interfaces: Tuple[NetworkInterface, ...]
+    unit_states: Mapping[str, str] = field(default_factory=dict)
+    package_versions: Mapping[str, str] = field(default_factory=dict)
+
+    def unit_active(self, unit: str) -> bool:
+        return self.unit_states.get(unit) == 'active'
+
+    def package_version(self, package: str) -> Optional[str]:
+        return self.package_versions.get(package)
+
+    def primary_ip(self, policy: str = 'default-route') -> str:
+        # 'default-route': the NIC the host routes out of, 'physical': the first hardware NIC, otherwise an interface
+        # name or a CIDR the address has to be in. Virtual NICs (tailscale, cni, flannel) only match by name
+        candidates = [interface for interface in self.interfaces if interface.is_up and interface.ipv4_addresses()]
+        if policy == 'default-route':
+            preferred = [interface for interface in candidates if interface.has_default_route] or \
+                        [interface for interface in candidates if interface.is_physical]
+        elif policy == 'physical':
+            preferred = [interface for interface in candidates if interface.is_physical]
+        elif '/' in policy:
+            network = ipaddress.ip_network(policy, strict=False)
+            for interface in candidates:
+                for address in interface.ipv4_addresses():
+                    if ipaddress.ip_address(address) in network:
+                        return address
+            preferred = []
+        else:
+            preferred = [interface for interface in candidates if interface.name == policy]
+        if not preferred:
+            raise HostFactsError(f"No interface with an IPv4 address matches the NIC policy {policy!r}: "
+                                 f"{', '.join(interface.name for interface in candidates) or 'none are up'}")
+        return preferred[0].ipv4_addresses()[0]
+
+    @staticmethod
+    def _netlink_addresses() -> Dict[int, List[str]]:
+        # RTM_GETADDR dump, the same query `ip -o addr` makes, global scope addresses only
+        addresses: Dict[int, List[str]] = {}
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+            sock.bind((0, 0))
+            request = struct.pack('=BBBBI', socket.AF_UNSPEC, 0, 0, 0, 0)
+            sock.send(struct.pack('=IHHII', 16 + len(request), RTM_GETADDR, NLM_F_REQUEST_DUMP, 1, 0) + request)
+            while True:
+                data = sock.recv(65536)
+                offset = 0
+                while offset + 16 <= len(data):
+                    length, message_type, _, _, _ = struct.unpack_from('=IHHII', data, offset)
+                    if message_type == NLMSG_DONE:
+                        return addresses
+                    if message_type == NLMSG_ERROR:
+                        raise HostFactsError('Netlink address dump failed')
+                    if message_type == RTM_NEWADDR:
+                        family, _, _, scope, index = struct.unpack_from('=BBBBI', data, offset + 16)
+                        attributes: Dict[int, bytes] = {}
+                        attribute_offset = offset + 24
+                        while attribute_offset + 4 <= offset + length:
+                            attribute_length, attribute_type = struct.unpack_from('=HH', data, attribute_offset)
+                            if attribute_length < 4:
+                                break
+                            attributes[attribute_type] = data[attribute_offset + 4:attribute_offset + attribute_length]
+                            attribute_offset += (attribute_length + 3) & ~3
+                        # IFA_LOCAL is the interface's own address, IFA_ADDRESS the peer on point-to-point links
+                        raw = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+                        if scope == RT_SCOPE_UNIVERSE and raw is not None:
+                            addresses.setdefault(index, []).append(socket.inet_ntop(family, raw))
+                    offset += (length + 3) & ~3
+                if not data:
+                    return addresses
+
+    @staticmethod
+    def _default_route_interfaces() -> List[str]:
+        names = []
+        try:
+            for line in PROC_ROUTE.read_text().splitlines()[1:]:
+                columns = line.split()
+                if len(columns) > 7 and columns[1] == '00000000' and columns[7] == '00000000':
+                    names.append(columns[0])
+        except OSError:
+            pass
+        try:
+            for line in PROC_IPV6_ROUTE.read_text().splitlines():
+                columns = line.split()
+                if len(columns) == 10 and columns[0] == '0' * 32 and columns[1] == '00' and columns[9] != 'lo':
+                    names.append(columns[9])
+        except OSError:
+            pass
+        return names
+
+    @staticmethod
+    def collect_interfaces() -> Tuple[NetworkInterface, ...]:
+        addresses = HostFacts._netlink_addresses()
+        default_route = HostFacts._default_route_interfaces()
+        interfaces = []
+        for index, name in sorted(socket.if_nameindex()):
+            device = SYS_CLASS_NET / name
+            try:
+                is_up = (device / 'operstate').read_text().strip() in ('up', 'unknown')
+            except OSError:
+                is_up = False
+            interfaces.append(NetworkInterface(name=name, addresses=tuple(addresses.get(index, [])), is_up=is_up,
+                                               is_physical=(device / 'device').exists(),
+                                               has_default_route=name in default_route))
+        return tuple(interfaces)
+
+    @staticmethod
+    def collect_unit_states() -> Dict[str, str]:
+        # Exits non-zero whenever any unit is inactive, the per-unit states are all on stdout
+        output = command_runner().run(['systemctl', 'is-active', *RELEVANT_UNITS], timeout_in_seconds=10).stdout
+        states = output.splitlines()
+        return dict(zip(RELEVANT_UNITS, states + ['unknown'] * (len(RELEVANT_UNITS) - len(states))))
+
+    @staticmethod
+    def collect_package_versions() -> Dict[str, str]:
+        result = command_runner().run(['dpkg-query', '--show', '--showformat', '${Package}\t${Version}\t${Status}\n'],
+                                      timeout_in_seconds=30)
+        versions = {}
+        for line in result.stdout.splitlines() if result.succeeded else []:
+            package, _, rest = line.partition('\t')
+            version, _, status = rest.partition('\t')
+            if status.endswith(' installed'):
+                versions[package] = version
+        return versions
+
+    @staticmethod
+    def collect() -> 'HostFacts':
+        with tracer().span('host-facts', 'install') as span, \
+                ThreadPoolExecutor(max_workers=4, thread_name_prefix='host-facts') as executor:
+            interfaces = executor.submit(propagate_context(HostFacts.collect_interfaces))
+            units = executor.submit(propagate_context(HostFacts.collect_unit_states))
+            packages = executor.submit(propagate_context(HostFacts.collect_package_versions))
+            capacity = executor.submit(propagate_context(HostCapacity.detect))
+            facts = HostFacts(hostname=socket.gethostname(), capacity=capacity.result(),
+                              interfaces=interfaces.result(), unit_states=units.result(),
+                              package_versions=packages.result())
+            span.set(interfaces=len(facts.interfaces), packages=len(facts.package_versions))
+        logging.getLogger(LOGGER_NAME).info(
+            f"Host facts: {facts.hostname}, {facts.capacity.cpu_count} cpus, {facts.capacity.memory_gib:.1f}GiB, "
+            f"units {dict(facts.unit_states)}")
+        return facts
+
+
+_default_facts: Optional[HostFacts] = None
+_default_facts_lock = threading.Lock()
+
+
+def host_facts() -> HostFacts:
+    global _default_facts
+    with _default_facts_lock:
+        if _default_facts is None:
+            _default_facts = HostFacts.collect()
+        return _default_facts
+
+
+def set_host_facts(facts: Optional[HostFacts]):
+    global _default_facts
+    with _default_facts_lock:
+        _default_facts = facts
+
+
+def invalidate_host_facts():
+    # Steps that install packages or start units drop the snapshot, the next reader collects a fresh one
+    set_host_facts(None)
+
+
+if __name__ == '__main__':
+    snapshot = HostFacts.collect()
+    for interface in snapshot.interfaces:
+        print(f'{interface.name:<16}{"up" if interface.is_up else "down":<6}'
+              f'{"physical" if interface.is_physical else "virtual":<10}'
+              f'{"default" if interface.has_default_route else "":<9}{" ".join(interface.addresses)}')
+    for nic_policy in NIC_POLICIES:
+        try:
+            print(f'{nic_policy}: {snapshot.primary_ip(nic_policy)}')
+        except HostFactsError as e:
+            print(f'{nic_policy}: {e}')
@@ -0,0 +1,228 @@
+import functools
+import http.client
+import logging
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Final, Any, Callable, Dict, List, Optional, Sequence
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.tracing import tracer, propagate_context
+
+
+@dataclass(frozen=True)
+class ProbeResult:
+    name: str
+    ready: bool
+    attempts: int
+    time_to_ready: Optional[float]
+    last_error: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.ready:
+            return f'{self.name}: ready after {self.time_to_ready:.2f}s ({self.attempts} attempts)'
+        return f'{self.name}: not ready after {self.attempts} attempts (last error: {self.last_error})'
+
+
+class Probe:
+    def __init__(self, name: str):
+        self.name = name
+
+    def check(self, engine: 'ProbeEngine') -> bool:
+        raise NotImplementedError()
+
+
+class HttpProbe(Probe):
+    def __init__(self, name: str, url: str, is_ready: Callable[[requests.Response], bool] = lambda response: response.ok,
+                 request_timeout_in_seconds: float = 5, verify_tls: bool = True):
+        super().__init__(name)
+        self._url = url
+        self._is_ready = is_ready
+        self._request_timeout = request_timeout_in_seconds
+        self._verify_tls = verify_tls
+
+    def check(self, engine: 'ProbeEngine') -> bool:
+        response = engine.session.get(self._url, timeout=self._request_timeout, verify=self._verify_tls)
+        return self._is_ready(response)
+
+
+class KubernetesApiProbe(Probe):
+    # Any call that raises until the API (or an aggregated API such as metrics.k8s.io) is serving
+    def __init__(self, name: str, call: Callable[[], Any]):
+        super().__init__(name)
+        self._call = call
+
+    def check(self, engine: 'ProbeEngine') -> bool:
+        self._call()
+        return True
+
+
+class TcpProbe(Probe):
+    def __init__(self, name: str, host: str, port: int, connect_timeout_in_seconds: float = 2):
+        super().__init__(name)
+        self._address = (host, port)
+        self._connect_timeout = connect_timeout_in_seconds
+
+    def check(self, engine: 'ProbeEngine') -> bool:
+        with socket.create_connection(self._address, timeout=self._connect_timeout):
+            return True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def http_connection(endpoint: str, timeout_in_seconds: float) -> http.client.HTTPConnection:
+    # endpoint: 'unix:///path/to.sock' or 'host:port'
+    if endpoint.startswith('unix://'):
+        return UnixHTTPConnection(endpoint[len('unix://'):], timeout_in_seconds)
+    host, _, port = endpoint.rpartition(':')
+    return http.client.HTTPConnection(host, int(port), timeout=timeout_in_seconds)
+
+
+class HttpEndpointProbe(Probe):
+    # Ready once the server answers at all. A socket activated service accepts connections as soon as systemd
+    # listens, only a response shows the process behind the socket is serving
+    def __init__(self, name: str, endpoint: str, path: str = '/', request_timeout_in_seconds: float = 2):
+        super().__init__(name)
+        self._endpoint = endpoint
+        self._path = path
+        self._request_timeout = request_timeout_in_seconds
+
+    def check(self, engine: 'ProbeEngine') -> bool:
+        connection = http_connection(self._endpoint, self._request_timeout)
+        try:
+            connection.request('GET', self._path)
+            response = connection.getresponse()
+            response.read()
+            return response.status < 500
+        finally:
+            connection.close()
+
+
+class SystemdUnitProbe(Probe):
+    def __init__(self, unit: str):
+        super().__init__(f'systemd:{unit}')
+        self.unit = unit
+
+    def check(self, engine: 'ProbeEngine') -> bool:
+        return engine.systemd_unit_states([self.unit])[self.unit] == 'active'
+
+
+class ProbeEngine:
+    INITIAL_DELAY_IN_SECONDS: Final[float] = 0.25
+    MAX_DELAY_IN_SECONDS: Final[float] = 5.0
+    BACKOFF_MULTIPLIER: Final[float] = 2.0
+    JITTER: Final[float] = 0.5
+    POOL_SIZE: Final[int] = 10
+    SYSTEMCTL_TIMEOUT_IN_SECONDS: Final[float] = 10
+
+    def __init__(self, initial_delay_in_seconds: float = INITIAL_DELAY_IN_SECONDS,
+                 max_delay_in_seconds: float = MAX_DELAY_IN_SECONDS):
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._initial_delay = initial_delay_in_seconds
+        self._max_delay = max_delay_in_seconds
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+        self._systemd_lock = threading.Lock()
+        self._systemd_states: Dict[str, str] = {}
+        self._systemd_checked_at = 0.0
+        self._cancel_event = threading.Event()
+
+    def bind_cancel_event(self, cancel_event: threading.Event):
+        # Ties waiting probes to an install run, so a failed step does not leave siblings waiting out their timeouts
+        self._cancel_event = cancel_event
+
+    @property
+    def session(self) -> requests.Session:
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=ProbeEngine.POOL_SIZE, pool_maxsize=ProbeEngine.POOL_SIZE)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def systemd_unit_states(self, units: Sequence[str]) -> Dict[str, str]:
+        # Concurrent systemd probes share one `systemctl is-active` fork per backoff round
+        with self._systemd_lock:
+            if time.monotonic() - self._systemd_checked_at > self._initial_delay or \
+                    not set(units) <= self._systemd_states.keys():
+                wanted = sorted(set(units) | self._systemd_states.keys())
+                # Exits non-zero whenever any unit is inactive, the per-unit states are all on stdout
+                output = command_runner().run(
+                    ['systemctl', 'is-active', *wanted],
+                    timeout_in_seconds=ProbeEngine.SYSTEMCTL_TIMEOUT_IN_SECONDS).stdout.splitlines()
+                self._systemd_states = dict(zip(wanted, output + ['unknown'] * (len(wanted) - len(output))))
+                self._systemd_checked_at = time.monotonic()
+            return {unit: self._systemd_states[unit] for unit in units}
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self._max_delay, self._initial_delay * ProbeEngine.BACKOFF_MULTIPLIER ** attempt)
+        return delay * random.uniform(1 - ProbeEngine.JITTER, 1)
+
+    def _wait_for_probe(self, probe: Probe, deadline: float, stop: threading.Event) -> ProbeResult:
+        with tracer().span(probe.name, 'probe') as span:
+            result = self._poll_probe(probe, deadline, stop)
+            span.set(ready=result.ready, attempts=result.attempts)
+            return result
+
+    def _poll_probe(self, probe: Probe, deadline: float, stop: threading.Event) -> ProbeResult:
+        start = time.monotonic()
+        attempts = 0
+        last_error: Optional[str] = None
+        while not stop.is_set():
+            attempts += 1
+            try:
+                if probe.check(self):
+                    result = ProbeResult(probe.name, True, attempts, time.monotonic() - start)
+                    self._logger.info(str(result))
+                    return result
+                last_error = 'not ready'
+            except Exception as e:
+                last_error = f'{type(e).__name__}: {e}'
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            stop.wait(min(remaining, self._backoff(attempts - 1)))
+
+        result = ProbeResult(probe.name, False, attempts, None, 'cancelled' if stop.is_set() else last_error)
+        self._logger.warning(str(result))
+        return result
+
+    def wait_all(self, probes: Sequence[Probe], timeout_in_seconds: float,
+                 stop: Optional[threading.Event] = None) -> List[ProbeResult]:
+        deadline = time.monotonic() + timeout_in_seconds
+        stop = stop or self._cancel_event
+        with ThreadPoolExecutor(max_workers=max(1, len(probes)), thread_name_prefix='probe') as executor:
+            futures = [executor.submit(propagate_context(self._wait_for_probe), probe, deadline, stop)
+                       for probe in probes]
+            return [future.result() for future in futures]
+
+    def wait(self, probe: Probe, timeout_in_seconds: float) -> ProbeResult:
+        return self._wait_for_probe(probe, time.monotonic() + timeout_in_seconds, self._cancel_event)
+
+
+@functools.lru_cache(maxsize=None)
+def default_probe_engine() -> ProbeEngine:
+    return ProbeEngine()
@@ -0,0 +1,106 @@
+import argparse
+import logging
+import pathlib
+import threading
+import zipfile
+from typing import Final, Dict, List, Optional, Sequence
+
+from cluster_server_installer import LOGGER_NAME
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+
+PACKAGE_DIR: Final[pathlib.Path] = pathlib.Path(__file__).parent.parent
+
+
+class Resources:
+    # Resources are looked up as plain files first (source tree, pip installs). The onefile binary instead ships a
+    # single compressed archive, and each member is only extracted the first time something asks for it
+    DEFAULT_DIRECTORY: Final[pathlib.Path] = PACKAGE_DIR / 'resources'
+    DEFAULT_ARCHIVE: Final[pathlib.Path] = PACKAGE_DIR / 'resources.zip'
+    DEFAULT_EXTRACT_DIR: Final[pathlib.Path] = pathlib.Path('/var/cache/ciy-installer/resources')
+    # Already compressed members gain nothing from deflate, they are stored as is
+    STORED_SUFFIXES: Final[frozenset] = frozenset({'.tgz', '.gz', '.xz', '.zip', '.deb'})
+
+    def __init__(self, directories: Sequence[pathlib.Path] = (DEFAULT_DIRECTORY,),
+                 archive: Optional[pathlib.Path] = DEFAULT_ARCHIVE, extract_dir: pathlib.Path = DEFAULT_EXTRACT_DIR):
+        self._directories = list(directories)
+        self._archive = archive
+        self._extract_dir = extract_dir
+        self._extracted: Dict[str, pathlib.Path] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(LOGGER_NAME)
+
+    def path(self, name: str) -> pathlib.Path:
+        for directory in self._directories:
+            candidate = directory / name
+            if candidate.is_file():
+                return candidate
+
+        with self._lock:
+            if name not in self._extracted:
+                self._extracted[name] = self._extract(name)
+            return self._extracted[name]
+
+    def _extract(self, name: str) -> pathlib.Path:
+        if self._archive is None or not self._archive.is_file():
+            raise FileNotFoundError(f"Resource {name} is not bundled with this installer")
+        with zipfile.ZipFile(self._archive) as archive:
+            try:
+                info = archive.getinfo(name)
+            except KeyError:
+                raise FileNotFoundError(f"Resource {name} is not in {self._archive}") from None
+            with archive.open(info) as source:
+                # Unix permissions live in the upper half of external_attr
+                mode = (info.external_attr >> 16) & 0o777 or 0o644
+                return ArtifactDeployer().deploy_stream(source, self._extract_dir / name, mode,
+                                                        size=info.file_size).destination
+
+    def names(self) -> List[str]:
+        names = {str(path.relative_to(directory)) for directory in self._directories if directory.is_dir()
+                 for path in directory.rglob('*') if path.is_file()}
+        if self._archive is not None and self._archive.is_file():
+            with zipfile.ZipFile(self._archive) as archive:
+                names.update(info.filename for info in archive.infolist() if not info.is_dir())
+        return sorted(names)
+
+    @staticmethod
+    def build_archive(source: pathlib.Path, archive: pathlib.Path) -> List[str]:
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        names = []
+        with zipfile.ZipFile(archive, 'w') as bundle:
+            for path in sorted(source.rglob('*')):
+                if not path.is_file():
+                    continue
+                name = str(path.relative_to(source))
+                compression = zipfile.ZIP_STORED if path.suffix in Resources.STORED_SUFFIXES else \
+                    zipfile.ZIP_DEFLATED
+                bundle.write(path, name, compress_type=compression, compresslevel=9)
+                names.append(name)
+        return names
+
+
+_default_resources: Optional[Resources] = None
+_default_resources_lock = threading.Lock()
+
+
+def resources() -> Resources:
+    global _default_resources
+    with _default_resources_lock:
+        if _default_resources is None:
+            _default_resources = Resources()
+        return _default_resources
+
+
+def set_resources(bundled: Resources):
+    global _default_resources
+    with _default_resources_lock:
+        _default_resources = bundled
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs the installer resources into the archive the binary ships')
+    parser.add_argument('archive', type=pathlib.Path)
+    parser.add_argument('--source', type=pathlib.Path, default=Resources.DEFAULT_DIRECTORY)
+    args = parser.parse_args()
+
+    packed = Resources.build_archive(args.source, args.archive)
+    print(f'Packed {len(packed)} resources into {args.archive} ({args.archive.stat().st_size} bytes)')
@@ -1,9 +0,0 @@
-import socket
-
-
-def get_ethernet_ip() -> str:
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(('8.8.8.8', 80))
-    ip = s.getsockname()[0]
-    s.close()
-    return ip
\ No newline at end of file
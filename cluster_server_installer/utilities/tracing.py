@@ -0,0 +1,171 @@
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Final, Any, Callable, Dict, Iterator, List, Optional
+
+
+@dataclass
+class Span:
+    span_id: int
+    name: str
+    category: str
+    parent_id: Optional[int]
+    thread_id: int
+    thread_name: str
+    start: float
+    end: Optional[float] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+
+def propagate_context(function: Callable) -> Callable:
+    # Worker threads start with an empty context; run each call in a copy of the submitter's so spans keep nesting
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
+
+
+class Tracer:
+    DEFAULT_TRACE_DIR: Final[pathlib.Path] = pathlib.Path('/var/log/ciy-installer/traces')
+    SUMMARY_LIMIT: Final[int] = 15
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans: List[Span] = []
+        self._ids = itertools.count(1)
+        self._origin = time.perf_counter()
+        self._started_at = time.time()
+
+    @property
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = 'install', **attributes) -> Iterator[Span]:
+        parent = _current_span.get()
+        current = threading.current_thread()
+        span = Span(span_id=next(self._ids), name=name, category=category,
+                    parent_id=parent.span_id if parent is not None else None, thread_id=current.ident,
+                    thread_name=current.name, start=time.perf_counter(), attributes=dict(attributes))
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=f'{type(e).__name__}: {e}')
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current_span.reset(token)
+            with self._lock:
+                self._spans.append(span)
+
+    def _microseconds(self, timestamp: float) -> float:
+        return round((timestamp - self._origin) * 1e6, 1)
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        pid = os.getpid()
+        spans = sorted(self.spans, key=lambda span: span.start)
+        events: List[Dict[str, Any]] = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id, 'args': {'name': thread_name}}
+            for thread_id, thread_name in sorted({(span.thread_id, span.thread_name) for span in spans})]
+        for span in spans:
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': self._microseconds(span.start),
+                'dur': round(span.duration * 1e6, 1),
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': {'span_id': span.span_id, 'parent_id': span.parent_id, **span.attributes},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'started_at': self._started_at}}
+
+    def export(self, path: pathlib.Path) -> pathlib.Path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.chrome_trace(), default=str))
+        return path
+
+    def default_trace_path(self, command: str, trace_dir: pathlib.Path = DEFAULT_TRACE_DIR) -> pathlib.Path:
+        return trace_dir / f'{command}-{time.strftime("%Y%m%d-%H%M%S", time.localtime(self._started_at))}.json'
+
+    def summary(self, limit: int = SUMMARY_LIMIT) -> str:
+        return summarize_events(self.chrome_trace()['traceEvents'], limit)
+
+
+def summarize_events(events: List[Dict[str, Any]], limit: int = Tracer.SUMMARY_LIMIT) -> str:
+    spans = sorted((event for event in events if event.get('ph') == 'X'), key=lambda event: -event['dur'])
+    lines = [f'{"duration":>10}  {"category":<14} {"step":<40} attributes']
+    for event in spans[:limit]:
+        attributes = ', '.join(f'{key}={value}' for key, value in event['args'].items()
+                               if key not in ('span_id', 'parent_id'))
+        lines.append(f'{event["dur"] / 1e6:>9.2f}s  {event["cat"]:<14} {event["name"]:<40} {attributes}')
+    return '\n'.join(lines)
+
+
+def compare_traces(current: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+                   limit: int = Tracer.SUMMARY_LIMIT) -> str:
+    def totals(events: List[Dict[str, Any]]) -> Dict[str, float]:
+        durations: Dict[str, float] = {}
+        for event in events:
+            if event.get('ph') == 'X':
+                key = f'{event["cat"]}:{event["name"]}'
+                durations[key] = durations.get(key, 0.0) + event['dur'] / 1e6
+        return durations
+
+    current_totals, baseline_totals = totals(current), totals(baseline)
+    deltas = sorted(current_totals.keys() | baseline_totals.keys(),
+                    key=lambda key: -abs(current_totals.get(key, 0.0) - baseline_totals.get(key, 0.0)))
+    lines = [f'{"baseline":>10} {"current":>10} {"delta":>10}  step']
+    for key in deltas[:limit]:
+        before, after = baseline_totals.get(key, 0.0), current_totals.get(key, 0.0)
+        lines.append(f'{before:>9.2f}s {after:>9.2f}s {after - before:>+9.2f}s  {key}')
+    return '\n'.join(lines)
+
+
+_default_tracer: Optional[Tracer] = None
+_default_tracer_lock = threading.Lock()
+
+
+def tracer() -> Tracer:
+    global _default_tracer
+    with _default_tracer_lock:
+        if _default_tracer is None:
+            _default_tracer = Tracer()
+        return _default_tracer
+
+
+def set_tracer(new_tracer: Tracer):
+    global _default_tracer
+    with _default_tracer_lock:
+        _default_tracer = new_tracer
+
+
+if __name__ == '__main__':
+    # python -m cluster_server_installer.utilities.tracing <trace.json> [<baseline-trace.json>]
+    trace_events = json.loads(pathlib.Path(sys.argv[1]).read_text())['traceEvents']
+    print(summarize_events(trace_events))
+    if len(sys.argv) > 2:
+        print()
+        print(compare_traces(trace_events, json.loads(pathlib.Path(sys.argv[2]).read_text())['traceEvents']))
@@ -0,0 +1,76 @@
+import io
+import ipaddress
+import json
+import pathlib
+from typing import Final, Any, Dict, Iterable, List, Optional, Set, Union
+
+from cluster_server_installer.k8s.cluster_network import ClusterNetwork
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class AclPolicy:
+    DEFAULT_APPROVER: Final[str] = 'cluster-user'
+    DEFAULT_ACLS: Final[List[Dict[str, Any]]] = [{'action': 'accept', 'src': ['*'], 'dst': ['*:*']}]
+
+    def __init__(self, document: Optional[Dict[str, Any]] = None):
+        self._document: Dict[str, Any] = dict(document or {'acls': AclPolicy.DEFAULT_ACLS})
+        # approver -> networks it may approve, always kept collapsed
+        self._routes: Dict[str, Set[Network]] = {}
+        routes = self._document.get('autoApprovers', {}).get('routes', {})
+        for prefix, approvers in routes.items():
+            for approver in approvers:
+                self._routes.setdefault(approver, set()).add(ipaddress.ip_network(prefix, strict=False))
+        self._routes = {approver: AclPolicy._collapse(networks) for approver, networks in self._routes.items()}
+
+    @staticmethod
+    def _collapse(networks: Iterable[Network]) -> Set[Network]:
+        # collapse_addresses only accepts one IP version at a time
+        collapsed: Set[Network] = set()
+        for version in (4, 6):
+            collapsed.update(ipaddress.collapse_addresses(network for network in networks
+                                                          if network.version == version))
+        return collapsed
+
+    @staticmethod
+    def for_cluster(network: ClusterNetwork, approver: str = DEFAULT_APPROVER) -> 'AclPolicy':
+        policy = AclPolicy()
+        policy.add_route_prefixes(network.routes(), approver)
+        return policy
+
+    @staticmethod
+    def load(path: pathlib.Path) -> 'AclPolicy':
+        return AclPolicy(json.loads(path.read_text()))
+
+    def route_prefixes(self, approver: str = DEFAULT_APPROVER) -> List[str]:
+        return [str(network) for network in sorted(self._routes.get(approver, set()),
+                                                   key=lambda network: (network.version, network))]
+
+    def add_route_prefixes(self, prefixes: Iterable[str], approver: str = DEFAULT_APPROVER) -> bool:
+        # Headscale auto-approves any advertised route contained in an approver prefix, so a node subnet inside the
+        # cluster CIDR adds nothing and the policy only grows for genuinely new address space
+        current = self._routes.get(approver, set())
+        updated = AclPolicy._collapse([*current, *(ipaddress.ip_network(prefix, strict=False) for prefix in prefixes)])
+        if updated == current:
+            return False
+        self._routes[approver] = updated
+        return True
+
+    def document(self) -> Dict[str, Any]:
+        routes: Dict[str, List[str]] = {}
+        for approver in sorted(self._routes):
+            for prefix in self.route_prefixes(approver):
+                routes.setdefault(prefix, []).append(approver)
+        return {**self._document, 'autoApprovers': {**self._document.get('autoApprovers', {}), 'routes': routes}}
+
+    def to_json(self) -> str:
+        return json.dumps(self.document(), indent=2) + '\n'
+
+    def save(self, path: pathlib.Path) -> bool:
+        # Unchanged policies are not rewritten, so headscale has nothing to reload
+        return ArtifactDeployer().deploy_stream(io.BytesIO(self.to_json().encode('utf-8')), path, mode=0o644).replaced
+
+
+if __name__ == '__main__':
+    print(AclPolicy.for_cluster(ClusterNetwork()).to_json(), end='')
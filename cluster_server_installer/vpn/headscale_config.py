@@ -0,0 +1,174 @@
+import io
+import ipaddress
+import json
+import pathlib
+import re
+import urllib.parse
+from dataclasses import dataclass
+from typing import Final, Any, Dict, List, Mapping, Optional, Tuple
+
+import yaml
+
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer
+
+GO_DURATION_PATTERN: Final[re.Pattern] = re.compile(r'^(\d+(\.\d+)?(ns|us|µs|ms|s|m|h))+$')
+
+
+class HeadscaleConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class HeadscaleTuning:
+    node_update_check_interval: str = '10s'
+    ephemeral_node_inactivity_timeout: str = '30m'
+    sqlite_write_ahead_log: bool = True
+    embedded_derp: bool = False
+    log_level: str = 'info'
+
+
+# Hundreds of nodes: poll the database for node changes less often, drop vanished ephemeral nodes sooner so the
+# map sent to every client stays small, relay through our own DERP instead of the shared public ones, and keep
+# per-request info logging off the hot path
+HEADSCALE_PROFILES: Final[Dict[str, HeadscaleTuning]] = {
+    'default': HeadscaleTuning(),
+    'large-fleet': HeadscaleTuning(node_update_check_interval='30s', ephemeral_node_inactivity_timeout='10m',
+                                   embedded_derp=True, log_level='warn'),
+}
+
+
+class HeadscaleConfig:
+    LEGACY_LAYOUT: Final[str] = 'legacy'
+    CURRENT_LAYOUT: Final[str] = 'current'
+    # Logical setting -> (path in the flat pre-0.23 layout, path in the nested 0.23+ layout), None where a layout
+    # has no such key
+    KEY_PATHS: Final[Dict[str, Tuple[Optional[str], Optional[str]]]] = {
+        'acl_policy_path': ('acl_policy_path', 'policy.path'),
+        'database_type': ('db_type', 'database.type'),
+        'sqlite_path': ('db_path', 'database.sqlite.path'),
+        'sqlite_write_ahead_log': (None, 'database.sqlite.write_ahead_log'),
+    }
+    SQLITE_TYPES: Final[Dict[str, str]] = {LEGACY_LAYOUT: 'sqlite3', CURRENT_LAYOUT: 'sqlite'}
+    LOG_LEVELS: Final[frozenset] = frozenset({'trace', 'debug', 'info', 'warn', 'error', 'fatal', 'panic'})
+    EMBEDDED_DERP_REGION_ID: Final[int] = 999
+    EMBEDDED_DERP_STUN_PORT: Final[int] = 3478
+
+    def __init__(self, document: Dict[str, Any]):
+        self._document = document
+
+    @staticmethod
+    def load(path: pathlib.Path) -> 'HeadscaleConfig':
+        document = yaml.safe_load(path.read_text()) or {}
+        if not isinstance(document, dict):
+            raise HeadscaleConfigError(f"{path} is not a YAML mapping")
+        return HeadscaleConfig(document)
+
+    @property
+    def layout(self) -> str:
+        if any(key in self._document for key in ('database', 'policy', 'dns')):
+            return HeadscaleConfig.CURRENT_LAYOUT
+        return HeadscaleConfig.LEGACY_LAYOUT
+
+    def _path_of(self, key: str) -> Optional[str]:
+        if key not in HeadscaleConfig.KEY_PATHS:
+            return key
+        legacy_path, current_path = HeadscaleConfig.KEY_PATHS[key]
+        return legacy_path if self.layout == HeadscaleConfig.LEGACY_LAYOUT else current_path
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self._path_of(key)
+        if path is None:
+            return default
+        node: Any = self._document
+        for part in path.split('.'):
+            if not isinstance(node, dict) or part not in node:
+                return default
+            node = node[part]
+        return node
+
+    def set(self, key: str, value: Any) -> bool:
+        path = self._path_of(key)
+        if path is None:
+            return False
+        *parents, leaf = path.split('.')
+        node = self._document
+        for part in parents:
+            child = node.setdefault(part, {})
+            if not isinstance(child, dict):
+                raise HeadscaleConfigError(f"Cannot set {path}: {part} is not a mapping")
+            node = child
+        node[leaf] = value
+        return True
+
+    def apply(self, settings: Mapping[str, Any]):
+        for key, value in settings.items():
+            self.set(key, value)
+
+    def apply_tuning(self, tuning: HeadscaleTuning):
+        self.apply({
+            'node_update_check_interval': tuning.node_update_check_interval,
+            'ephemeral_node_inactivity_timeout': tuning.ephemeral_node_inactivity_timeout,
+            'log.level': tuning.log_level,
+            'derp.server.enabled': tuning.embedded_derp,
+        })
+        if self.get('database_type') == HeadscaleConfig.SQLITE_TYPES[self.layout]:
+            self.set('sqlite_write_ahead_log', tuning.sqlite_write_ahead_log)
+        if tuning.embedded_derp:
+            self.apply({
+                'derp.server.region_id': self.get('derp.server.region_id', HeadscaleConfig.EMBEDDED_DERP_REGION_ID),
+                'derp.server.region_code': self.get('derp.server.region_code', 'ciy'),
+                'derp.server.region_name': self.get('derp.server.region_name', 'CloudIY embedded DERP'),
+                'derp.server.stun_listen_addr':
+                    self.get('derp.server.stun_listen_addr', f'0.0.0.0:{HeadscaleConfig.EMBEDDED_DERP_STUN_PORT}'),
+                'derp.server.private_key_path':
+                    self.get('derp.server.private_key_path', '/var/lib/headscale/derp_server_private.key'),
+            })
+
+    @staticmethod
+    def _check_address(errors: List[str], key: str, value: Any):
+        host, _, port = str(value).rpartition(':')
+        if not host or not port.isdigit() or not 0 < int(port) < 65536:
+            errors.append(f"{key} must be host:port, got {value!r}")
+
+    def validate(self) -> List[str]:
+        errors: List[str] = []
+        server_url = urllib.parse.urlparse(str(self.get('server_url', '')))
+        if server_url.scheme != 'https' or not server_url.hostname:
+            errors.append(f"server_url must be an https URL, got {self.get('server_url')!r}")
+        HeadscaleConfig._check_address(errors, 'listen_addr', self.get('listen_addr'))
+
+        for key in ('tls_cert_path', 'tls_key_path'):
+            if not self.get(key) or not pathlib.Path(self.get(key)).is_file():
+                errors.append(f"{key} does not point to a file: {self.get(key)!r}")
+        policy_path = self.get('acl_policy_path')
+        if policy_path:
+            try:
+                json.loads(pathlib.Path(policy_path).read_text())
+            except (OSError, ValueError) as e:
+                errors.append(f"ACL policy {policy_path} is unreadable: {e}")
+
+        for prefix in self.get('ip_prefixes', []) or []:
+            try:
+                ipaddress.ip_network(prefix)
+            except ValueError:
+                errors.append(f"ip_prefixes entry {prefix!r} is not a network")
+        for key in ('node_update_check_interval', 'ephemeral_node_inactivity_timeout'):
+            if self.get(key) is not None and not GO_DURATION_PATTERN.match(str(self.get(key))):
+                errors.append(f"{key} must be a duration like 10s or 30m, got {self.get(key)!r}")
+        if self.get('log.level', 'info') not in HeadscaleConfig.LOG_LEVELS:
+            errors.append(f"log.level must be one of {sorted(HeadscaleConfig.LOG_LEVELS)}")
+        if self.get('derp.server.enabled'):
+            if not isinstance(self.get('derp.server.region_id'), int):
+                errors.append("derp.server.region_id must be set when the embedded DERP server is enabled")
+            HeadscaleConfig._check_address(errors, 'derp.server.stun_listen_addr',
+                                           self.get('derp.server.stun_listen_addr'))
+        return errors
+
+    def dump(self) -> str:
+        return yaml.safe_dump(self._document, default_flow_style=False, sort_keys=False)
+
+    def save(self, path: pathlib.Path, mode: int = 0o644) -> bool:
+        errors = self.validate()
+        if errors:
+            raise HeadscaleConfigError(f"Refusing to write an invalid headscale config: {'; '.join(errors)}")
+        return ArtifactDeployer().deploy_stream(io.BytesIO(self.dump().encode('utf-8')), path, mode=mode).replaced
@@ -1,74 +1,86 @@
+import json
 import logging
-import os
 import pathlib
-import shutil
-import subprocess
-import tarfile
-from tempfile import TemporaryDirectory
-from typing import Final
+from typing import Final, Optional, Tuple
+
+import yaml
 
 from cluster_server_installer import LOGGER_NAME
 from cluster_server_installer.certificates.lego_certificate_installer import LegoCertificateInstaller
-
-ACL_TEMPLATE = """
-{{
-  "acls": [
-  {{"action": "accept", "src": ["*"], "dst": ["*:*"]}}
-  ],
-  "autoApprovers": {{
-        "routes": {{
-            "10.42.0.0/16":        ["cluster-user"],
-{cluster_subnets}            "2001:cafe:42::/56": ["cluster-user"],
-        }},
-    }},
-}}
-"""
+from cluster_server_installer.k8s.cluster_network import ClusterNetwork
+from cluster_server_installer.utilities.artifact_cache import ArtifactCache, ArtifactSpec
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer, DeployTarget
+from cluster_server_installer.utilities.command_runner import command_runner
+from cluster_server_installer.utilities.host_facts import host_facts, invalidate_host_facts
+from cluster_server_installer.utilities.probes import default_probe_engine, SystemdUnitProbe, TcpProbe
+from cluster_server_installer.utilities.resources import resources
+from cluster_server_installer.utilities.tracing import tracer
+from cluster_server_installer.vpn.acl_policy import AclPolicy
+from cluster_server_installer.vpn.headscale_config import HeadscaleConfig, HeadscaleConfigError, HeadscaleTuning, \
+    HEADSCALE_PROFILES
 
 
 class VpnServerInstaller:
     VPN_PORT: Final[int] = 30000
     HEAD_SCALE_VERSION: Final[str] = '1.0.0'
+    SERVICE_STARTUP_TIME_IN_SECONDS: Final[int] = 60
 
     HEAD_SCALE_CONFIG_PATH: Final[pathlib.Path] = pathlib.Path('/etc/headscale/config.yaml')
     HEAD_SCALE_ACL_PATH: Final[pathlib.Path] = pathlib.Path('/etc/headscale/acl.json')
-    HEAD_SCALE_URL: Final[str] = 'server_url: https://{host_url}:30000'
-    HEAD_SCALE_ADDR: Final[str] = 'listen_addr: 0.0.0.0:30000'
-    HEAD_SCALE_ACL_LINE: Final[str] = 'acl_policy_path: ""'
-    HEAD_SCALE_CERT_PATH: Final[str] = 'tls_cert_path: ""'
-    HEAD_SCALE_KEY_PATH: Final[str] = 'tls_key_path: ""'
 
-    def __init__(self):
+    TAILSCALE_ARCHIVE_RESOURCE: Final[str] = 'tailscale/tailscale_1.56.1_amd64.tgz'
+    TAILSCALE_ARCHIVE_ROOT: Final[str] = 'tailscale_1.56.1_amd64'
+    TAILSCALE_BINARY_PATH: Final[pathlib.Path] = pathlib.Path('/usr/bin/tailscale')
+    TAILSCALED_BINARY_PATH: Final[pathlib.Path] = pathlib.Path('/usr/sbin/tailscaled')
+    TAILSCALED_UNIT_PATH: Final[pathlib.Path] = pathlib.Path('/etc/systemd/system/tailscaled.service')
+    TAILSCALED_DEFAULTS_PATH: Final[pathlib.Path] = pathlib.Path('/etc/default/tailscaled')
+
+    def __init__(self, headscale_tuning: HeadscaleTuning = HEADSCALE_PROFILES['default']):
         self._logger = logging.getLogger(LOGGER_NAME)
+        self._headscale_tuning = headscale_tuning
 
     @staticmethod
     def check_if_headscale_is_installed() -> bool:
-        return os.system('systemctl is-active quiet headscale') == 0
+        return host_facts().unit_active('headscale')
 
     @staticmethod
     def check_if_tailscale_is_installed() -> bool:
-        return os.system('systemctl is-active quiet tailscaled') == 0
+        return host_facts().unit_active('tailscaled')
 
     def install_vpn(self, host_url: str, email: str, gitlab_token: str, godaddy_key: str, godaddy_secret: str):
-        installation_status = True
+        certs_location = self.issue_headscale_certificates(host_url=host_url, email=email, godaddy_key=godaddy_key,
+                                                           godaddy_secret=godaddy_secret)
+        if certs_location is not None:
+            package_path = self.download_headscale(gitlab_token=gitlab_token, artifact_cache=ArtifactCache())
+            self.setup_headscale(host_url=host_url, package_path=package_path, cert_crt_path=certs_location[0],
+                                 cert_key_path=certs_location[1])
+        self.setup_tailscale()
+
+    def issue_headscale_certificates(self, host_url: str, email: str, godaddy_key: str,
+                                     godaddy_secret: str) -> Optional[Tuple[pathlib.Path, pathlib.Path]]:
         self._logger.info("Checking if headscale is installed")
-        if not VpnServerInstaller.check_if_headscale_is_installed():
-            self._logger.info("Installing certificates...")
-            cert_installer = LegoCertificateInstaller(godaddy_key, godaddy_secret, email, host_url)
-
-            if not cert_installer.install_certificates():
-                raise RuntimeError("Failed to issue headscale certificates")
-
-            self._logger.info("Installing headscale...")
-            certs_location = cert_installer.get_certificate_root_path()
-            installation_status = self.install_headscale(host_url=host_url, gitlab_token=gitlab_token,
-                                                         cert_crt_path=certs_location[0],
-                                                         cert_key_path=certs_location[1])
-            self._logger.info(f"Headscale installation status: {installation_status}")
+        if VpnServerInstaller.check_if_headscale_is_installed():
+            return None
+
+        self._logger.info("Installing certificates...")
+        cert_installer = LegoCertificateInstaller(godaddy_key, godaddy_secret, email, host_url)
+        if not cert_installer.install_certificates():
+            raise RuntimeError("Failed to issue headscale certificates")
+        return cert_installer.get_certificate_root_path()
+
+    def setup_headscale(self, host_url: str, package_path: pathlib.Path, cert_crt_path: pathlib.Path,
+                        cert_key_path: pathlib.Path):
+        self._logger.info("Installing headscale...")
+        installation_status = self.install_headscale(host_url=host_url, package_path=package_path,
+                                                     cert_crt_path=cert_crt_path, cert_key_path=cert_key_path)
+        self._logger.info(f"Headscale installation status: {installation_status}")
 
         if not installation_status:
             self._logger.fatal("Error!! failed to install headscale... aborting")
             raise RuntimeError("Failed to install headscale... aborting")
 
+    def setup_tailscale(self):
+        installation_status = True
         self._logger.info("Checking if tailscale client is installed")
         if not VpnServerInstaller.check_if_tailscale_is_installed():
             self._logger.info("Installing tailscale client...")
@@ -80,82 +92,116 @@ class VpnServerInstaller:
             raise RuntimeError("Failed to install tailscale... aborting")
 
     @staticmethod
-    def create_headscale_acl_policies():
-        string = ''
-        template = '            "10.42.{subnet}.0/24":        ["cluster-user"],\n'
-        for i in range(255):
-            string += template.format(subnet=i)
-        return ACL_TEMPLATE.format(cluster_subnets=string)
-
-    def install_headscale(self, host_url: str, gitlab_token: str, cert_crt_path: pathlib.Path,
+    def create_headscale_acl_policies(network: ClusterNetwork = ClusterNetwork()) -> AclPolicy:
+        # Routes already in the policy (e.g. added for extra subnets since) are kept, the cluster ones merged in
+        policy_path = VpnServerInstaller.HEAD_SCALE_ACL_PATH
+        try:
+            policy = AclPolicy.load(policy_path)
+        except (OSError, json.JSONDecodeError):
+            policy = AclPolicy()
+        policy.add_route_prefixes(network.routes())
+        return policy
+
+    @staticmethod
+    def headscale_artifact(gitlab_token: str) -> ArtifactSpec:
+        return ArtifactSpec(
+            name='headscale-ciy', version=VpnServerInstaller.HEAD_SCALE_VERSION, suffix='-amd64.deb',
+            url=f'https://gitlab.com/api/v4/projects/54080196/packages/generic/headscale-ciy/{VpnServerInstaller.HEAD_SCALE_VERSION}/headscale-ciy-{VpnServerInstaller.HEAD_SCALE_VERSION}-amd64.deb',
+            headers={'PRIVATE-TOKEN': gitlab_token})
+
+    def download_headscale(self, gitlab_token: str, artifact_cache: ArtifactCache) -> Optional[pathlib.Path]:
+        if VpnServerInstaller.check_if_headscale_is_installed():
+            return None
+        self._logger.info("Fetching headscale package")
+        return artifact_cache.fetch(VpnServerInstaller.headscale_artifact(gitlab_token))
+
+    def install_headscale(self, host_url: str, package_path: pathlib.Path, cert_crt_path: pathlib.Path,
                           cert_key_path: pathlib.Path) -> bool:
         status = True
-        status &= os.system(f'wget --header="PRIVATE-TOKEN: {gitlab_token}" --output-document=headscale.deb \
-  https://gitlab.com/api/v4/projects/54080196/packages/generic/headscale-ciy/{VpnServerInstaller.HEAD_SCALE_VERSION}/headscale-ciy-{VpnServerInstaller.HEAD_SCALE_VERSION}-amd64.deb') == 0
         self._logger.info("Headscale dpkg in progress")
-        status &= os.system(f'dpkg --install headscale.deb') == 0
+        status &= command_runner().run(['dpkg', '--install', package_path]).succeeded
 
         self._logger.info("Enablind headscale service")
-        status &= os.system(f'systemctl enable headscale') == 0
+        status &= command_runner().run(['systemctl', 'enable', 'headscale']).succeeded
         if not status:
             return False
 
         self._logger.info("Configuring headscale service")
-        VpnServerInstaller.HEAD_SCALE_ACL_PATH.write_text(VpnServerInstaller.create_headscale_acl_policies())
-        head_scale_config = VpnServerInstaller.HEAD_SCALE_CONFIG_PATH.read_text()
-        VpnServerInstaller.HEAD_SCALE_CONFIG_PATH.write_text(
-            head_scale_config.replace('server_url: http://127.0.0.1:8080',
-                                      VpnServerInstaller.HEAD_SCALE_URL.format(host_url=host_url)).replace(
-                'listen_addr: 127.0.0.1:8080', VpnServerInstaller.HEAD_SCALE_ADDR).replace(
-                VpnServerInstaller.HEAD_SCALE_ACL_LINE,
-                f'acl_policy_path: {str(VpnServerInstaller.HEAD_SCALE_ACL_PATH.absolute())}').replace(
-                VpnServerInstaller.HEAD_SCALE_KEY_PATH, f'tls_key_path: {str(cert_key_path.absolute())}').replace(
-                VpnServerInstaller.HEAD_SCALE_CERT_PATH, f'tls_cert_path: {str(cert_crt_path.absolute())}'))
-
-        VpnServerInstaller.HEAD_SCALE_CONFIG_PATH.chmod(0o777)
-        VpnServerInstaller.HEAD_SCALE_ACL_PATH.chmod(0o777)
+        VpnServerInstaller.create_headscale_acl_policies().save(VpnServerInstaller.HEAD_SCALE_ACL_PATH)
+        if not self.configure_headscale(host_url=host_url, cert_crt_path=cert_crt_path, cert_key_path=cert_key_path):
+            return False
 
         self._logger.info("Starting headscale")
-        status &= os.system(f'systemctl start headscale') == 0
-        return status and os.system(
-            'headscale users create cluster-user') == 0 and VpnServerInstaller.check_if_headscale_is_installed()
+        status &= command_runner().run(['systemctl', 'start', 'headscale']).succeeded
+        invalidate_host_facts()
+        if not status:
+            return False
+
+        startup = default_probe_engine().wait_all(
+            [SystemdUnitProbe('headscale'), TcpProbe('headscale-listener', '127.0.0.1', VpnServerInstaller.VPN_PORT)],
+            VpnServerInstaller.SERVICE_STARTUP_TIME_IN_SECONDS)
+        return all(result.ready for result in startup) and \
+            command_runner().run(['headscale', 'users', 'create', 'cluster-user']).succeeded
+
+    def configure_headscale(self, host_url: str, cert_crt_path: pathlib.Path, cert_key_path: pathlib.Path) -> bool:
+        try:
+            config = HeadscaleConfig.load(VpnServerInstaller.HEAD_SCALE_CONFIG_PATH)
+        except (OSError, yaml.YAMLError, HeadscaleConfigError) as e:
+            self._logger.error(f"Could not read the headscale config: {e}")
+            return False
+
+        config.apply({
+            'server_url': f'https://{host_url}:{VpnServerInstaller.VPN_PORT}',
+            'listen_addr': f'0.0.0.0:{VpnServerInstaller.VPN_PORT}',
+            'acl_policy_path': str(VpnServerInstaller.HEAD_SCALE_ACL_PATH.absolute()),
+            'tls_cert_path': str(cert_crt_path.absolute()),
+            'tls_key_path': str(cert_key_path.absolute()),
+        })
+        config.apply_tuning(self._headscale_tuning)
+        self._logger.info(f"Headscale config layout: {config.layout}, tuning: {self._headscale_tuning}")
+        try:
+            config.save(VpnServerInstaller.HEAD_SCALE_CONFIG_PATH)
+        except (OSError, HeadscaleConfigError) as e:
+            self._logger.error(f"Could not write the headscale config: {e}")
+            return False
+        return True
 
     @staticmethod
     def install_tailscale() -> bool:
-        tailscale_file = pathlib.Path(__file__).parent.parent / 'resources' / 'tailscale' / 'tailscale_1.56.1_amd64.tgz'
-        tailscale_file_path = pathlib.Path('/usr/bin/tailscale')
-        tailscaled_file_path = pathlib.Path('/usr/sbin/tailscaled')
-
-        os.system('systemctl unmask tailscaled.service')  # precaution
-
-        with (TemporaryDirectory() as tmp, tarfile.open(tailscale_file, mode="r:gz") as tar):
-            tmp_as_path = pathlib.Path(tmp)
-            tar.extractall(path=tmp)
-            tailscale_file_path.write_bytes((tmp_as_path / 'tailscale_1.56.1_amd64' / 'tailscale').read_bytes())
-            tailscaled_file_path.write_bytes((tmp_as_path / 'tailscale_1.56.1_amd64' / 'tailscaled').read_bytes())
-            tailscale_file_path.chmod(0o777)
-            tailscaled_file_path.chmod(0o777)
-
-            systemd_base_path = pathlib.Path(r'/etc/systemd/system/tailscaled.service')
-            systemd_defaults_path = pathlib.Path(r'/etc/default/tailscaled')
-            systemd_base_path.write_bytes(
-                (tmp_as_path / 'tailscale_1.56.1_amd64' / 'systemd' / 'tailscaled.service').read_bytes())
-            systemd_defaults_path.write_bytes(
-                (tmp_as_path / 'tailscale_1.56.1_amd64' / 'systemd' / 'tailscaled.defaults').read_bytes())
-
-            return os.system('systemctl enable tailscaled') == 0 and \
-                os.system('systemctl start tailscaled') == 0 and VpnServerInstaller.check_if_tailscale_is_installed()
+        runner = command_runner()
+        runner.run(['systemctl', 'unmask', 'tailscaled.service'])  # precaution
+
+        archive_path = resources().path(VpnServerInstaller.TAILSCALE_ARCHIVE_RESOURCE)
+        archive_root = VpnServerInstaller.TAILSCALE_ARCHIVE_ROOT
+        with tracer().span('tailscale-extract', 'install', bytes=archive_path.stat().st_size) as span:
+            deployed = ArtifactDeployer().deploy_archive_members(archive_path, [
+                DeployTarget(f'{archive_root}/tailscale', VpnServerInstaller.TAILSCALE_BINARY_PATH),
+                DeployTarget(f'{archive_root}/tailscaled', VpnServerInstaller.TAILSCALED_BINARY_PATH),
+                DeployTarget(f'{archive_root}/systemd/tailscaled.service', VpnServerInstaller.TAILSCALED_UNIT_PATH,
+                             mode=0o644),
+                DeployTarget(f'{archive_root}/systemd/tailscaled.defaults',
+                             VpnServerInstaller.TAILSCALED_DEFAULTS_PATH, mode=0o644),
+            ])
+            span.set(replaced=sum(result.replaced for result in deployed))
+
+        # systemd only rereads a unit file it already knows about on daemon-reload
+        if deployed[2].replaced and not runner.run(['systemctl', 'daemon-reload']).succeeded:
+            return False
+        started = runner.run(['systemctl', 'enable', 'tailscaled']).succeeded and \
+            runner.run(['systemctl', 'start', 'tailscaled']).succeeded
+        invalidate_host_facts()
+        return started and default_probe_engine().wait(
+            SystemdUnitProbe('tailscaled'), VpnServerInstaller.SERVICE_STARTUP_TIME_IN_SECONDS).ready
 
     @staticmethod
     def get_api_key() -> str:
-        return subprocess.run(['headscale', 'apikeys', 'create'],
-                              stdout=subprocess.PIPE).stdout.decode('utf-8').splitlines()[-1]
+        return command_runner().run(['headscale', 'apikeys', 'create']).check().stdout.splitlines()[-1]
 
     @staticmethod
     def get_headscale_preauthkey() -> str:
-        return subprocess.run(['headscale', 'preauthkeys', 'create', '-u', 'cluster-user', '--reusable'],
-                              stdout=subprocess.PIPE).stdout.decode('utf-8').splitlines()[-1]
+        return command_runner().run(['headscale', 'preauthkeys', 'create', '-u', 'cluster-user',
+                                     '--reusable']).check().stdout.splitlines()[-1]
 
 
 if __name__ == '__main__':
-    print(VpnServerInstaller.create_headscale_acl_policies())
+    print(VpnServerInstaller.create_headscale_acl_policies().to_json(), end='')
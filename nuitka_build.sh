@@ -1,3 +1,8 @@
 #! /bin/bash
 pip3 install nuitka
-nuitka3 --follow-imports --onefile --include-data-dir=./cluster_server_installer/resources=cluster_server_installer/resources cluster_server_installer/main.py
\ No newline at end of file
+# Resources ship as one compressed archive, members are extracted only when a command needs them
+python3 -m cluster_server_installer.utilities.resources build/resources.zip
+# A onefile binary unpacks its whole payload on every launch into a fresh temp dir. With a fixed per-build
+# directory it unpacks once and later launches reuse it
+nuitka3 --follow-imports --onefile --onefile-tempdir-spec="{CACHE_DIR}/ciy-installer/$(git rev-parse --short HEAD)" \
+  --include-data-files=build/resources.zip=cluster_server_installer/resources.zip cluster_server_installer/main.py
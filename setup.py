@@ -10,5 +10,5 @@ setup(
                        'resources/cert_provider/*','resources/deployments/descheduler/*.yaml' ,
                        'resources/deployments/loadbalancer/*.yaml','resources/deployments/traefik/*.yaml']},
     packages=find_packages(),
-    install_requires=['kubernetes', 'requests', 'python-crontab']
+    install_requires=['kubernetes', 'requests', 'python-crontab', 'PyYAML']
 )
@@ -0,0 +1,36 @@
+import json
+
+from cluster_server_installer.k8s.cluster_network import ClusterNetwork
+from cluster_server_installer.vpn.acl_policy import AclPolicy
+
+
+def test_cluster_routes_compile_into_collapsed_auto_approvers():
+    policy = AclPolicy.for_cluster(ClusterNetwork(cluster_cidr='10.42.0.0/16', service_cidr='10.43.0.0/16'))
+    # The two adjacent /16s merge into one /15, IPv4 sorts before IPv6
+    assert policy.route_prefixes() == ['10.42.0.0/15', '2001:cafe:42::/56']
+    assert policy.document() == {'acls': AclPolicy.DEFAULT_ACLS, 'autoApprovers': {'routes': {
+        '10.42.0.0/15': ['cluster-user'], '2001:cafe:42::/56': ['cluster-user']}}}
+
+
+def test_prefixes_inside_approved_space_do_not_change_the_policy():
+    policy = AclPolicy.for_cluster(ClusterNetwork())
+    assert not policy.add_route_prefixes(['10.42.7.0/24', '10.43.0.10/32'])
+    assert policy.add_route_prefixes(['192.168.10.0/24'])
+    assert '192.168.10.0/24' in policy.route_prefixes()
+
+
+def test_existing_policies_keep_their_rules_and_are_only_rewritten_on_change(tmp_path):
+    path = tmp_path / 'acl.json'
+    path.write_text(json.dumps({'acls': [{'action': 'accept', 'src': ['group:ops'], 'dst': ['*:22']}],
+                                'autoApprovers': {'routes': {'10.42.0.0/16': ['cluster-user', 'ops'],
+                                                             '10.43.0.0/16': ['cluster-user']},
+                                                  'exitNode': ['ops']}}))
+    policy = AclPolicy.load(path)
+    assert policy.route_prefixes() == ['10.42.0.0/15']
+    assert policy.route_prefixes('ops') == ['10.42.0.0/16']
+    assert policy.save(path)
+    saved = json.loads(path.read_text())
+    assert saved['acls'][0]['src'] == ['group:ops']
+    assert saved['autoApprovers']['exitNode'] == ['ops']
+    assert saved['autoApprovers']['routes'] == {'10.42.0.0/15': ['cluster-user'], '10.42.0.0/16': ['ops']}
+    assert not AclPolicy.load(path).save(path)
@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from cluster_server_installer.utilities.artifact_cache import ArtifactCache, ArtifactIntegrityError, ArtifactSpec
+
+PAYLOAD = bytes(range(256)) * 4096
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+@pytest.fixture
+def server():
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.headers.get('Range'))
+            start = int(self.headers['Range'][len('bytes='):-1]) if self.headers.get('Range') else 0
+            self.send_response(206 if start else 200)
+            self.send_header('Content-Length', str(len(PAYLOAD) - start))
+            self.end_headers()
+            self.wfile.write(PAYLOAD[start:])
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    http_server.requests = requests
+    http_server.url = f'http://127.0.0.1:{http_server.server_address[1]}/k3s'
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def test_artifacts_are_downloaded_once_and_found_again_by_a_new_cache(tmp_path, server):
+    spec = ArtifactSpec('k3s', 'v1.27.9', server.url)
+    path = ArtifactCache(tmp_path).fetch(spec)
+    assert path.read_bytes() == PAYLOAD and path.name == PAYLOAD_SHA256
+    # Without a pinned checksum the index remembers the digest of the first download
+    assert ArtifactCache(tmp_path).fetch(spec) == path
+    assert server.requests == [None]
+
+
+def test_a_checksum_mismatch_is_rejected(tmp_path, server):
+    with pytest.raises(ArtifactIntegrityError):
+        ArtifactCache(tmp_path).fetch(ArtifactSpec('k3s', 'v1.27.9', server.url, sha256='0' * 64))
+    assert not (tmp_path / 'sha256').exists()
+
+
+def test_an_interrupted_download_resumes(tmp_path, server):
+    spec = ArtifactSpec('k3s', 'v1.27.9', server.url, sha256=PAYLOAD_SHA256)
+    partial = tmp_path / 'partial' / spec.file_name
+    partial.parent.mkdir(parents=True)
+    partial.write_bytes(PAYLOAD[:1000])
+    assert ArtifactCache(tmp_path).fetch(spec).read_bytes() == PAYLOAD
+    assert server.requests == ['bytes=1000-']
+
+
+def test_offline_bundles_are_checked_against_their_checksums(tmp_path, server):
+    spec = ArtifactSpec('k3s', 'v1.27.9', server.url, suffix='.bin')
+    bundle = tmp_path / 'bundle'
+    ArtifactCache(tmp_path / 'online').export_bundle([spec], bundle)
+
+    offline_spec = ArtifactSpec('k3s', 'v1.27.9', 'http://unreachable.invalid/k3s', suffix='.bin')
+    assert ArtifactCache(tmp_path / 'offline', offline_bundle=bundle).fetch(offline_spec).read_bytes() == PAYLOAD
+    (bundle / spec.file_name).write_bytes(PAYLOAD[:-1])
+    with pytest.raises(ArtifactIntegrityError):
+        ArtifactCache(tmp_path / 'tampered', offline_bundle=bundle).fetch(offline_spec)
+    assert server.requests == [None]
@@ -0,0 +1,51 @@
+import io
+import tarfile
+
+import pytest
+
+from cluster_server_installer.utilities.artifact_deployer import ArtifactDeployer, DeployTarget
+
+
+@pytest.fixture
+def deployer(monkeypatch):
+    # Small chunks so the tests cross chunk boundaries
+    monkeypatch.setattr(ArtifactDeployer, 'CHUNK_SIZE', 4)
+    return ArtifactDeployer()
+
+
+def test_unchanged_content_is_left_in_place(tmp_path, deployer):
+    destination = tmp_path / 'bin' / 'headscale'
+    assert deployer.deploy_stream(io.BytesIO(b'headscale v0.22'), destination).replaced
+    inode = destination.stat().st_ino
+    result = deployer.deploy_stream(io.BytesIO(b'headscale v0.22'), destination, mode=0o700)
+    assert not result.replaced and result.size == 15
+    assert destination.stat().st_ino == inode
+    assert destination.stat().st_mode & 0o7777 == 0o700
+
+
+@pytest.mark.parametrize('new_content', [b'headscale v0.23', b'headscale v0.2', b'headscale v0.22.1', b''])
+def test_changed_content_replaces_the_file_atomically(tmp_path, deployer, new_content):
+    destination = tmp_path / 'headscale'
+    destination.write_bytes(b'headscale v0.22')
+    inode = destination.stat().st_ino
+    result = deployer.deploy_stream(io.BytesIO(new_content), destination)
+    assert result.replaced
+    assert destination.read_bytes() == new_content
+    assert destination.stat().st_ino != inode
+    assert [path.name for path in tmp_path.iterdir()] == ['headscale']
+
+
+def test_archive_members_are_deployed_by_name(tmp_path, deployer):
+    archive = tmp_path / 'k3s.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        for name, content in (('docs/README', b'docs'), ('bin/k3s', b'k3s binary'), ('bin/ctr', b'ctr binary')):
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+
+    ctr, k3s = deployer.deploy_archive_members(archive, [DeployTarget('bin/ctr', tmp_path / 'ctr'),
+                                                         DeployTarget('bin/k3s', tmp_path / 'k3s', 0o750)])
+    assert (ctr.destination.read_bytes(), k3s.destination.read_bytes()) == (b'ctr binary', b'k3s binary')
+    assert k3s.destination.stat().st_mode & 0o7777 == 0o750
+    with pytest.raises(FileNotFoundError, match='bin/kubectl'):
+        deployer.deploy_archive_members(archive, [DeployTarget('bin/kubectl', tmp_path / 'kubectl')])
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from kubernetes import client
+
+from cluster_server_installer.benchmarks.fake_kubernetes import FakeKubernetesApi, ReadinessDelays
+from cluster_server_installer.k8s import cluster_selftest
+from cluster_server_installer.k8s.cluster_selftest import ClusterSelfTest, SelfTestMetric, SelfTestReport
+from cluster_server_installer.utilities.command_runner import CommandResult, CommandRunner, command_runner, \
+    set_command_runner
+
+BASELINE = SelfTestReport('node-1', 1.0, [SelfTestMetric('api_list_p50', 10.0, 'ms'),
+                                          SelfTestMetric('nfs-client.write', 200.0, 'MiB/s', higher_is_better=True),
+                                          SelfTestMetric('redis_round_trip', 0.5, 'ms')])
+
+
+class TailscaleRunner(CommandRunner):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def _run(self, argv, *args) -> CommandResult:
+        self.calls.append(argv)
+        if argv[1] == 'status':
+            peers = {'a': {'Online': False, 'TailscaleIPs': ['100.64.0.7']},
+                     'b': {'Online': True, 'TailscaleIPs': ['fd7a:115c:a1e0::2', '100.64.0.2']}}
+            return CommandResult(argv, 0, json.dumps({'Peer': peers}), '', 0.0)
+        return CommandResult(argv, 0, ''.join(f'pong from node-2 ({argv[-1]}) via DERP(fra) in {rtt}ms\n'
+                                              for rtt in (30, 10, 20)), '', 0.0)
+
+
+@pytest.fixture
+def tailscale():
+    previous = command_runner()
+    runner = TailscaleRunner()
+    set_command_runner(runner)
+    yield runner
+    set_command_runner(previous)
+
+
+@pytest.fixture
+def api():
+    api = FakeKubernetesApi(ReadinessDelays().scaled(0.1)).start()
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def api_client(api):
+    configuration = client.Configuration()
+    configuration.host = api.url
+    with client.ApiClient(configuration) as api_client:
+        yield api_client
+
+
+def test_metrics_regress_in_their_own_direction():
+    report = SelfTestReport('node-1', 2.0, [SelfTestMetric('api_list_p50', 12.0, 'ms'),
+                                            SelfTestMetric('nfs-client.write', 140.0, 'MiB/s', higher_is_better=True),
+                                            SelfTestMetric('redis_round_trip', 0.7, 'ms'),
+                                            SelfTestMetric('postgres_query', 3.0, 'ms')],
+                            failures={'vpn': 'no tailscale peer is online'})
+    comparisons = report.compare(BASELINE)
+    assert {comparison.name: comparison.regressed for comparison in comparisons} == {
+        'api_list_p50': False, 'nfs-client.write': True, 'redis_round_trip': True}
+    assert comparisons[0].change == pytest.approx(0.2)
+    assert [comparison.name for comparison in report.compare(BASELINE, tolerance=0.5) if comparison.regressed] == []
+
+    lines = report.format_report(comparisons).splitlines()
+    assert lines[2].endswith('REGRESSED') and not lines[1].endswith('REGRESSED')
+    assert lines[4].split() == ['postgres_query', '3.00', 'ms']
+    assert lines[5].split()[:2] == ['vpn', 'FAILED']
+
+
+def test_report_round_trips_through_the_baseline_file(tmp_path):
+    path = tmp_path / 'selftest-baseline.json'
+    BASELINE.save(path)
+    assert SelfTestReport.load(path) == BASELINE
+
+
+def test_api_latency_is_measured_against_the_api_server(api, api_client):
+    metrics = ClusterSelfTest(api_client).measure_api_latency()
+    assert [metric.name for metric in metrics] == ['api_list_p50', 'api_list_p99']
+    assert 0 < metrics[0].value <= metrics[1].value
+    assert api.api_calls['GET pods'] == ClusterSelfTest.API_REQUESTS
+
+
+def test_vpn_round_trip_to_the_first_online_peer(tailscale, monkeypatch):
+    monkeypatch.setattr(cluster_selftest.shutil, 'which', lambda name: None)
+    metrics = ClusterSelfTest(client.ApiClient()).measure_vpn()
+    assert [(metric.name, metric.value) for metric in metrics] == [('vpn_rtt_p50', 20.0), ('vpn_rtt_max', 30.0)]
+    assert tailscale.calls[-1][-1] == '100.64.0.2'
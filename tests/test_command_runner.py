@@ -0,0 +1,54 @@
+import sys
+import threading
+import time
+
+from cluster_server_installer.utilities.command_runner import CommandError, CommandRunner
+
+
+def python(code: str):
+    return [sys.executable, '-c', code]
+
+
+def test_output_is_captured_and_secrets_are_redacted():
+    result = CommandRunner().run([*python('import os, sys; print("key", os.environ["TOKEN"]); '
+                                          'sys.stderr.write(sys.argv[1])'), 'password'],
+                                 secret_env={'TOKEN': 'hunter2'}, secrets=['password'])
+    assert result.succeeded
+    assert result.stdout == f'key {CommandRunner.REDACTED}\n'
+    assert result.stderr == CommandRunner.REDACTED
+
+
+def test_failures_carry_the_exit_code_and_stderr():
+    result = CommandRunner().run(python('import sys; sys.stderr.write("no space left"); sys.exit(3)'))
+    assert result.return_code == 3 and not result.succeeded
+    try:
+        result.check()
+    except CommandError as e:
+        assert 'exited with 3: no space left' in str(e)
+    else:
+        raise AssertionError('check() did not raise')
+
+
+def test_a_timeout_kills_the_whole_process_group(tmp_path):
+    marker = tmp_path / 'grandchild-survived'
+    # The shell's child would outlive a kill of the shell alone
+    result = CommandRunner().run(['sh', '-c', f'(sleep 2; touch {marker}) & wait'], timeout_in_seconds=0.3)
+    assert result.timed_out and not result.succeeded
+    time.sleep(2.5)
+    assert not marker.exists()
+
+
+def test_cancelling_stops_running_and_later_commands():
+    cancel_event = threading.Event()
+    runner = CommandRunner(cancel_event=cancel_event)
+    future = runner.submit(python('import time; time.sleep(30)'))
+    time.sleep(0.3)
+    cancel_event.set()
+    assert future.result(timeout=10).cancelled
+    assert runner.run(python('print(1)')).cancelled
+
+
+def test_output_beyond_the_capture_limit_keeps_the_tail():
+    result = CommandRunner().run(python('print("x" * 5000 + "tail")'), capture_limit=100)
+    assert result.truncated
+    assert result.stdout.endswith('tail\n') and len(result.stdout) == 100
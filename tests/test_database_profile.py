@@ -0,0 +1,58 @@
+import json
+
+import pytest
+import yaml
+
+from cluster_server_installer.k8s.database_profile import DatabaseProfile
+from cluster_server_installer.utilities.host_facts import HostCapacity
+
+GIB = 1024 ** 3
+
+
+def capacity(cpu_count: int, memory_gib: int) -> HostCapacity:
+    return HostCapacity(cpu_count=cpu_count, memory_bytes=memory_gib * GIB, disk_bytes=200 * GIB)
+
+
+def test_tier_follows_host_memory_and_stays_within_its_share():
+    assert [DatabaseProfile.for_host(capacity(4, memory)).tier for memory in (2, 8, 64)] == [
+        'small', 'medium', 'large']
+    # A large tier forced onto an 8GiB host is held to a quarter of its memory for postgres, an eighth for redis
+    values = DatabaseProfile.for_host(capacity(2, 8), tier='large').template_values()
+    assert json.loads(values['POSTGRES_RESOURCES']) == {'requests': {'cpu': '1', 'memory': '1Gi'},
+                                                        'limits': {'cpu': '2', 'memory': '2Gi'}}
+    assert json.loads(values['REDIS_RESOURCES']) == {'requests': {'cpu': '500m', 'memory': '512Mi'},
+                                                     'limits': {'cpu': '1', 'memory': '1Gi'}}
+    assert json.loads(values['REDIS_ARGS'])[:4] == ['--maxmemory', '768mb', '--maxmemory-policy', 'volatile-lru']
+    with pytest.raises(ValueError, match='huge'):
+        DatabaseProfile.for_host(capacity(4, 8), tier='huge')
+
+
+def test_postgres_settings_depend_on_the_latency_backend():
+    nfs = json.loads(DatabaseProfile.for_host(capacity(4, 8)).template_values()['POSTGRES_ARGS'])
+    local = json.loads(DatabaseProfile.for_host(capacity(4, 8), latency_backend='local-path').template_values()[
+        'POSTGRES_ARGS'])
+    assert nfs[:4] == ['-c', 'shared_buffers=512MB', '-c', 'effective_cache_size=1536MB']
+    assert 'wal_compression=on' in nfs and 'random_page_cost=1.1' not in nfs
+    assert 'random_page_cost=1.1' in local and 'wal_compression=on' not in local
+
+
+def test_overrides_set_settings_and_resources():
+    base = DatabaseProfile.for_host(capacity(4, 8))
+    profile = base.with_overrides({
+        'postgres.shared_buffers': '1GB', 'postgres.wal_compression': None, 'postgres.fsync': False,
+        'redis.appendonly': True, 'redis.resources.limits.memory': '2Gi'})
+    dumped = yaml.safe_load(profile.dump())
+    assert dumped['tier'] == 'medium'
+    assert dumped['postgres']['settings']['shared_buffers'] == '1GB'
+    assert 'wal_compression' not in dumped['postgres']['settings']
+    assert (dumped['postgres']['settings']['fsync'], dumped['redis']['settings']['appendonly']) == ('off', 'yes')
+    assert dumped['redis']['resources']['limits']['memory'] == '2Gi'
+    # The profile the overrides were applied to is left as it was
+    assert 'wal_compression=on' in base.template_values()['POSTGRES_ARGS']
+
+
+@pytest.mark.parametrize('key', ['mysql.max_connections', 'postgres', 'redis.resources.limits.disk',
+                                 'postgres.resources.maximum.cpu'])
+def test_malformed_overrides_are_rejected(key):
+    with pytest.raises(ValueError, match=key):
+        DatabaseProfile.for_host(capacity(4, 8)).with_overrides({key: '1'})
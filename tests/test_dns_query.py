@@ -0,0 +1,63 @@
+import logging
+import socket
+import struct
+import threading
+
+import pytest
+
+from cluster_server_installer.certificates.lego_certificate_installer import LegoCertificateInstaller
+from cluster_server_installer.utilities.dns_query import DnsError, DnsResolver
+
+ZONES = {'example.com': ['ns02.domaincontrol.com', 'ns01.domaincontrol.com']}
+
+
+@pytest.fixture
+def nameserver(monkeypatch):
+    # Answers NS queries for ZONES, with the owner name compressed to a pointer at the question like real servers do
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    monkeypatch.setattr(DnsResolver, 'DNS_PORT', sock.getsockname()[1])
+
+    def serve():
+        while True:
+            try:
+                query, client = sock.recvfrom(512)
+            except OSError:
+                return
+            name, end = DnsResolver._decode_name(query, 12)
+            question = query[12:end + 4]
+            answers = b''.join(struct.pack('!HHHIH', 0xC00C, DnsResolver.TYPE_NS, 1, 300,
+                                           len(DnsResolver._encode_name(server))) +
+                               DnsResolver._encode_name(server) for server in ZONES.get(name, []))
+            sock.sendto(query[:2] + struct.pack('!HHHHH', 0x8180, 1, len(ZONES.get(name, [])), 0, 0) + question +
+                        answers, client)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield DnsResolver(['127.0.0.1'])
+    sock.close()
+
+
+def test_zone_nameservers_walk_up_to_the_zone_apex(nameserver):
+    assert nameserver.zone_nameservers('dashboard.cloud.example.com') == \
+        ('example.com', ['ns01.domaincontrol.com', 'ns02.domaincontrol.com'])
+    with pytest.raises(DnsError):
+        nameserver.zone_nameservers('example.org')
+
+
+def test_unreachable_nameservers_raise(monkeypatch):
+    monkeypatch.setattr(DnsResolver, 'TIMEOUT_IN_SECONDS', 0.2)
+    with pytest.raises(DnsError, match='No nameserver answered'):
+        DnsResolver(['127.0.0.1']).query('example.com', DnsResolver.TYPE_NS)
+
+
+def test_lego_checks_propagation_at_the_zone_nameservers(monkeypatch, caplog):
+    zones = {'cloud.example.com': ('example.com', ['ns01.domaincontrol.com']),
+             'cloud.example.org': ('example.org', ['ns1.elsewhere.net'])}
+    monkeypatch.setattr(DnsResolver, 'zone_nameservers', lambda self, domain: zones[domain])
+    monkeypatch.setattr(DnsResolver, 'system_nameservers', staticmethod(lambda: ['127.0.0.1']))
+    with caplog.at_level(logging.WARNING):
+        assert LegoCertificateInstaller.challenge_resolvers('cloud.example.com') == ['ns01.domaincontrol.com:53']
+        assert not caplog.records
+        # A zone GoDaddy does not serve is only warned about
+        assert LegoCertificateInstaller.challenge_resolvers('cloud.example.org') == ['ns1.elsewhere.net:53']
+        assert 'not only GoDaddy' in caplog.text
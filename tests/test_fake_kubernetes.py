@@ -0,0 +1,61 @@
+import contextlib
+import json
+import time
+
+from cluster_server_installer.benchmarks.fake_kubernetes import FakeKubernetesApi, ReadinessDelays
+
+CRD = {'metadata': {'name': 'widgets.example.com'},
+       'spec': {'group': 'example.com', 'scope': 'Namespaced', 'names': {'kind': 'Widget', 'plural': 'widgets'},
+                'versions': [{'name': 'v1', 'served': True, 'storage': True}]}}
+
+
+@contextlib.contextmanager
+def fake_api(delays: ReadinessDelays):
+    api = FakeKubernetesApi(delays).start()
+    try:
+        yield api
+    finally:
+        api.stop()
+
+
+def request(api, method, path, body=None):
+    return api.handle(method, path, json.dumps(body).encode() if body is not None else b'')
+
+
+def test_objects_are_created_once_and_bump_their_generation_on_spec_changes():
+    with fake_api(ReadinessDelays().scaled(0)) as api:
+        path = '/apis/apps/v1/namespaces/cloud-iy/statefulsets'
+        body = {'metadata': {'name': 'postgres'}, 'spec': {'replicas': 1}}
+        assert request(api, 'POST', path, body)[0] == 201
+        assert request(api, 'POST', path, body)[0] == 409
+        request(api, 'PATCH', f'{path}/postgres', {**body, 'metadata': {'name': 'postgres', 'labels': {'a': 'b'}}})
+        assert request(api, 'GET', f'{path}/postgres')[1]['metadata']['generation'] == 1
+        request(api, 'PATCH', f'{path}/postgres', {'metadata': {'name': 'postgres'}, 'spec': {'replicas': 2}})
+        assert request(api, 'GET', f'{path}/postgres')[1]['metadata']['generation'] == 2
+        assert api.api_calls['PATCH statefulsets'] == 2
+
+
+def test_established_crds_are_served_and_discoverable():
+    with fake_api(ReadinessDelays(crd_established=0.05)) as api:
+        request(api, 'POST', '/apis/apiextensions.k8s.io/v1/customresourcedefinitions', CRD)
+        assert request(api, 'GET', '/apis/example.com/v1/namespaces/default/widgets')[0] == 404
+        time.sleep(0.1)
+        assert request(api, 'GET', '/apis/example.com/v1/namespaces/default/widgets')[0] == 200
+        _, discovery = request(api, 'GET', '/apis/example.com/v1')
+        assert [resource['name'] for resource in discovery['resources']] == ['widgets']
+
+
+def test_watches_stream_changes_after_the_listed_version():
+    with fake_api(ReadinessDelays(deployment_rollout=0.05)) as api:
+        request(api, 'POST', '/apis/apps/v1/namespaces/cloud-iy/deployments',
+                {'metadata': {'name': 'dashboard'}, 'spec': {'replicas': 1}})
+        listed = request(api, 'GET', '/apis/apps/v1/namespaces/cloud-iy/deployments')[1]
+        _, events = request(api, 'GET', '/apis/apps/v1/namespaces/cloud-iy/deployments?watch=true&timeoutSeconds=1&'
+                                        f'resourceVersion={listed["metadata"]["resourceVersion"]}')
+        event = next(events)
+        assert event['type'] == 'MODIFIED'
+        assert event['object']['status']['availableReplicas'] == 1
+
+        api.compact()
+        assert request(api, 'GET', '/apis/apps/v1/namespaces/cloud-iy/deployments?watch=true&'
+                                   f'resourceVersion={listed["metadata"]["resourceVersion"]}')[0] == 410
@@ -0,0 +1,81 @@
+import json
+import sys
+import time
+
+import pytest
+
+from cluster_server_installer.fleet.executors import FakeExecutor, HostExecutionError, SshExecutor
+from cluster_server_installer.fleet.fleet_runner import FleetRunner
+from cluster_server_installer.fleet.inventory import Inventory
+
+HOST_PARAMETERS = {'server_url': 'cloud.example.com', 'email': 'ops@example.com', 'registry': 'registry.example.com',
+                   'access_key': 'access-secret', 'godaddy_access_key': 'godaddy-key',
+                   'godaddy_secret': 'godaddy-secret'}
+
+
+def load_inventory(tmp_path, hosts, defaults=None) -> Inventory:
+    path = tmp_path / 'inventory.json'
+    path.write_text(json.dumps({'defaults': {**HOST_PARAMETERS, **(defaults or {})}, 'hosts': hosts}))
+    return Inventory.load(path)
+
+
+def test_install_options_map_onto_install_flags(tmp_path):
+    host, = load_inventory(tmp_path, [{'address': '10.0.0.1', 'nic_policy': 'physical', 'storage_benchmark': False,
+                                       'k3s_overrides': {'kubelet-arg.max-pods': 200}}],
+                           defaults={'score_transport': 'uds', 'database_overrides': ['redis.maxmemory=1gb']}).hosts
+    arguments = host.install_arguments()
+    assert arguments[:7] == ['install', 'cloud.example.com', 'ops@example.com', 'registry.example.com',
+                             'access-secret', 'godaddy-key', 'godaddy-secret']
+    assert arguments[7:] == ['--scheduler-score-transport', 'uds', '--database-set', 'redis.maxmemory=1gb',
+                             '--nic-policy', 'physical', '--skip-storage-benchmark',
+                             '--k3s-set', 'kubelet-arg.max-pods=200']
+
+
+def test_unknown_inventory_parameters_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match='nic_polcy'):
+        load_inventory(tmp_path, [{'address': '10.0.0.1', 'nic_polcy': 'physical'}])
+
+
+def test_remote_install_keeps_secrets_off_the_command_line(tmp_path):
+    host, = load_inventory(tmp_path, [{'address': '10.0.0.1'}]).hosts
+    command = SshExecutor(tmp_path / 'installer')._remote_install_command(host, 600)
+    assert 'access-secret' not in command and 'godaddy-secret' not in command
+    assert 'timeout --kill-after=' in command
+
+
+def test_timed_out_command_runs_the_timeout_handler(tmp_path):
+    timeouts = []
+    with (tmp_path / 'host.log').open('ab') as log_file, pytest.raises(HostExecutionError, match='timed out'):
+        SshExecutor(tmp_path / 'installer')._run([sys.executable, '-c', 'import time; time.sleep(60)'], log_file,
+                                                 time.monotonic() + 1, 'remote install',
+                                                 on_timeout=lambda: timeouts.append(True))
+    assert timeouts == [True]
+
+
+def test_stdin_reaches_the_command(tmp_path):
+    log_path = tmp_path / 'host.log'
+    with log_path.open('ab') as log_file:
+        SshExecutor(tmp_path / 'installer')._run([sys.executable, '-c', 'print(input()[::-1])'], log_file,
+                                                 time.monotonic() + 30, 'echo', stdin_text='terces\n')
+    assert log_path.read_text().strip() == 'secret'
+
+
+def test_fleet_reports_failed_and_timed_out_hosts(tmp_path):
+    hosts = load_inventory(tmp_path, [{'address': f'10.0.0.{index}'} for index in range(1, 5)]).hosts
+    executor = FakeExecutor(durations={'10.0.0.4': 5}, failures={'10.0.0.2': 'k3s failed'}, default_duration=0.01)
+    results = FleetRunner(executor, log_dir=tmp_path / 'logs', concurrency=4, host_timeout_in_seconds=0.5).run(hosts)
+    assert sorted(executor.executed) == [host.name for host in hosts]
+    assert {result.name: result.error for result in results} == {
+        '10.0.0.1': None, '10.0.0.2': 'k3s failed', '10.0.0.3': None, '10.0.0.4': 'fake install timed out'}
+    assert '2/4 hosts installed' in FleetRunner.summary(results)
+
+
+def test_installer_reads_dashed_secrets_from_the_environment(monkeypatch):
+    from cluster_server_installer.main import secret_argument
+
+    monkeypatch.setenv('CIY_ACCESS_KEY', 'from-env')
+    monkeypatch.delenv('CIY_GODADDY_SECRET', raising=False)
+    assert secret_argument('given', 'CIY_ACCESS_KEY') == 'given'
+    assert secret_argument('-', 'CIY_ACCESS_KEY') == 'from-env'
+    with pytest.raises(SystemExit):
+        secret_argument('-', 'CIY_GODADDY_SECRET')
@@ -0,0 +1,51 @@
+import pytest
+
+from cluster_server_installer.vpn.headscale_config import HEADSCALE_PROFILES, HeadscaleConfig, HeadscaleConfigError
+
+
+def valid_document(tmp_path, **overrides):
+    for name in ('tls.crt', 'tls.key'):
+        (tmp_path / name).write_text('pem')
+    (tmp_path / 'acl.json').write_text('{}')
+    return {'server_url': 'https://vpn.example.com', 'listen_addr': '0.0.0.0:8080',
+            'tls_cert_path': str(tmp_path / 'tls.crt'), 'tls_key_path': str(tmp_path / 'tls.key'),
+            'ip_prefixes': ['100.64.0.0/10'], **overrides}
+
+
+@pytest.mark.parametrize('document, write_ahead_log', [
+    ({'db_type': 'sqlite3', 'db_path': '/var/lib/headscale/db.sqlite', 'acl_policy_path': ''}, None),
+    ({'database': {'type': 'sqlite', 'sqlite': {'path': '/var/lib/headscale/db.sqlite'}}, 'policy': {'path': ''}},
+     True),
+])
+def test_logical_keys_follow_the_config_layout(document, write_ahead_log):
+    config = HeadscaleConfig(document)
+    assert config.get('sqlite_path') == '/var/lib/headscale/db.sqlite'
+    assert config.get('database_type') == HeadscaleConfig.SQLITE_TYPES[config.layout]
+    config.apply_tuning(HEADSCALE_PROFILES['large-fleet'])
+    assert config.get('node_update_check_interval') == '30s'
+    assert config.get('derp.server.region_id') == HeadscaleConfig.EMBEDDED_DERP_REGION_ID
+    # The pre-0.23 layout has no write-ahead log switch, nothing is invented for it
+    assert config.get('sqlite_write_ahead_log') is write_ahead_log
+    assert ('write_ahead_log' in config.dump()) == (write_ahead_log is not None)
+
+
+def test_invalid_configs_are_never_written(tmp_path):
+    config = HeadscaleConfig(valid_document(tmp_path, server_url='http://vpn.example.com',
+                                            node_update_check_interval='thirty seconds',
+                                            ip_prefixes=['100.64.0.0/33']))
+    errors = config.validate()
+    assert len(errors) == 3
+    with pytest.raises(HeadscaleConfigError):
+        config.save(tmp_path / 'config.yaml')
+    assert not (tmp_path / 'config.yaml').exists()
+
+
+def test_valid_configs_are_rewritten_only_when_they_change(tmp_path):
+    path = tmp_path / 'config.yaml'
+    config = HeadscaleConfig(valid_document(tmp_path))
+    assert config.validate() == []
+    assert config.save(path)
+    assert not HeadscaleConfig.load(path).save(path)
+    reloaded = HeadscaleConfig.load(path)
+    reloaded.set('log.level', 'warn')
+    assert reloaded.save(path)
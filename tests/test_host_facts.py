@@ -0,0 +1,63 @@
+import pytest
+
+from cluster_server_installer.utilities.command_runner import CommandResult, CommandRunner, command_runner, \
+    set_command_runner
+from cluster_server_installer.utilities.host_facts import RELEVANT_UNITS, HostCapacity, HostFacts, HostFactsError, \
+    NetworkInterface
+
+CAPACITY = HostCapacity(cpu_count=4, memory_bytes=16 * 1024 ** 3, disk_bytes=200 * 1024 ** 3)
+
+ETH0 = NetworkInterface('eth0', ('192.168.1.10', 'fd00::10'), is_up=True, is_physical=True, has_default_route=False)
+ETH1 = NetworkInterface('eth1', ('10.20.0.5',), is_up=True, is_physical=True, has_default_route=False)
+WG0 = NetworkInterface('wg0', ('172.16.0.2',), is_up=True, is_physical=False, has_default_route=True)
+TAILSCALE = NetworkInterface('tailscale0', ('100.64.0.1',), is_up=True, is_physical=False, has_default_route=False)
+DOWN = NetworkInterface('eth2', ('10.30.0.5',), is_up=False, is_physical=True, has_default_route=True)
+
+
+def facts_with(*interfaces: NetworkInterface) -> HostFacts:
+    return HostFacts('node-1', CAPACITY, interfaces)
+
+
+class HostCommandRunner(CommandRunner):
+    def _run(self, argv, *args) -> CommandResult:
+        if argv[0] == 'systemctl':
+            return CommandResult(argv, 3, 'active\ninactive\n', '', 0.0)
+        return CommandResult(argv, 0, 'k3s\t1.29.3\tinstall ok installed\n'
+                                      'nfs-common\t1:2.6.1\tdeinstall ok config-files\n', '', 0.0)
+
+
+@pytest.fixture
+def host_commands():
+    previous = command_runner()
+    set_command_runner(HostCommandRunner())
+    yield
+    set_command_runner(previous)
+
+
+def test_default_route_policy_prefers_the_routing_interface():
+    facts = facts_with(ETH0, ETH1, WG0, DOWN)
+    assert facts.primary_ip() == '172.16.0.2'
+    # Without a default route the first physical NIC is the fallback
+    assert facts_with(TAILSCALE, ETH0).primary_ip('default-route') == '192.168.1.10'
+
+
+def test_physical_cidr_and_name_policies():
+    facts = facts_with(TAILSCALE, WG0, ETH0, ETH1)
+    assert facts.primary_ip('physical') == '192.168.1.10'
+    assert facts.primary_ip('10.20.0.0/16') == '10.20.0.5'
+    assert facts.primary_ip('tailscale0') == '100.64.0.1'
+
+
+def test_unmatched_policy_names_the_candidates():
+    facts = facts_with(ETH0, DOWN)
+    with pytest.raises(HostFactsError, match="'10.99.0.0/16'.*eth0"):
+        facts.primary_ip('10.99.0.0/16')
+    with pytest.raises(HostFactsError, match='none are up'):
+        facts_with(DOWN).primary_ip('physical')
+
+
+def test_unit_states_and_installed_packages(host_commands):
+    states = HostFacts.collect_unit_states()
+    assert list(states) == list(RELEVANT_UNITS)
+    assert (states['headscale'], states['tailscaled'], states['k3s']) == ('active', 'inactive', 'unknown')
+    assert HostFacts.collect_package_versions() == {'k3s': '1.29.3'}
@@ -0,0 +1,90 @@
+import pathlib
+
+import pytest
+
+from cluster_server_installer.k8s.image_prefetch import ImagePrefetcher, ImageReference, images_in_manifests, \
+    pin_images
+from cluster_server_installer.utilities.command_runner import CommandResult, CommandRunner, command_runner, \
+    set_command_runner
+
+REDIS_DIGEST = 'sha256:' + 'a' * 64
+SCHEDULER_DIGEST = 'sha256:' + 'b' * 64
+
+
+class CtrRunner(CommandRunner):
+    def __init__(self, failing=()):
+        super().__init__()
+        self.images = {}
+        self.failing = set(failing)
+        self.calls = []
+
+    def _run(self, argv, timeout_in_seconds, env, secret_env, secrets, cwd, stdin, capture_limit) -> CommandResult:
+        self.calls.append((argv, tuple(secrets)))
+        command = argv[5:]
+        if command[0] == 'ls':
+            rows = [f'{name} application/vnd.oci.image.index.v1+json {digest} {size} MiB linux/amd64 -'
+                    for name, (digest, size) in self.images.items()]
+            return CommandResult(argv, 0, '\n'.join(['REF TYPE DIGEST SIZE PLATFORMS LABELS', *rows]), '', 0.0)
+        if command[0] == 'import':
+            self.images['docker.io/library/redis:7.2.4'] = (REDIS_DIGEST, 40)
+            return CommandResult(argv, 0, f'unpacking docker.io/library/redis:7.2.4 ({REDIS_DIGEST})...done\n', '',
+                                 2.0)
+        image = command[-1]
+        if image in self.failing:
+            return CommandResult(argv, 1, '', 'not found', 1.0)
+        self.images[image] = (SCHEDULER_DIGEST, 12)
+        return CommandResult(argv, 0, f'{image}: done\nelapsed: 3.0 s total: 12.5 Mi (4.2 MiB/s)\n', '', 3.0)
+
+
+@pytest.fixture
+def ctr():
+    previous = command_runner()
+    runner = CtrRunner(failing={'docker.io/library/busybox:latest'})
+    set_command_runner(runner)
+    yield runner
+    set_command_runner(previous)
+
+
+def test_references_are_normalized_like_containerd():
+    assert ImageReference.parse('redis:7.2.4').name == 'docker.io/library/redis:7.2.4'
+    assert ImageReference.parse('bitnami/redis').name == 'docker.io/bitnami/redis:latest'
+    assert ImageReference.parse('localhost:5000/app').name == 'localhost:5000/app:latest'
+    pinned = ImageReference.parse(f'registry.example.com/ciy/scheduler@{SCHEDULER_DIGEST}')
+    assert (pinned.registry, pinned.tag, pinned.name) == ('registry.example.com', None,
+                                                          f'registry.example.com/ciy/scheduler@{SCHEDULER_DIGEST}')
+
+
+def test_manifest_images_are_collected_once_and_pinned():
+    manifest = 'containers:\n  - image: "redis:7.2.4"\n    name: redis\n  - name: sidecar\n    image: redis:7.2.4\n'
+    assert [image.name for image in images_in_manifests([manifest, 'image: busybox'])] == [
+        'docker.io/library/redis:7.2.4', 'docker.io/library/busybox:latest']
+    pinned = pin_images(manifest, {'docker.io/library/redis:7.2.4': REDIS_DIGEST})
+    assert pinned.count(f'docker.io/library/redis@{REDIS_DIGEST}') == 2
+    assert f'image: "docker.io/library/redis@{REDIS_DIGEST}"' in pinned
+    assert pin_images('image: busybox\n', {}) == 'image: busybox\n'
+
+
+def test_prefetch_imports_the_archive_then_pulls_the_rest(ctr):
+    images = [ImageReference.parse(name) for name in ('redis:7.2.4', 'registry.example.com/ciy/scheduler:1.0',
+                                                      'busybox')]
+    prefetcher = ImagePrefetcher('registry.example.com', 'access-secret')
+    results = prefetcher.prefetch(images, archive=pathlib.Path('images.tar'))
+    assert [(result.image, result.source, result.succeeded) for result in results] == [
+        ('docker.io/library/redis:7.2.4', 'import', True),
+        ('registry.example.com/ciy/scheduler:1.0', 'pull', True),
+        ('docker.io/library/busybox:latest', 'pull', False)]
+    assert results[0].transferred_bytes == 40 * 1024 ** 2
+    assert results[1].digest == SCHEDULER_DIGEST and results[1].transferred_bytes == int(12.5 * 1024 ** 2)
+
+    pulls = {argv[-1]: (argv, secrets) for argv, secrets in ctr.calls if argv[5] == 'pull'}
+    assert 'docker.io/library/redis:7.2.4' not in pulls
+    assert pulls['registry.example.com/ciy/scheduler:1.0'][1] == ('access-secret',)
+    assert '--user' not in pulls['docker.io/library/busybox:latest'][0]
+    assert 'FAILED' in ImagePrefetcher.format_report(results).splitlines()[-1]
+
+
+def test_missing_images_compares_digests(ctr):
+    ctr.images['docker.io/library/redis:7.2.4'] = (REDIS_DIGEST, 40)
+    assert ImagePrefetcher().missing_images({'docker.io/library/redis:7.2.4': REDIS_DIGEST,
+                                             'docker.io/library/busybox:latest': SCHEDULER_DIGEST}) == [
+        'docker.io/library/busybox:latest']
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from cluster_server_installer.orchestration.install_graph import InstallGraph, InstallGraphError
+
+
+def test_nodes_run_after_their_dependencies_and_independent_ones_overlap():
+    graph = InstallGraph(max_workers=4)
+    started = {}
+    both_running = threading.Barrier(2, timeout=5)
+
+    def step(name, overlap=False):
+        def action():
+            started[name] = time.monotonic()
+            if overlap:
+                both_running.wait()
+            return name.upper()
+        return action
+
+    graph.add_node('packages', step('packages'))
+    graph.add_node('vpn', step('vpn', overlap=True), dependencies=['packages'])
+    graph.add_node('nfs', step('nfs', overlap=True), dependencies=['packages'])
+    graph.add_node('k3s', step('k3s'), dependencies=['vpn', 'nfs'])
+    assert graph.run() == {'packages': 'PACKAGES', 'vpn': 'VPN', 'nfs': 'NFS', 'k3s': 'K3S'}
+    assert started['packages'] < min(started['vpn'], started['nfs'])
+    assert started['k3s'] > max(started['vpn'], started['nfs'])
+
+
+def test_nodes_sharing_a_lock_never_run_together():
+    graph = InstallGraph(max_workers=4)
+    holders = []
+    overlaps = []
+
+    def locked():
+        holders.append(1)
+        overlaps.append(len(holders))
+        time.sleep(0.05)
+        holders.pop()
+
+    for name in ('apt-vpn', 'apt-nfs', 'apt-k3s'):
+        graph.add_node(name, locked, locks=['dpkg'])
+    graph.run()
+    assert overlaps == [1, 1, 1]
+
+
+def test_a_failing_node_cancels_the_graph_and_names_itself():
+    graph = InstallGraph(max_workers=2)
+    graph.add_node('broken', lambda: 1 / 0)
+    graph.add_node('after', lambda: None, dependencies=['broken'])
+    with pytest.raises(InstallGraphError) as error:
+        graph.run()
+    assert error.value.node_name == 'broken'
+    assert graph.cancel_event.is_set()
+    with pytest.raises(KeyError):
+        graph.result('after')
+
+
+@pytest.mark.parametrize('dependencies, message', [({'a': ['b'], 'b': ['a']}, 'cycle'),
+                                                   ({'a': ['missing']}, 'unknown')])
+def test_invalid_graphs_are_rejected_before_anything_runs(dependencies, message):
+    graph = InstallGraph()
+    ran = []
+    for name, node_dependencies in dependencies.items():
+        graph.add_node(name, lambda: ran.append(name), dependencies=node_dependencies)
+    with pytest.raises(ValueError, match=message):
+        graph.run()
+    assert not ran
+
+
+def test_duplicate_and_journaled_ephemeral_nodes_are_rejected():
+    graph = InstallGraph()
+    graph.add_node('k3s', lambda: None)
+    with pytest.raises(ValueError, match='Duplicate'):
+        graph.add_node('k3s', lambda: None)
+    with pytest.raises(ValueError, match='ephemeral'):
+        graph.add_node('token', lambda: None, inputs={}, ephemeral=True)
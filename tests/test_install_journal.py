@@ -0,0 +1,50 @@
+from cluster_server_installer.orchestration.install_graph import InstallGraph
+from cluster_server_installer.orchestration.install_journal import InstallJournal
+
+
+def test_recorded_steps_survive_a_restart_until_their_inputs_change(tmp_path):
+    path = tmp_path / 'journal.json'
+    InstallJournal(path).record('k3s', {'version': 'v1.27.9', 'flags': ['--disable', 'traefik']}, 'installed')
+
+    journal = InstallJournal(path)
+    # Key order does not matter to the fingerprint, the values do
+    assert journal.lookup('k3s', {'flags': ['--disable', 'traefik'], 'version': 'v1.27.9'}) == (True, 'installed')
+    assert journal.lookup('k3s', {'version': 'v1.28.5', 'flags': ['--disable', 'traefik']}) == (False, None)
+    journal.invalidate(['k3s', 'never-recorded'])
+    assert InstallJournal(path).lookup('k3s', {'version': 'v1.27.9', 'flags': ['--disable', 'traefik']}) == \
+        (False, None)
+    assert path.stat().st_mode & 0o777 == 0o600
+
+
+def test_a_journal_of_another_format_is_ignored(tmp_path):
+    path = tmp_path / 'journal.json'
+    path.write_text('{"version": 0, "steps": {"k3s": {"inputs": "x", "output": null}}}')
+    assert InstallJournal(path).lookup('k3s', {}) == (False, None)
+
+
+def build_graph(journal, runs, k3s_version='v1.27.9', verified=True):
+    graph = InstallGraph(journal=journal)
+    graph.add_node('packages', lambda: runs.append('packages'), inputs={'packages': ['nfs-common']})
+    graph.add_node('k3s', lambda: runs.append('k3s') or k3s_version, dependencies=['packages'],
+                   inputs={'version': k3s_version}, verify=lambda output: verified)
+    graph.add_node('deployments', lambda: runs.append('deployments'), dependencies=['k3s'], inputs={})
+    return graph
+
+
+def test_graph_resumes_and_reruns_what_changed_and_everything_after_it(tmp_path):
+    journal = InstallJournal(tmp_path / 'journal.json')
+    runs = []
+    build_graph(journal, runs).run()
+    assert runs == ['packages', 'k3s', 'deployments']
+
+    runs.clear()
+    graph = build_graph(journal, runs)
+    assert graph.run()['k3s'] == 'v1.27.9'
+    assert runs == [] and not graph.executed
+
+    build_graph(journal, runs, k3s_version='v1.28.5').run()
+    assert runs == ['k3s', 'deployments']
+
+    runs.clear()
+    build_graph(journal, runs, k3s_version='v1.28.5', verified=False).run()
+    assert runs == ['k3s', 'deployments']
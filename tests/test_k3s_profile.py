@@ -0,0 +1,48 @@
+import pytest
+import yaml
+
+from cluster_server_installer.k8s.k3s_profile import K3sProfile, parse_overrides
+from cluster_server_installer.utilities.host_facts import HostCapacity
+
+GIB = 1024 ** 3
+
+
+def component_flags(profile: K3sProfile, component: str):
+    return dict(argument.split('=', 1) for argument in profile.settings()[component])
+
+
+def test_limits_scale_with_the_host_within_bounds():
+    small = K3sProfile.for_host(HostCapacity(cpu_count=2, memory_bytes=4 * GIB, disk_bytes=40 * GIB))
+    large = K3sProfile.for_host(HostCapacity(cpu_count=64, memory_bytes=512 * GIB, disk_bytes=2000 * GIB))
+    assert component_flags(small, 'kube-apiserver-arg')['max-requests-inflight'] == '400'
+    assert component_flags(large, 'kube-apiserver-arg')['max-requests-inflight'] == '3200'
+    assert component_flags(small, 'kubelet-arg')['max-pods'] == str(K3sProfile.DEFAULT_MAX_PODS)
+    assert component_flags(large, 'kubelet-arg')['max-pods'] == str(K3sProfile.MAX_PODS_LIMIT)
+    assert component_flags(small, 'kubelet-arg')['image-gc-high-threshold'] == '75'
+    assert component_flags(large, 'kubelet-arg')['image-gc-high-threshold'] == '85'
+    # The datastore is never switched to embedded etcd behind the user's back
+    assert not small.embedded_etcd and not large.embedded_etcd
+
+
+def test_overrides_set_keys_and_single_component_flags():
+    profile = K3sProfile.for_host(HostCapacity(cpu_count=4, memory_bytes=16 * GIB, disk_bytes=200 * GIB))
+    overridden = profile.with_overrides(parse_overrides(['kubelet-arg.max-pods=200', 'flannel-backend=wireguard-native',
+                                                         'disable-scheduler=null', 'cluster-init=true']))
+    assert component_flags(overridden, 'kubelet-arg')['max-pods'] == '200'
+    assert len(overridden.settings()['kubelet-arg']) == len(profile.settings()['kubelet-arg'])
+    assert overridden.settings()['flannel-backend'] == 'wireguard-native'
+    assert 'disable-scheduler' not in overridden.settings()
+    assert overridden.embedded_etcd
+    # The original profile is left untouched
+    assert component_flags(profile, 'kubelet-arg')['max-pods'] != '200'
+    with pytest.raises(ValueError):
+        parse_overrides(['max-pods'])
+
+
+def test_saved_config_adds_node_settings(tmp_path):
+    profile = K3sProfile.for_host(HostCapacity(cpu_count=4, memory_bytes=16 * GIB, disk_bytes=200 * GIB))
+    path = tmp_path / 'config.yaml'
+    assert profile.save(path, {'node-ip': '10.0.0.5'})
+    assert not profile.save(path, {'node-ip': '10.0.0.5'})
+    assert yaml.safe_load(path.read_text()) == {**profile.settings(), 'node-ip': '10.0.0.5'}
+    assert path.stat().st_mode & 0o777 == 0o600
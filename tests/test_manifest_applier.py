@@ -0,0 +1,87 @@
+import pytest
+from kubernetes import client
+
+from cluster_server_installer.benchmarks.fake_kubernetes import FakeKubernetesApi, ReadinessDelays
+from cluster_server_installer.k8s.manifest_applier import ManifestApplier
+
+MANIFEST = '''
+apiVersion: admissionregistration.k8s.io/v1
+kind: ValidatingWebhookConfiguration
+metadata:
+  name: ciy-webhook
+---
+apiVersion: apps/v1
+kind: StatefulSet
+metadata:
+  name: postgres
+  namespace: cloud-iy
+spec:
+  replicas: 1
+---
+apiVersion: v1
+kind: ServiceAccount
+metadata:
+  name: dashboard
+  namespace: cloud-iy
+---
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: cloud-iy
+---
+apiVersion: example.com/v1
+kind: Unserved
+metadata:
+  name: nobody-serves-this
+'''
+
+
+@pytest.fixture
+def api():
+    api = FakeKubernetesApi(ReadinessDelays().scaled(0.1)).start()
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def applier(api):
+    configuration = client.Configuration()
+    configuration.host = api.url
+    with client.ApiClient(configuration) as api_client:
+        yield ManifestApplier(api_client, max_workers=4)
+
+
+def resource_version(api, path) -> int:
+    status, obj = api.handle('GET', path, b'')
+    assert status == 200
+    return int(obj['metadata']['resourceVersion'])
+
+
+def test_tiers_are_applied_in_order(api, applier):
+    results = applier.apply_manifest(MANIFEST)
+    assert [result.kind for result in results] == ['Namespace', 'ServiceAccount', 'StatefulSet', 'Unserved',
+                                                   'ValidatingWebhookConfiguration']
+    # Every write takes the next resource version, so the versions record the order the server saw the objects in
+    versions = [resource_version(api, '/api/v1/namespaces/cloud-iy'),
+                resource_version(api, '/api/v1/namespaces/cloud-iy/serviceaccounts/dashboard'),
+                resource_version(api, '/apis/apps/v1/namespaces/cloud-iy/statefulsets/postgres'),
+                resource_version(api, '/apis/admissionregistration.k8s.io/v1/validatingwebhookconfigurations/'
+                                      'ciy-webhook')]
+    assert versions == sorted(versions)
+
+
+def test_an_unserved_kind_fails_only_its_own_object(applier):
+    results = {result.kind: result for result in applier.apply_manifest(MANIFEST)}
+    assert not results['Unserved'].succeeded
+    assert all(result.succeeded for kind, result in results.items() if kind != 'Unserved')
+
+
+def test_applied_objects_carry_the_manifest_hash(api, applier):
+    document, = ManifestApplier.load_documents(MANIFEST.split('---')[3])
+    applier.apply_documents([document])
+    _, live = api.handle('GET', '/api/v1/namespaces/cloud-iy', b'')
+    assert live['metadata']['annotations'][ManifestApplier.APPLIED_HASH_ANNOTATION] == \
+        ManifestApplier.applied_hash(document)
+    # The annotation itself does not feed the hash, so re-hashing an applied document gives the same value
+    assert ManifestApplier.applied_hash(ManifestApplier.with_applied_hash(document)) == \
+        ManifestApplier.applied_hash(document)
@@ -0,0 +1,129 @@
+import base64
+import json
+
+import pytest
+from kubernetes import client
+
+from cluster_server_installer.benchmarks.fake_kubernetes import FakeKubernetesApi, ReadinessDelays
+from cluster_server_installer.k8s.manifest_applier import ManifestApplier
+from cluster_server_installer.k8s.manifest_reconciler import ManifestReconciler, semantic_differences
+
+NAMESPACE_MANIFEST = '''
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: cloud-iy
+'''
+
+DASHBOARD_MANIFEST = '''
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: dashboard
+  namespace: cloud-iy
+spec:
+  replicas: 2
+  selector:
+    matchLabels:
+      app: dashboard
+  template:
+    metadata:
+      labels:
+        app: dashboard
+    spec:
+      containers:
+      - name: dashboard
+        image: dashboard:1
+        ports:
+        - containerPort: 8080
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: dashboard
+  namespace: cloud-iy
+spec:
+  selector:
+    app: dashboard
+  ports:
+  - port: 80
+    targetPort: "8080"
+'''
+
+SECRET_MANIFEST = '''
+apiVersion: v1
+kind: Secret
+metadata:
+  name: redis-pwd
+  namespace: cloud-iy
+stringData:
+  redis-pwd: hunter2
+'''
+
+MANIFESTS = [('namespace.yaml', NAMESPACE_MANIFEST), ('dashboard.yaml', DASHBOARD_MANIFEST)]
+
+
+@pytest.fixture
+def api():
+    api = FakeKubernetesApi(ReadinessDelays().scaled(0.1)).start()
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def applier(api):
+    configuration = client.Configuration()
+    configuration.host = api.url
+    with client.ApiClient(configuration) as api_client:
+        yield ManifestApplier(api_client, max_workers=4)
+
+
+def put(api, path, obj):
+    status, _ = api.handle('PUT', path, json.dumps(obj).encode('utf-8'))
+    assert status == 200
+
+
+def test_only_fields_the_manifest_sets_are_compared():
+    desired = {'spec': {'replicas': 2, 'ports': [{'port': 80, 'targetPort': '8080'}]}}
+    live = {'spec': {'replicas': 2, 'ports': [{'port': '80', 'targetPort': 8080, 'protocol': 'TCP'}],
+                     'clusterIP': '10.43.0.10'}, 'status': {}}
+    assert semantic_differences(desired, live) == []
+    assert semantic_differences({'spec': {'replicas': 2, 'ports': [{'port': 80}]}},
+                                {'spec': {'replicas': 3, 'ports': [{'port': 80}, {'port': 443}]}}) == [
+        'spec.replicas', 'spec.ports']
+    assert semantic_differences({'spec': {'template': {'spec': {}}}}, {'spec': {'template': None}}) == [
+        'spec.template']
+
+
+def test_plan_lists_changed_missing_and_unannotated_objects(api, applier):
+    reconciler = ManifestReconciler(applier)
+    for _, manifest in MANIFESTS:
+        applier.apply_manifest(manifest)
+    assert reconciler.plan(MANIFESTS).drifts == ()
+
+    _, deployment = api.handle('GET', '/apis/apps/v1/namespaces/cloud-iy/deployments/dashboard', b'')
+    deployment['spec']['replicas'] = 5
+    put(api, '/apis/apps/v1/namespaces/cloud-iy/deployments/dashboard', deployment)
+    api.handle('DELETE', '/api/v1/namespaces/cloud-iy/services/dashboard', b'')
+    put(api, '/api/v1/namespaces/cloud-iy', {'metadata': {'name': 'cloud-iy'}})
+
+    plan = reconciler.plan(MANIFESTS)
+    assert {(drift.kind, drift.differences) for drift in plan.drifts} == {
+        ('Namespace', ('metadata.annotations.ciy-installer/applied-hash',)),
+        ('Deployment', ('spec.replicas',)),
+        ('Service', (ManifestReconciler.MISSING,))}
+    assert plan.manifests == ['namespace.yaml', 'dashboard.yaml']
+    assert plan.format().splitlines()[0] == '3 of 3 objects differ from the bundled manifests'
+
+    assert all(result.succeeded for result in reconciler.apply(plan))
+    assert reconciler.plan(MANIFESTS).drifts == ()
+
+
+def test_secret_string_data_matches_its_encoded_data(api, applier):
+    applier.apply_manifest(NAMESPACE_MANIFEST)
+    document, = ManifestApplier.load_documents(SECRET_MANIFEST)
+    # What the API server stores for the applied Secret
+    live = {key: value for key, value in ManifestApplier.with_applied_hash(document).items() if key != 'stringData'}
+    live['data'] = {'redis-pwd': base64.b64encode(b'hunter2').decode('utf-8')}
+    put(api, '/api/v1/namespaces/cloud-iy/secrets/redis-pwd', live)
+    assert ManifestReconciler(applier).plan([('redis.yaml', SECRET_MANIFEST)]).drifts == ()
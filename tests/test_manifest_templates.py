@@ -0,0 +1,40 @@
+import pytest
+
+from cluster_server_installer.k8s.manifest_templates import ManifestTemplate, ManifestTemplateSet, TemplateError
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return path
+
+
+def test_render_is_a_single_pass(tmp_path):
+    template = ManifestTemplate.load(write(tmp_path, 'ingress.yaml', 'host: ${DOMAIN}\nemail: ${EMAIL}\n'))
+    # A value that looks like a placeholder is inserted as it is, never expanded again
+    assert template.render({'DOMAIN': '${EMAIL}', 'EMAIL': 'ops@example.com'}) == \
+        'host: ${EMAIL}\nemail: ops@example.com\n'
+    with pytest.raises(TemplateError, match='EMAIL'):
+        template.render({'DOMAIN': 'example.com'})
+
+
+def test_template_sets_reject_unknown_and_missing_variables(tmp_path):
+    paths = [write(tmp_path, 'a.yaml', '${DOMAIN}'), write(tmp_path, 'b.yaml', '${DOMAIN} ${EMAIL}')]
+    with pytest.raises(TemplateError, match='TYPO'):
+        ManifestTemplateSet([*paths, write(tmp_path, 'c.yaml', '${TYPO}')], ['DOMAIN', 'EMAIL'])
+
+    templates = ManifestTemplateSet(paths, ['DOMAIN', 'EMAIL', 'UNUSED'])
+    assert templates.manifests_by_variable() == {'DOMAIN': ['a.yaml', 'b.yaml'], 'EMAIL': ['b.yaml'], 'UNUSED': []}
+    with pytest.raises(TemplateError, match='EMAIL'):
+        list(templates.render({'DOMAIN': 'example.com'}))
+    with pytest.raises(TemplateError, match='EXTRA'):
+        list(templates.render({'DOMAIN': 'example.com', 'EMAIL': 'ops@example.com', 'EXTRA': ''}))
+    assert [text for _, text in templates.render({'DOMAIN': 'example.com', 'EMAIL': 'ops@example.com'})] == \
+        ['example.com', 'example.com ops@example.com']
+
+
+def test_bundled_manifests_use_every_known_variable():
+    from cluster_server_installer.k8s.k3s_installer import K3sInstaller
+
+    # Loading already rejects unknown variables, a known one nothing uses is dead configuration
+    assert all(K3sInstaller.load_manifest_templates().manifests_by_variable().values())
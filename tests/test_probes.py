@@ -0,0 +1,109 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from cluster_server_installer.orchestration.install_graph import InstallGraph, InstallGraphError
+from cluster_server_installer.utilities.command_runner import CommandResult, CommandRunner, command_runner, \
+    set_command_runner
+from cluster_server_installer.utilities.probes import HttpEndpointProbe, Probe, ProbeEngine, SystemdUnitProbe
+
+
+class NeverReadyProbe(Probe):
+    def check(self, engine: ProbeEngine) -> bool:
+        return False
+
+
+class ReadyAfterProbe(Probe):
+    def __init__(self, name: str, attempts: int):
+        super().__init__(name)
+        self._attempts = attempts
+
+    def check(self, engine: ProbeEngine) -> bool:
+        self._attempts -= 1
+        if self._attempts > 0:
+            raise ConnectionRefusedError('connection refused')
+        return True
+
+
+class SystemctlRunner(CommandRunner):
+    def __init__(self, states):
+        super().__init__()
+        self.states = states
+        self.calls = []
+
+    def _run(self, argv, *args) -> CommandResult:
+        self.calls.append(argv)
+        return CommandResult(argv, 3, ''.join(f'{self.states.get(unit, "inactive")}\n' for unit in argv[2:]), '',
+                             0.0)
+
+
+@pytest.fixture
+def systemctl():
+    previous = command_runner()
+    runner = SystemctlRunner({'headscale': 'active', 'k3s': 'activating'})
+    set_command_runner(runner)
+    yield runner
+    set_command_runner(previous)
+
+
+def test_probes_retry_until_ready_and_report_attempts():
+    engine = ProbeEngine(initial_delay_in_seconds=0.01, max_delay_in_seconds=0.02)
+    ready, never = engine.wait_all([ReadyAfterProbe('ready', 3), NeverReadyProbe('never')], 0.5)
+    assert ready.ready and ready.attempts == 3
+    assert not never.ready and never.last_error == 'not ready'
+    failing = engine.wait(ReadyAfterProbe('refused', 100), 0.1)
+    assert failing.last_error == 'ConnectionRefusedError: connection refused'
+
+
+def test_systemd_probes_share_one_systemctl_call(systemctl):
+    engine = ProbeEngine(initial_delay_in_seconds=10)
+    assert engine.systemd_unit_states(['headscale', 'k3s']) == {'headscale': 'active', 'k3s': 'activating'}
+    assert engine.wait(SystemdUnitProbe('headscale'), 1).ready
+    assert systemctl.calls == [('systemctl', 'is-active', 'headscale', 'k3s')]
+
+
+def test_http_endpoint_probe_needs_an_answer_below_500():
+    statuses = [503, 404]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(statuses.pop(0) if statuses else 200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        result = ProbeEngine(initial_delay_in_seconds=0.01).wait(
+            HttpEndpointProbe('score', f'127.0.0.1:{server.server_address[1]}'), 5)
+        assert result.ready and result.attempts == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_cancelling_the_graph_stops_a_waiting_probe():
+    graph = InstallGraph(max_workers=2)
+    engine = ProbeEngine()
+    engine.bind_cancel_event(graph.cancel_event)
+    results = []
+
+    def fail():
+        time.sleep(0.2)
+        raise RuntimeError('sibling failed')
+
+    graph.add_node('waits', lambda: results.append(engine.wait(NeverReadyProbe('never-ready'), 600)))
+    graph.add_node('fails', fail)
+    start = time.monotonic()
+    with pytest.raises(InstallGraphError):
+        graph.run()
+    # A cancelled run does not wait for its running steps, the probe has to notice the cancellation on its own
+    while not results and time.monotonic() - start < 10:
+        time.sleep(0.05)
+    assert results and not results[0].ready
+    assert results[0].last_error == 'cancelled'
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+from kubernetes import client
+
+from cluster_server_installer.benchmarks.fake_kubernetes import FakeKubernetesApi, ReadinessDelays
+from cluster_server_installer.k8s.readiness_gates import DeploymentRolloutGate, HelmChartJobGate, \
+    ReadinessFailedError, ReadinessTimeoutError, ServiceEndpointsGate, wait_for_gates
+
+DEPLOYMENT = {'metadata': {'name': 'dashboard'},
+              'spec': {'replicas': 2, 'selector': {'matchLabels': {'app': 'dashboard'}},
+                       'template': {'metadata': {'labels': {'app': 'dashboard'}},
+                                    'spec': {'containers': [{'name': 'dashboard', 'image': 'dashboard:1'}]}}}}
+
+
+@pytest.fixture
+def api():
+    api = FakeKubernetesApi(ReadinessDelays().scaled(0.1)).start()
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def api_client(api):
+    configuration = client.Configuration()
+    configuration.host = api.url
+    with client.ApiClient(configuration) as api_client:
+        yield api_client
+
+
+def test_gates_wait_for_rollout_and_endpoints(api, api_client):
+    client.AppsV1Api(api_client).create_namespaced_deployment('cloud-iy', DEPLOYMENT)
+    client.CoreV1Api(api_client).create_namespaced_service('cloud-iy', {
+        'metadata': {'name': 'dashboard'}, 'spec': {'selector': {'app': 'dashboard'}, 'ports': [{'port': 80}]}})
+    gate = DeploymentRolloutGate('cloud-iy', 'dashboard', timeout_in_seconds=10)
+    assert not gate._is_ready({})
+    wait_for_gates([gate, ServiceEndpointsGate('cloud-iy', 'dashboard', timeout_in_seconds=10)], api_client)
+    status = client.AppsV1Api(api_client).read_namespaced_deployment('dashboard', 'cloud-iy').status
+    assert status.available_replicas == 2
+
+
+def test_an_expired_watch_relists_and_keeps_waiting(api, api_client):
+    class CompactingGate(DeploymentRolloutGate):
+        checks = 0
+
+        def _is_ready(self, objects):
+            # Runs between the first list and its watch, so that watch starts from a compacted version
+            CompactingGate.checks += 1
+            if CompactingGate.checks == 1:
+                api.compact()
+            return super()._is_ready(objects)
+
+    client.AppsV1Api(api_client).create_namespaced_deployment('cloud-iy', DEPLOYMENT)
+    CompactingGate('cloud-iy', 'dashboard', timeout_in_seconds=10).wait(api_client)
+    assert api.api_calls['GET deployments'] == 2
+
+
+def test_a_failed_helm_job_fails_the_gate(api, api_client):
+    api.handle('POST', '/apis/batch/v1/namespaces/kube-system/jobs', json.dumps({
+        'metadata': {'name': 'helm-install-traefik'},
+        'status': {'failed': 1, 'conditions': [{'type': 'Failed', 'status': 'True',
+                                                'message': 'BackoffLimitExceeded'}]}}).encode())
+    with pytest.raises(ReadinessFailedError, match='BackoffLimitExceeded'):
+        HelmChartJobGate('kube-system', 'traefik', timeout_in_seconds=10).wait(api_client)
+
+
+def test_a_missing_object_times_out(api_client):
+    with pytest.raises(ReadinessTimeoutError):
+        DeploymentRolloutGate('cloud-iy', 'missing', timeout_in_seconds=1).wait(api_client)
@@ -0,0 +1,44 @@
+import zipfile
+
+import pytest
+
+from cluster_server_installer.utilities.resources import Resources
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'deployments').mkdir(parents=True)
+    (source / 'deployments' / 'redis.yaml').write_text('kind: Deployment\n')
+    (source / 'lego.tar.gz').write_bytes(b'\x1f\x8b already compressed')
+    install_script = source / 'install.sh'
+    install_script.write_text('#!/bin/sh\n')
+    install_script.chmod(0o755)
+    return source
+
+
+def test_archived_resources_are_extracted_once_on_first_use(tmp_path, source):
+    archive = tmp_path / 'resources.zip'
+    assert Resources.build_archive(source, archive) == ['deployments/redis.yaml', 'install.sh', 'lego.tar.gz']
+    with zipfile.ZipFile(archive) as bundle:
+        assert bundle.getinfo('lego.tar.gz').compress_type == zipfile.ZIP_STORED
+        assert bundle.getinfo('install.sh').compress_type == zipfile.ZIP_DEFLATED
+
+    bundled = Resources(directories=[], archive=archive, extract_dir=tmp_path / 'extracted')
+    assert not (tmp_path / 'extracted').exists()
+    path = bundled.path('install.sh')
+    assert path == tmp_path / 'extracted' / 'install.sh'
+    assert path.read_text() == '#!/bin/sh\n' and path.stat().st_mode & 0o777 == 0o755
+    assert [path.name for path in (tmp_path / 'extracted').iterdir()] == ['install.sh']
+    assert bundled.path('install.sh') == path
+    with pytest.raises(FileNotFoundError):
+        bundled.path('missing.yaml')
+
+
+def test_plain_files_take_precedence_over_the_archive(tmp_path, source):
+    archive = tmp_path / 'resources.zip'
+    Resources.build_archive(source, archive)
+    (source / 'install.sh').write_text('#!/bin/sh\n# edited\n')
+    bundled = Resources(directories=[source], archive=archive, extract_dir=tmp_path / 'extracted')
+    assert bundled.path('install.sh') == source / 'install.sh'
+    assert bundled.names() == ['deployments/redis.yaml', 'install.sh', 'lego.tar.gz']
@@ -0,0 +1,78 @@
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from cluster_server_installer.benchmarks.score_benchmark import format_report, run_benchmark
+from cluster_server_installer.k8s.ciy_scheduler_installer import CiySchedulerInstaller
+from cluster_server_installer.utilities.host_facts import HostCapacity, HostFacts, set_host_facts
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in one segment, a second small write would wait on the client's delayed ack
+    wbufsize = -1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def score_servers(tmp_path):
+    socket_path = tmp_path / 'score.sock'
+    servers = [ThreadingHTTPServer(('127.0.0.1', 0), ScoreHandler),
+               socketserver.ThreadingUnixStreamServer(str(socket_path), ScoreHandler)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield {'tcp': f'127.0.0.1:{servers[0].server_address[1]}', 'uds': f'unix://{socket_path}'}
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def host_with_cpus():
+    def set_cpus(cpu_count: int):
+        set_host_facts(HostFacts('node-1', HostCapacity(cpu_count, 16 * 1024 ** 3, 200 * 1024 ** 3), ()))
+
+    yield set_cpus
+    set_host_facts(None)
+
+
+def test_both_transports_are_measured_and_compared(score_servers):
+    results = run_benchmark(score_servers, requests=50)
+    assert [result.transport for result in results] == ['tcp', 'uds']
+    assert all(result.errors == 0 and 0 < result.p50_ms <= result.p99_ms for result in results)
+    assert format_report(results).splitlines()[-1].startswith('tcp p50 is ')
+
+
+def test_an_unreachable_endpoint_counts_every_request_as_an_error():
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    result, = run_benchmark({'tcp': f'127.0.0.1:{port}'}, requests=10)
+    assert (result.errors, result.p50_ms) == (10, 0.0)
+    assert 'p50 is' not in format_report([result])
+
+
+def test_environment_file_follows_the_transport_and_workers(host_with_cpus):
+    host_with_cpus(12)
+    tcp = CiySchedulerInstaller().environment_file('cloud.example.com')
+    assert 'SCHEDULER_SCORE_SERVER_URL=0.0.0.0:25555\n' in tcp and 'WORKERS' not in tcp
+    uds = CiySchedulerInstaller('uds').environment_file('cloud.example.com')
+    assert 'SCHEDULER_SCORE_SERVER_URL=unix:///run/ciy-scheduler/score.sock\n' in uds
+    assert uds.endswith('SCHEDULER_SCORE_WORKERS=6\n')
+    explicit = CiySchedulerInstaller('tcp', score_workers=3).environment_file('cloud.example.com')
+    assert explicit.endswith('SCHEDULER_SCORE_WORKERS=3\nGOMAXPROCS=3\n')
+    host_with_cpus(64)
+    assert CiySchedulerInstaller('uds').score_workers == CiySchedulerInstaller.MAX_SCORE_WORKERS
+    with pytest.raises(ValueError, match='quic'):
+        CiySchedulerInstaller('quic')
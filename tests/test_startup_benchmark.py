@@ -0,0 +1,13 @@
+from cluster_server_installer.benchmarks.startup_benchmark import run_benchmark
+
+
+def test_renew_certs_dispatch_stays_clear_of_heavy_modules():
+    # The inventory file does not exist, the probe has to exit before fleet reads it
+    renew_certs, fleet = run_benchmark(1, ['renew-certs', 'fleet'], None)
+    assert renew_certs.modules > 0 and not renew_certs.heavy_modules
+    assert not fleet.heavy_modules
+
+
+def test_install_dispatch_imports_the_pipeline():
+    install, = run_benchmark(1, ['install'], None)
+    assert 'kubernetes' in install.heavy_modules
@@ -0,0 +1,60 @@
+import pathlib
+
+import pytest
+
+from cluster_server_installer.benchmarks.storage_benchmark import format_report, run_benchmark
+from cluster_server_installer.k8s.storage_profile import StorageProfile
+from cluster_server_installer.utilities.command_runner import CommandResult, CommandRunner, command_runner, \
+    set_command_runner
+
+SHARE_PATH = pathlib.Path('/srv/nfs/share')
+BULK_SHARE_PATH = pathlib.Path('/srv/nfs/bulk')
+
+
+class FailingMountRunner(CommandRunner):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def _run(self, argv, *args) -> CommandResult:
+        self.calls.append(argv)
+        return CommandResult(argv, 32, '', 'mount.nfs: Connection refused', 0.0)
+
+
+@pytest.fixture
+def failing_mount():
+    previous = command_runner()
+    runner = FailingMountRunner()
+    set_command_runner(runner)
+    yield runner
+    set_command_runner(previous)
+
+
+def test_nfs_settings_scale_with_the_host_within_bounds():
+    small = StorageProfile.for_host(1, SHARE_PATH, BULK_SHARE_PATH)
+    large = StorageProfile.for_host(64, SHARE_PATH, BULK_SHARE_PATH)
+    assert (small.nfsd_threads, large.nfsd_threads) == (8, 256)
+    assert 'nconnect=1' in small.mount_options and 'nconnect=8' in large.mount_options
+    assert large.nfs_conf() == '[nfsd]\nthreads=256\n'
+    assert large.exports_file() == ('/srv/nfs/share *(rw,sync,no_subtree_check,no_root_squash)\n'
+                                    '/srv/nfs/bulk *(rw,async,no_subtree_check,no_root_squash)\n')
+
+
+def test_latency_backend_picks_the_database_storage_class():
+    nfs = StorageProfile.for_host(4, SHARE_PATH, BULK_SHARE_PATH)
+    local = StorageProfile.for_host(4, SHARE_PATH, BULK_SHARE_PATH, latency_backend='local-path')
+    assert (nfs.database_storage_class, nfs.k3s_overrides()) == ('nfs-client', {})
+    assert local.template_values()['DATABASE_STORAGE_CLASS'] == 'local-path'
+    assert local.k3s_overrides() == {'disable': ['servicelb', 'traefik']}
+    with pytest.raises(ValueError, match='ceph'):
+        StorageProfile.for_host(4, SHARE_PATH, BULK_SHARE_PATH, latency_backend='ceph')
+
+
+def test_benchmark_falls_back_to_the_directory_when_nfs_cannot_mount(tmp_path, failing_mount):
+    profile = StorageProfile.for_host(4, tmp_path, tmp_path)
+    result, = run_benchmark({'nfs-client': tmp_path}, size_mib=1, fsyncs=5, mount_options=profile.mount_options)
+    assert failing_mount.calls[0][:3] == ('mount', '-t', 'nfs')
+    assert not result.mounted and result.path == str(tmp_path)
+    assert result.write_mib_per_second > 0 and result.fsync_p99_ms >= result.fsync_p50_ms
+    assert list(tmp_path.iterdir()) == []
+    assert format_report([result]).splitlines()[1].startswith('nfs-client     local')
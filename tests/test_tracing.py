@@ -0,0 +1,45 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cluster_server_installer.utilities.tracing import Tracer, compare_traces, propagate_context, summarize_events
+
+
+def test_spans_nest_across_worker_threads():
+    tracer = Tracer()
+
+    def step(name: str):
+        with tracer.span(name, 'install-step'):
+            pass
+
+    with tracer.span('install', 'run') as root:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(propagate_context(step), ['vpn', 'k3s']))
+    steps = [span for span in tracer.spans if span.category == 'install-step']
+    assert sorted(span.name for span in steps) == ['k3s', 'vpn']
+    assert all(span.parent_id == root.span_id for span in steps)
+
+
+def test_failed_spans_record_the_error_and_export_as_chrome_trace(tmp_path):
+    tracer = Tracer()
+    with pytest.raises(RuntimeError):
+        with tracer.span('k3s', 'install-step', version='v1.27.9'):
+            raise RuntimeError('download failed')
+    trace = json.loads(tracer.export(tmp_path / 'trace.json').read_text())
+    event, = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    assert event['name'] == 'k3s' and event['dur'] >= 0
+    assert event['args']['version'] == 'v1.27.9'
+    assert event['args']['error'] == 'RuntimeError: download failed'
+    assert 'k3s' in summarize_events(trace['traceEvents'])
+
+
+def test_trace_comparison_orders_steps_by_change():
+    def events(**durations):
+        return [{'ph': 'X', 'cat': 'install-step', 'name': name, 'dur': seconds * 1e6, 'args': {}}
+                for name, seconds in durations.items()]
+
+    report = compare_traces(events(k3s=30, vpn=5), events(k3s=10, vpn=5, removed=2)).splitlines()
+    assert [line.split()[-1] for line in report[1:]] == ['install-step:k3s', 'install-step:removed',
+                                                         'install-step:vpn']
+    assert '+20.00s' in report[1] and '-2.00s' in report[2]